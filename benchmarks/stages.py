@@ -0,0 +1,233 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+#
+# Per-stage benchmarks of the simulation pipeline
+#
+# Runs offline against data/materials.csv and data/dataset_ISAF22. Every stage
+# is timed on its own (best of --repeat runs with perf_counter), peak memory is
+# the tracemalloc peak of one extra run. Results are appended as one JSON line
+# per run to the history file, tagged with the git commit.
+#
+# From the repository root:
+#   python -m benchmarks.stages                    run and append to the history
+#   python -m benchmarks.stages --quick            small sizes only
+#   python -m benchmarks.stages --compare A B      compare two commits of the history
+#
+
+from time import perf_counter
+import subprocess
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import datetime
+import shutil
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from simulation.src.data.loader import Material, MaterialLibrary, VNA_Dataloader
+from simulation.src.features.transducer import Transducer
+from simulation.src.features.characteristics import Model_init, compile_layers
+from simulation.src.features.circuit import Transducer_acoustic_circuit
+from simulation.src.features.kernel import MasonKernel
+from simulation.src.features.ports import acoustic_transmission_line
+from simulation.src.features.ports import mason_piezo, mason_ac_transducer, mason_transformer, mason_el_transducer
+from simulation.src.models.sweep import sweep_xMason
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MATERIALS = os.path.join(ROOT, 'data', 'materials.csv')
+DATASET = os.path.join(ROOT, 'data', 'dataset_ISAF22')
+HISTORY = os.path.join(ROOT, 'benchmarks', 'results', 'history.jsonl')
+
+# ISAF22 reference stack
+PARAMETERS = {'radius': 0.0088,
+              'thickness_td': 12.3 * 10 ** -6,
+              'thickness_el': 0.5 * 10 ** -6,
+              'thickness_sub': 13 * 10 ** -6,
+              'Tload': 'Air',
+              'Telectrode': 'Silverink',
+              'piezo': 'P(VDF-TrFE)',
+              'Belectrode': 'Silverink',
+              'Bsubstrate': 'Kapton',
+              'Bload': 'Air'}
+
+N_FREQS = [1000, 10000, 100000]
+N_LAYERS = [1, 4, 16]
+BATCH_SIZES = [1, 16, 256]
+
+
+def measure(function, repeat):
+    function()  # warm up (imports, material cache)
+    seconds = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        seconds.append(perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(seconds), peak
+
+
+def transducer():
+    return Transducer(material=Material(MATERIALS).library, **PARAMETERS)
+
+
+# Pipeline stages on a frequency grid of n_freqs points
+#
+def pipeline_stages(n_freqs):
+    frequency = np.linspace(20 * 10 ** 6, 100 * 10 ** 6, n_freqs)
+    td = transducer()
+    init = Model_init(transducer=td).compiled
+    lines = acoustic_transmission_line(init=init, frequency=frequency).values
+    piezo = mason_piezo(init=init, frequency=frequency).values
+    acoustic = mason_ac_transducer(acoustic_struct=lines, piezo=piezo, init=init).values
+    transformed = mason_transformer(acoustic_struct=acoustic, init=init).values
+    kernel = MasonKernel(init)
+    out = np.empty(n_freqs, dtype=complex)
+
+    return {'acoustic_transmission_line': lambda: acoustic_transmission_line(init=init, frequency=frequency).values,
+            'mason_piezo': lambda: mason_piezo(init=init, frequency=frequency).values,
+            'mason_ac_transducer': lambda: mason_ac_transducer(acoustic_struct=lines, piezo=piezo, init=init).values,
+            'mason_transformer': lambda: mason_transformer(acoustic_struct=acoustic, init=init).values,
+            'mason_el_transducer': lambda: mason_el_transducer(impedance=transformed, init=init,
+                                                               frequency=frequency).values,
+            'circuit_per_stage': lambda: Transducer_acoustic_circuit(compiled=init, frequency=frequency),
+            'fused_kernel': lambda: kernel.evaluate(frequency, out=out)}
+
+
+def run(quick=False, repeat=5):
+    n_freqs = N_FREQS[:2] if quick else N_FREQS
+    results = []
+
+    def record(stage, seconds, peak, points=None, **size):
+        results.append(dict(stage=stage, seconds=seconds, peak_bytes=int(peak),
+                            points_per_s=(points / seconds if points else None), **size))
+        print(f"{stage:<28} {json.dumps(size):<40} {seconds * 1e3:10.3f} ms {peak / 2 ** 20:9.2f} MiB")
+
+    # Inputs
+    #
+    def load_materials():
+        MaterialLibrary.clear()
+        return Material(MATERIALS).library
+
+    record('Material', *measure(load_materials, repeat))
+    record('Transducer', *measure(transducer, repeat))
+    td = transducer()
+    record('Model_init', *measure(lambda: Model_init(transducer=td).compiled, repeat))
+
+    with tempfile.TemporaryDirectory() as copy:
+        dataset = shutil.copytree(DATASET, os.path.join(copy, 'dataset'))
+        record('VNA_Dataloader', *measure(lambda: VNA_Dataloader(dataset, process=1, fcut=100, cache=False), repeat),
+               cache='off')
+        record('VNA_Dataloader', *measure(lambda: VNA_Dataloader(dataset, process=1, fcut=100, cache=True), repeat),
+               cache='on')
+
+    # Circuit stages against frequency points
+    #
+    for n in n_freqs:
+        for stage, function in pipeline_stages(n).items():
+            record(stage, *measure(function, repeat), points=n, n_freqs=n)
+
+    # Layer count (compiled chain of any depth)
+    #
+    library = Material(MATERIALS).library
+    frequency = np.linspace(20 * 10 ** 6, 100 * 10 ** 6, n_freqs[-1])
+    for n_layers in N_LAYERS:
+        stack = compile_layers(library=library, radius=PARAMETERS['radius'], piezo=PARAMETERS['piezo'],
+                               thickness_td=PARAMETERS['thickness_td'],
+                               top_layers=[('Silverink', 0.5 * 10 ** -6)] * n_layers,
+                               bottom_layers=[('Silverink', 0.5 * 10 ** -6)] + [('Kapton', 13 * 10 ** -6)] * (n_layers - 1),
+                               Tload='Air')
+        record('mason_chain', *measure(lambda: stack.electric_impedance(frequency), repeat),
+               points=len(frequency), n_freqs=len(frequency), n_layers=n_layers)
+
+    # Batch size (designs per vectorized block)
+    #
+    n = n_freqs[0]
+    for batch_size in BATCH_SIZES:
+        parameters = dict(PARAMETERS, fband=[20, 100], frequency=np.linspace(20 * 10 ** 6, 100 * 10 ** 6, n),
+                          thickness_td=np.linspace(10, 20, batch_size) * 10 ** -6)
+        sweep = sweep_xMason(parameters=parameters, matpath=MATERIALS, compute=False)
+        record('sweep_block', *measure(lambda: sweep.evaluate_block(0, batch_size), repeat),
+               points=n * batch_size, n_freqs=n, batch_size=batch_size)
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(results, path=HISTORY):
+    entry = {'commit': git_commit(),
+             'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+             'python': platform.python_version(),
+             'numpy': np.__version__,
+             'machine': platform.machine(),
+             'results': results}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as history:
+        history.write(json.dumps(entry) + '\n')
+
+
+# Time ratio (new / old) of every stage and size of the latest runs of two commits
+#
+def compare(old, new, path=HISTORY):
+    with open(path) as history:
+        entries = [json.loads(line) for line in history if line.strip()]
+
+    def latest(commit):
+        runs = [entry for entry in entries if entry['commit'] and entry['commit'].startswith(commit)]
+        if not runs:
+            raise ValueError(f"No benchmark run of commit '{commit}' in {path}.")
+        table = pd.DataFrame(runs[-1]['results']).drop(columns=['points_per_s'])
+        size = [column for column in table.columns if column not in ['stage', 'seconds', 'peak_bytes']]
+        return table.set_index(['stage'] + size)
+
+    table = latest(old).join(latest(new), lsuffix='_old', rsuffix='_new', how='outer')
+    table['speedup'] = table['seconds_old'] / table['seconds_new']
+    table['memory'] = table['peak_bytes_new'] / table['peak_bytes_old']
+    return table
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-stage xMason benchmarks')
+    parser.add_argument('--quick', action='store_true', help='skip the largest frequency grid')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--history', default=HISTORY, help='JSON lines history file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two commits of the history')
+    arguments = parser.parse_args()
+
+    if arguments.compare:
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(compare(*arguments.compare, path=arguments.history))
+    else:
+        save(run(quick=arguments.quick, repeat=arguments.repeat), path=arguments.history)
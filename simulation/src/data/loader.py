@@ -18,54 +18,257 @@
 
 import pandas as pd
 import numpy as np
+import threading
+import tempfile
 import glob
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 class Material():
     def __init__(self, path=None):
         self._material_path = path
+        self._library = MaterialLibrary.load(self._material_path)
         self._material = self.load_mat()
 
     def load_mat(self):
-        mat_load = pd.read_csv(self._material_path, header=[0,1,2])
-        return mat_load
+        return self._library.frame
 
     @property
     def material(self):
         return self._material
 
+    @property
+    def library(self):
+        return self._library
+
+
+
+class MaterialLibrary():
+    #
+    # Typed, name-indexed view of a materials table (materials.csv layout:
+    # three header rows, one material per row).
+    #
+    # MaterialLibrary.load(path) parses each file once per process; the
+    # library is cached by absolute path and modification time, so edits to
+    # the file are picked up on the next load.
+    #
+    _libraries = {}
+    _lock = threading.Lock()
+
+    DESCRIPTIVE = ['Material', 'Source', 'Details']
+
+    def __init__(self, frame=None):
+        self._frame = frame
+        self._names = frame.xs('Material', axis=1, level=0).iloc[:, 0].astype(str).to_list()
+        self._index = {name: row for row, name in enumerate(self._names)}
+
+        # Numeric constants, columns holding complex strings are converted once
+        #
+        self._properties = {}
+        for column in frame.columns.get_level_values(0):
+            if column in self.DESCRIPTIVE:
+                continue
+            values = frame.xs(column, axis=1, level=0).iloc[:, 0]
+            if values.dtype == object:
+                self._properties[column] = np.array([to_complex(value) for value in values], dtype=complex)
+            else:
+                self._properties[column] = values.to_numpy(dtype=float)
+
+
+    @classmethod
+    def load(cls, path=None):
+        path = os.path.abspath(path)
+        key = (path, os.path.getmtime(path))
+        with cls._lock:
+            library = cls._libraries.get(key)
+            if library is None:
+                library = cls(frame=pd.read_csv(path, header=[0, 1, 2]))
+                for stale in [cached for cached in cls._libraries if cached[0] == path]:
+                    del cls._libraries[stale]
+                cls._libraries[key] = library
+        return library
+
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._libraries.clear()
+
+
+    def index(self, name=None):
+        try:
+            return self._index[name]
+        except KeyError:
+            raise KeyError(f"Material '{name}' not found in the material library.") from None
+
+
+    # Single material constant, e.g. library.value('P(VDF-TrFE)', 'eps33')
+    #
+    def value(self, name=None, column=None):
+        return self._properties[column][self.index(name)]
+
+
+    # Constants of several materials as arrays, e.g. library.values(['Air', 'Kapton'], 'roh')
+    #
+    def values(self, names=None, column=None):
+        return self._properties[column][[self.index(name) for name in names]]
+
+
+    # Raw table row (1-row DataFrame) of a material
+    #
+    def row(self, name=None):
+        return self._frame.iloc[[self.index(name)]]
+
+
+    @property
+    def frame(self):
+        return self._frame
+
+    @property
+    def names(self):
+        return self._names
+
+    @property
+    def properties(self):
+        return self._properties
+
+
+
+# Parse complex constants written as '1+2j', '1-2j' or '0.43−j*0.0004'
+#
+def to_complex(value):
+    if not isinstance(value, str):
+        return complex(value)
+    value = value.replace('\u2212', '-').replace(' ', '')
+    value = re.sub(r'([+-])j\*?([0-9.eE+-]+)$', r'\1\2j', value)
+    try:
+        return complex(value)
+    except ValueError:
+        return complex(np.nan)
+
 
 class VNA_Dataloader():
-    def __init__(self, path, process=1, fcut=60):
-        if process == 1:
-            self.experiments = self.process(self.loaddata(path)[0], fcut)
-            self.files = self.loaddata(path)[1]
-        elif process == 0:
-            self.experiments, self.files = self.loaddata(path)
-        else:
+    #
+    # Load all VNA sweeps (*.csv, *.CSV) below `path`.
+    #
+    # process:   1 -> omit all points at or above fcut [MHz], 0 -> keep all points
+    # cache:     keep a binary .npy copy of every parsed file in a .vna_cache
+    #            directory next to it. A copy is reused as long as it is newer
+    #            than its csv file and is opened memory-mapped.
+    # n_workers: threads used to parse the files
+    # pad:       False skips building experiments/mask, the sweeps can then be
+    #            streamed in padded blocks with chunks() (memory-mapped if cached)
+    #
+    # sweeps:      list of (n_points, n_columns) arrays, one per file (ragged)
+    # experiments: (n_points_max, n_columns, n_files) array, shorter sweeps are
+    #              padded with NaN
+    # mask:        (n_points_max, n_files) True where experiments holds data
+    # files:       file names without extension
+    #
+    CACHE_DIR = '.vna_cache'
+
+    def __init__(self, path, process=1, fcut=60, cache=True, n_workers=None, pad=True):
+        self._cache = cache
+        self._n_workers = n_workers
+
+        if process not in [0, 1]:
             print('ERROR: Wrong value encountert')
+            return
+
+        self.sweeps, self.files = self.loaddata(path)
+        if process == 1:
+            self.sweeps = self.process(self.sweeps, fcut)
+        self.experiments, self.mask = self.pad(self.sweeps) if pad else (None, None)
 
 
+    # Padded (n_points_max, n_columns, <=chunk_size) blocks of consecutive
+    # files, e.g. for stats.column_statistics
+    #
+    def chunks(self, chunk_size=64):
+        n_points = max((sweep.shape[0] for sweep in self.sweeps), default=0)
+        for start in range(0, len(self.sweeps), chunk_size):
+            experiments, _ = self.pad(self.sweeps[start:start + chunk_size], n_points=n_points)
+            yield experiments
+
+
+    # omit all values larger than cutoff frequency MHz
+    #
     def process(self, d, f):
-        return np.dstack([d[np.squeeze(np.argwhere(d[:, 0, idx] < f * 10 **6)),:, idx] for idx in range(d.shape[2])])  # omit all values larger than cutoff frequency MHz
+        processed = []
+        for sweep in d:
+            keep = sweep[:, 0] < f * 10 ** 6
+            n_keep = np.count_nonzero(keep)
+            processed.append(sweep[:n_keep] if keep[:n_keep].all() else sweep[keep])  # slice (no copy) if sorted
+        return processed
 
     def loaddata(self, p):
-        d = []
-        for f in self.loadFiles(p):
-            exp = np.genfromtxt(f, delimiter=',')
-            d.append(np.array(exp))
+        files = self.loadFiles(p)
+        with ThreadPoolExecutor(max_workers=self._n_workers) as pool:
+            d = list(pool.map(self.read_file, files))
+        return d, np.array([os.path.splitext(os.path.basename(f))[0] for f in files])
 
-        d = [d[idx][~np.isnan(d[idx]).all(axis=1), :] for idx, _ in enumerate(d)] # cut first Nan row
+    def loadFiles(self, data_path, fileext=['*.csv', '*.CSV']):
+        extensions = [ext.lstrip('*').lower() for ext in fileext]
+        files = [f for f in glob.glob(os.path.join(data_path, '**', '*'), recursive=True)
+                 if os.path.splitext(f)[1].lower() in extensions and os.path.isfile(f)]
+        return np.unique(files)
 
 
-        return np.dstack(d), np.array([os.path.basename(f)[:-4] for f in self.loadFiles(p)])
+    # Parse a single sweep, going through the binary cache if enabled
+    #
+    def read_file(self, f):
+        if not self._cache:
+            return read_vna_csv(f)
 
-    def loadFiles(self, data_path, fileext=['*.csv', '*.CSV']):
-        return np.unique(glob.glob(os.path.join(data_path, '**', fileext[0]), recursive=True) +
-                         glob.glob(os.path.join(data_path, '**', fileext[1]), recursive=True))
+        cached = os.path.join(os.path.dirname(f), self.CACHE_DIR, os.path.basename(f) + '.npy')
+        if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(f):
+            try:
+                return np.load(cached, mmap_mode='r')
+            except (ValueError, OSError):
+                pass
+
+        exp = read_vna_csv(f)
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            handle, tmp = tempfile.mkstemp(dir=os.path.dirname(cached), suffix='.npy')
+            with os.fdopen(handle, 'wb') as tmp_file:
+                np.save(tmp_file, exp)
+            os.replace(tmp, cached)
+        except OSError:
+            pass  # read-only archive, parse again next time
+        return exp
 
 
+    # Stack ragged sweeps into a NaN padded array and its validity mask
+    #
+    def pad(self, d, n_points=None):
+        if len(d) == 0:
+            return np.empty((0, 0, 0)), np.empty((0, 0), dtype=bool)
+        n_points = n_points or max(sweep.shape[0] for sweep in d)
+        n_columns = max(sweep.shape[1] for sweep in d)
+        experiments = np.full((n_points, n_columns, len(d)), np.nan)
+        mask = np.zeros((n_points, len(d)), dtype=bool)
+        for idx, sweep in enumerate(d):
+            experiments[:sweep.shape[0], :sweep.shape[1], idx] = sweep
+            mask[:sweep.shape[0], idx] = True
+        return experiments, mask
 
 
 
+# Read a VNA csv export into a float array
+#
+# A leading header line is skipped and rows without any value are dropped
+# (same result as np.genfromtxt followed by removing all-NaN rows).
+#
+def read_vna_csv(path):
+    with open(path) as csv_file:
+        first = csv_file.readline()
+    try:
+        [float(value) for value in first.strip().split(',') if value.strip()]
+        header = 0
+    except ValueError:
+        header = 1
 
+    exp = pd.read_csv(path, header=None, skiprows=header).apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    return exp[~np.isnan(exp).all(axis=1), :]
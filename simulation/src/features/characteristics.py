@@ -19,6 +19,8 @@
 import pandas as pd
 import numpy as np
 
+from simulation.src.features.compiled import CompiledStack
+
 
 class Model_init():
     #
@@ -27,14 +29,13 @@ class Model_init():
     # Smart Mater. Struct., 23, 045036.
     #
     def __init__(self, transducer=None):
-        self._transducer_geometry = transducer.geometry
-        self._transducer_material = transducer.material
-
-        self._e33 = complex(self._transducer_material.loc[(['piezo'], slice(None), slice(None)), 'eps33'].values)
-        self._h33 = complex(self._transducer_material.loc[(['piezo'], slice(None), slice(None)), 'h33'].values)
+        self._transducer_index = transducer.material_index
+        self._compiled = compile_transducer(transducer)
 
-        self._init_electric_circuit = self.Eport()
-        self._init_acoustic_circuit = self.Aport()
+        # pandas views are only built on request
+        #
+        self._init_electric_circuit = None
+        self._init_acoustic_circuit = None
 
 
 
@@ -44,10 +45,9 @@ class Model_init():
     #
     # Piezoelectric constant: https://piezo.com/pages/piezo-terminology-glossary#:~:text=The%20piezoelectric%20constants%20relating%20the%20electric%20field%20produced%20by%20a,meter%20per%20newtons%2Fsquare%20meter.
     def Eport(self):
-        C0 = self._e33 * ((self._transducer_geometry.loc[(['piezo'], slice(None), slice(None)), 'Radius'] ** 2) * np.pi / 4) \
-             / self._transducer_geometry.loc[(['piezo'], slice(None), slice(None)), 'Thickness']
-        N = C0 * self._h33
-        return pd.DataFrame([C0, N], index=['C0', 'N']).T
+        piezo_idx = [idx for idx in self._transducer_index if idx[0] == 'piezo']
+        return pd.DataFrame({'C0': [complex(self._compiled.C0)], 'N': [complex(self._compiled.N)]},
+                            index=pd.MultiIndex.from_tuples(piezo_idx))
 
 
 
@@ -56,78 +56,175 @@ class Model_init():
     #
     #
     def Aport(self):
+        Z0 = np.concatenate((self._compiled.Z0_top,
+                             [self._compiled.Z0_piezo],
+                             self._compiled.Z0_bottom[::-1]))
+        return pd.DataFrame([Z0], columns=pd.MultiIndex.from_tuples(self._transducer_index))
 
-        # Acoustic Loads
-        #
-        Z0_Tload = acoustic_impedance(density=float(self._transducer_material.loc[(['Tload'], slice(None), slice(None)), 'roh'].values),
-                                      sos=float(self._transducer_material.loc[(['Tload'], slice(None), slice(None)), 'v'].values),
-                                      shape='circular',
-                                      radius=float(self._transducer_geometry.loc[(['Telectrode'], slice(None), slice(None)), 'Radius'].values))
-
-        Z0_Bload = acoustic_impedance(density=float(self._transducer_material.loc[(['Tload'], slice(None), slice(None)), 'roh'].values),
-                                      sos=float(self._transducer_material.loc[(['Tload'], slice(None), slice(None)), 'v'].values),
-                                      shape='circular',
-                                      radius=float(self._transducer_geometry.loc[(['Telectrode'], slice(None), slice(None)), 'Radius'].values))
-
-
-        # Electrode Layers
-        #
-        Z0_Tel = acoustic_impedance(density=float(self._transducer_material.loc[(['Telectrode'], slice(None), slice(None)), 'roh'].values),
-                                    sos=float(self._transducer_material.loc[(['Telectrode'], slice(None), slice(None)), 'v'].values),
-                                    shape='circular',
-                                    radius=float(self._transducer_geometry.loc[(['Telectrode'], slice(None), slice(None)), 'Radius'].values))
 
-        Z0_Bel = acoustic_impedance(density=float(self._transducer_material.loc[(['Telectrode'], slice(None), slice(None)), 'roh'].values),
-                                    sos=float(self._transducer_material.loc[(['Telectrode'], slice(None), slice(None)), 'v'].values),
-                                    shape='circular',
-                                    radius=float(self._transducer_geometry.loc[(['Telectrode'], slice(None), slice(None)), 'Radius'].values))
-
-
-        # Transducer Layer
-        #
-        Z0_piezo = acoustic_impedance(density=float(self._transducer_material.loc[(['piezo'], slice(None), slice(None)), 'roh'].values),
-                                      sos=float(self._transducer_material.loc[(['piezo'], slice(None), slice(None)), 'v'].values),
-                                      shape='circular',
-                                      radius=float(self._transducer_geometry.loc[(['piezo'], slice(None), slice(None)), 'Radius'].values))
+    @property
+    def Z0_acoustic(self):
+        if self._init_acoustic_circuit is None:
+            self._init_acoustic_circuit = self.Aport()
+        return self._init_acoustic_circuit
 
+    @property
+    def electric(self):
+        if self._init_electric_circuit is None:
+            self._init_electric_circuit = self.Eport()
+        return self._init_electric_circuit
 
-        # Substrate Layer (Backing)
-        #
-        if ~np.isnan(self._transducer_geometry.loc[(['Bsubstrate'], slice(None), slice(None)), 'Radius'].values):
-            Z0_substrate = acoustic_impedance(density=float(self._transducer_material.loc[(['Bsubstrate'], slice(None), slice(None)), 'roh'].values),
-                                              sos=float(self._transducer_material.loc[(['Bsubstrate'], slice(None), slice(None)), 'v'].values),
-                                              shape='circular',
-                                              radius=float(self._transducer_geometry.loc[(['Bsubstrate'], slice(None), slice(None)), 'Radius'].values))
+    @property
+    def compiled(self):
+        return self._compiled
+
+
+
+# COMPILE a transducer into a CompiledStack
+#
+def compile_transducer(transducer=None):
+    properties = transducer.properties
+    by_layer = {name: dict(zip(properties['layers'], properties[name]))
+                for name in ['roh', 'v', 'eps33', 'h33', 'radius', 'width', 'height', 'thickness']}
+    return compile_stack(**by_layer)
+
+
+# Characteristic properties of a stack as a CompiledStack
+#
+# All arguments are dicts keyed by layer (Tload, Telectrode, piezo, Belectrode,
+# Bsubstrate, Bload). Geometry entries may be arrays, they are broadcast into
+# the design axes of the compiled stack.
+#
+# Loads, electrodes and substrate follow the conventions of the Mason model:
+# - both loads use the top load material (Tload) and the electrode radius,
+#   the Bload entries are not used (as in Transducer and compile_layers)
+# - both electrodes use the top electrode material
+# - the substrate is circular unless its radius is undefined (width/height ratio)
+# - missing characteristic impedances are treated as short (0)
+#
+# Material constants per layer that compile_stack reads (the others follow
+# the conventions above and have no effect)
+COMPILED_CONSTANTS = {'roh': ['Tload', 'Telectrode', 'piezo', 'Bsubstrate'],
+                      'v': ['Tload', 'Telectrode', 'piezo', 'Belectrode', 'Bsubstrate'],
+                      'eps33': ['piezo'],
+                      'h33': ['piezo']}
+
+
+def compile_stack(roh=None, v=None, eps33=None, h33=None, radius=None, width=None, height=None, thickness=None):
+
+    Z0_load = acoustic_impedance(density=roh['Tload'],
+                                 sos=v['Tload'],
+                                 shape='circular',
+                                 radius=radius['Telectrode'])
+
+    Z0_el = acoustic_impedance(density=roh['Telectrode'],
+                               sos=v['Telectrode'],
+                               shape='circular',
+                               radius=radius['Telectrode'])
+
+    Z0_piezo = acoustic_impedance(density=roh['piezo'],
+                                  sos=v['piezo'],
+                                  shape='circular',
+                                  radius=radius['piezo'])
+
+    Z0_substrate = np.where(np.isnan(radius['Bsubstrate']),
+                            acoustic_impedance(density=roh['Bsubstrate'],
+                                               sos=v['Bsubstrate'],
+                                               shape='rectangular',
+                                               height=width['Bsubstrate'],
+                                               width=height['Bsubstrate']),
+                            acoustic_impedance(density=roh['Bsubstrate'],
+                                               sos=v['Bsubstrate'],
+                                               shape='circular',
+                                               radius=radius['Bsubstrate']))
+
+    C0, N = electric_characteristics(eps33=eps33['piezo'],
+                                     h33=h33['piezo'],
+                                     radius=radius['piezo'],
+                                     thickness=thickness['piezo'])
+
+    shape = np.broadcast(Z0_load, Z0_el, Z0_piezo, Z0_substrate, C0,
+                         thickness['Telectrode'], thickness['Belectrode'], thickness['Bsubstrate']).shape
+
+    def layers(*values):
+        return np.stack([np.broadcast_to(value, shape) for value in values], axis=-1)
+
+    return CompiledStack(Z0_top=np.nan_to_num(layers(Z0_load, Z0_el)),
+                         v_top=layers(v['Tload'], v['Telectrode']),
+                         l_top=layers(thickness['Tload'], thickness['Telectrode']),
+                         Z0_bottom=np.nan_to_num(layers(Z0_load, Z0_substrate, Z0_el)),
+                         v_bottom=layers(v['Tload'], v['Bsubstrate'], v['Belectrode']),
+                         l_bottom=layers(thickness['Bload'], thickness['Bsubstrate'], thickness['Belectrode']),
+                         Z0_piezo=np.nan_to_num(np.broadcast_to(Z0_piezo, shape)),
+                         v_piezo=np.broadcast_to(v['piezo'], shape),
+                         t_piezo=np.broadcast_to(thickness['piezo'], shape),
+                         C0=np.broadcast_to(C0, shape),
+                         N=np.broadcast_to(N, shape))
+
+
+
+# Characteristic properties of a stack with any number of layers
+#
+# library:       MaterialLibrary
+# radius:        default radius of all layers and loads
+# piezo, thickness_td: material and thickness of the piezo layer
+# top_layers, bottom_layers: layers listed from the piezo outwards, e.g.
+#                [('Silverink', 0.5e-6), ('Epoxy', 2e-6), ('Kapton', 13e-6)]
+#                A layer can also be a dict with the keys material, thickness
+#                and optionally radius or width and height.
+# Tload:         material of the semi-infinite load that terminates both
+#                branches (Mason convention of compile_stack)
+#
+# Thicknesses and radii may be arrays, they are broadcast into the design axes.
+#
+def compile_layers(library=None, radius=None, piezo=None, thickness_td=None,
+                   top_layers=(), bottom_layers=(), Tload=None):
+
+    def layer(spec):
+        if isinstance(spec, dict):
+            material, thickness, geometry = spec['material'], spec['thickness'], spec
         else:
-            Z0_substrate = acoustic_impedance(density=float(self._transducer_material.loc[(['Bsubstrate'], slice(None), slice(None)), 'roh'].values),
-                                              sos=float(self._transducer_material.loc[(['Bsubstrate'], slice(None), slice(None)), 'v'].values),
-                                              shape='rectangular',
-                                              height=float(self._transducer_geometry.loc[(['Bsubstrate'], slice(None), slice(None)), 'Width'].values),
-                                              width=float(self._transducer_geometry.loc[(['Bsubstrate'], slice(None), slice(None)), 'Height'].values))
+            (material, thickness), geometry = spec, {}
 
+        density = library.value(material, 'roh')
+        sos = library.value(material, 'v')
+        if 'width' in geometry:
+            Z0 = acoustic_impedance(density=density, sos=sos, shape='rectangular',
+                                    width=geometry['width'], height=geometry['height'])
+        else:
+            Z0 = acoustic_impedance(density=density, sos=sos, shape='circular',
+                                    radius=geometry.get('radius', radius))
+        return Z0, sos, thickness
 
-        # Set all elements together in a pandas array
-        Z0 = pd.DataFrame([Z0_Tload,
-                           Z0_Tel,
-                           Z0_piezo,
-                           Z0_Bel,
-                           Z0_substrate,
-                           Z0_Bload],
-                          index=self._transducer_material.index.to_list())
+    def branch(load, layers):
+        return [layer((load, np.nan))] + [layer(spec) for spec in reversed(list(layers))]
 
-        midx = pd.MultiIndex.from_tuples(Z0.index.to_list())
-        Z0 = Z0.reset_index(drop=True).set_index(midx).T
+    top = branch(Tload, top_layers)
+    bottom = branch(Tload, bottom_layers)
 
-        return Z0.fillna(0)
+    Z0_piezo, v_piezo, _ = layer((piezo, thickness_td))
+    C0, N = electric_characteristics(eps33=library.value(piezo, 'eps33'),
+                                     h33=library.value(piezo, 'h33'),
+                                     radius=radius,
+                                     thickness=thickness_td)
 
+    # np.broadcast takes at most 32 arrays, deep stacks exceed that
+    shape = np.broadcast_shapes(*[np.shape(value) for value in [Z0_piezo, C0] + [value for entry in top + bottom for value in entry]])
 
-    @property
-    def Z0_acoustic(self):
-        return self._init_acoustic_circuit
+    def layers(entries, position):
+        return np.stack([np.broadcast_to(entry[position], shape) for entry in entries], axis=-1)
 
-    @property
-    def electric(self):
-        return self._init_electric_circuit
+    return CompiledStack(Z0_top=np.nan_to_num(layers(top, 0)),
+                         v_top=layers(top, 1),
+                         l_top=layers(top, 2),
+                         Z0_bottom=np.nan_to_num(layers(bottom, 0)),
+                         v_bottom=layers(bottom, 1),
+                         l_bottom=layers(bottom, 2),
+                         Z0_piezo=np.nan_to_num(np.broadcast_to(Z0_piezo, shape)),
+                         v_piezo=np.broadcast_to(v_piezo, shape),
+                         t_piezo=np.broadcast_to(thickness_td, shape),
+                         C0=np.broadcast_to(C0, shape),
+                         N=np.broadcast_to(N, shape))
 
 
 
@@ -140,3 +237,10 @@ def acoustic_impedance(density=None, sos=None, shape=None, **kwargs):
         return ((density * sos) * rectangular_area)
     else:
         return (density * sos)
+
+
+
+def electric_characteristics(eps33=None, h33=None, radius=None, thickness=None):
+    C0 = eps33 * ((radius ** 2) * np.pi / 4) / thickness
+    N = C0 * h33
+    return C0, N
@@ -18,53 +18,72 @@
 
 
 
-from datetime import datetime
 from simulation.src.features.characteristics import Model_init
 from simulation.src.features.ports import acoustic_transmission_line
 from simulation.src.features.ports import mason_piezo, mason_ac_transducer, mason_transformer, mason_el_transducer
+from simulation.src.features.ports import frequency_points
+from simulation.src.features.sampling import adaptive_frequency_sampling
+from simulation.src.features.profiling import stage
 
 class Transducer_acoustic_circuit():
-    def __init__(self, transducer=None, fband=None):
-
-        print('Initializing model... ')
-        start_time = datetime.now()
-        #
-        self._characteristic_impedance = Model_init(transducer=transducer).Z0_acoustic
-        self._el_element_characteristic = Model_init(transducer=transducer).electric
+    #
+    # fband:     [f_low, f_high] in MHz, simulated on the default 1 kHz grid
+    # frequency: user supplied frequency vector in Hz (replaces the 1 kHz grid)
+    # sampling:  None or 'adaptive' (refine the grid around resonances,
+    #            see sampling.adaptive_frequency_sampling)
+    # compiled:  CompiledStack to simulate instead of a Transducer
+    #            (e.g. from characteristics.compile_layers)
+    #
+    # Runs silently, the stages report their timing to the hooks registered
+    # in features.profiling (e.g. a profiling.Profiler).
+    #
+    def __init__(self, transducer=None, fband=None, frequency=None, sampling=None, compiled=None):
+
+        with stage('Model_init'):
+            if compiled is None:
+                self._model_init = Model_init(transducer=transducer)
+                self._compiled_stack = self._model_init.compiled
+            else:
+                self._model_init = None
+                self._compiled_stack = compiled
+
+        if sampling == 'adaptive':
+            with stage('adaptive_frequency_sampling'):
+                frequency, _ = adaptive_frequency_sampling(evaluate=self._compiled_stack.electric_impedance,
+                                                           fband=fband,
+                                                           frequency=frequency)
+        elif sampling is not None:
+            raise ValueError(f"Unknown frequency sampling '{sampling}', use None or 'adaptive'.")
+        self._frequency = frequency_points(fband, frequency)
+        n_freqs = len(self._frequency)
+
+        # The stage results are only kept until the next stage consumed them
         #
-        end_time = datetime.now()
-        init_time = end_time - start_time
-        print('')
-        print(f'Model initialized in {init_time.total_seconds()} seconds')
-
+        with stage('acoustic_transmission_line', n_freqs=n_freqs):
+            impedance_acoustic_structures = acoustic_transmission_line(transducer=transducer,
+                                                                       init=self._compiled_stack,
+                                                                       frequency=self._frequency).values
 
+        with stage('mason_piezo', n_freqs=n_freqs):
+            impedance_mason_piezo = mason_piezo(transducer=transducer,
+                                                init=self._compiled_stack,
+                                                frequency=self._frequency).values
 
-        print('')
-        print('Start simulation... ')
-        start_time = datetime.now()
-        #
-        self._impedance_acoustic_structures = acoustic_transmission_line(transducer=transducer,
-                                                                         init=self._characteristic_impedance,
-                                                                         fband=fband).impedance
-
-        self._impedance_mason_piezo = mason_piezo(transducer=transducer,
-                                                  init=self._characteristic_impedance,
-                                                  fband=fband).impedance
+        with stage('mason_ac_transducer', n_freqs=n_freqs):
+            impedance_ac_transducer = mason_ac_transducer(acoustic_struct=impedance_acoustic_structures,
+                                                          piezo=impedance_mason_piezo,
+                                                          init=self._compiled_stack).values
+            del impedance_acoustic_structures, impedance_mason_piezo
 
-        self._impedance_ac_transducer = mason_ac_transducer(acoustic_struct=self._impedance_acoustic_structures,
-                                                            piezo=self._impedance_mason_piezo).impedance
+        with stage('mason_transformer', n_freqs=n_freqs):
+            impedance_transformer = mason_transformer(acoustic_struct=impedance_ac_transducer,
+                                                      init=self._compiled_stack).values
+            del impedance_ac_transducer
 
-        self._impedance_transformer = mason_transformer(acoustic_struct=self._impedance_ac_transducer,
-                                                        init=self._el_element_characteristic).impedance
-
-        self._impedance_el_transducer = mason_el_transducer(impedance=self._impedance_transformer,
-                                                            init=self._el_element_characteristic,
-                                                            fband=fband).impedance
-        #
-        end_time = datetime.now()
-        init_time = end_time - start_time
-        print('')
-        print(f'Impedance simulation took {init_time.total_seconds()}seconds')
+        with stage('mason_el_transducer', n_freqs=n_freqs):
+            self._impedance_el_transducer = mason_el_transducer(impedance=impedance_transformer,
+                                                                init=self._compiled_stack,
+                                                                frequency=self._frequency).impedance
 
 
 
@@ -72,4 +91,14 @@ class Transducer_acoustic_circuit():
     def electric_impedance(self):
         return self._impedance_el_transducer
 
+    @property
+    def frequency(self):
+        return self._frequency
 
+    @property
+    def characteristics(self):
+        return self._model_init
+
+    @property
+    def compiled(self):
+        return self._compiled_stack
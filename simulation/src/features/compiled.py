@@ -0,0 +1,102 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+
+import numpy as np
+
+from simulation.src.features.kernel import kernel_constants, fused_mason_impedance
+
+
+LAYERED = ['Z0_top', 'v_top', 'l_top', 'Z0_bottom', 'v_bottom', 'l_bottom']
+
+
+class CompiledStack():
+    #
+    # Array-backed transducer stack consumed by the circuit stages.
+    #
+    # Z0_top, v_top, l_top:          (..., n_top) from top load towards the piezo
+    # Z0_bottom, v_bottom, l_bottom: (..., n_bottom) from bottom load towards the piezo
+    # Z0_piezo, v_piezo, t_piezo:    (...)
+    # C0, N:                         (...) complex
+    #
+    # The leading axes (...) are design axes, a single transducer has shape ().
+    #
+    __slots__ = ['Z0_top', 'v_top', 'l_top',
+                 'Z0_bottom', 'v_bottom', 'l_bottom',
+                 'Z0_piezo', 'v_piezo', 't_piezo',
+                 'C0', 'N']
+
+    def __init__(self,
+                 Z0_top=None, v_top=None, l_top=None,
+                 Z0_bottom=None, v_bottom=None, l_bottom=None,
+                 Z0_piezo=None, v_piezo=None, t_piezo=None,
+                 C0=None, N=None):
+
+        self.Z0_top = np.asarray(Z0_top, dtype=float)
+        self.v_top = np.asarray(v_top, dtype=float)
+        self.l_top = np.asarray(l_top, dtype=float)
+
+        self.Z0_bottom = np.asarray(Z0_bottom, dtype=float)
+        self.v_bottom = np.asarray(v_bottom, dtype=float)
+        self.l_bottom = np.asarray(l_bottom, dtype=float)
+
+        self.Z0_piezo = np.asarray(Z0_piezo, dtype=float)
+        self.v_piezo = np.asarray(v_piezo, dtype=float)
+        self.t_piezo = np.asarray(t_piezo, dtype=float)
+
+        self.C0 = np.asarray(C0, dtype=complex)
+        self.N = np.asarray(N, dtype=complex)
+
+
+    # Fused Mason chain (kernel.fused_mason_impedance), the stage by stage
+    # formulation is ports.mason_chain_impedance
+    #
+    def electric_impedance(self, frequency=None, out=None):
+        return fused_mason_impedance(frequency, kernel_constants(self), out=out)
+
+
+    # Select designs along the leading axes
+    #
+    def __getitem__(self, idx):
+        return CompiledStack(**{name: value[idx] for name, value in self.arrays.items()})
+
+
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+
+    # Combine single (or batched) stacks with identical layer counts into one batch
+    #
+    @staticmethod
+    def concatenate(stacks=None):
+        def batch(stack, name):
+            if name in LAYERED:
+                return np.atleast_2d(getattr(stack, name))
+            return np.atleast_1d(getattr(stack, name))
+
+        return CompiledStack(**{name: np.concatenate([batch(stack, name) for stack in stacks])
+                                for name in CompiledStack.__slots__})
+
+
+    @property
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @property
+    def shape(self):
+        return self.Z0_piezo.shape
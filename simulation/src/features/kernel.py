@@ -0,0 +1,191 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+
+
+class MasonKernel():
+    #
+    # Fused single pass evaluation of the Mason chain of a CompiledStack.
+    #
+    # The frequency independent constants are folded once (kernel_constants)
+    # and the workspace buffers are kept per output shape, so
+    # evaluate(frequency, out=...) runs without allocating any array of the
+    # size of the spectrum. One kernel per thread (the buffers are shared
+    # between calls).
+    #
+    def __init__(self, compiled=None):
+        self._constants = kernel_constants(compiled)
+        self._buffers = {}
+
+
+    # Electrical impedance (..., n_freqs) at frequency (n_freqs,) or (..., n_freqs) [Hz]
+    #
+    def evaluate(self, frequency=None, out=None):
+        frequency = np.asarray(frequency, dtype=float)
+        shape = np.broadcast_shapes(self._constants['shape'] + (1,), frequency.shape)
+        if shape not in self._buffers:
+            self._buffers = {shape: allocate_buffers(shape)}
+        return fused_mason_impedance(frequency, self._constants, out=out, buffers=self._buffers[shape])
+
+
+    @property
+    def constants(self):
+        return self._constants
+
+
+
+# Frequency independent constants of a CompiledStack (read-only)
+#
+# Transmission lines: load impedance, Z0, 1/Z0 and electrical length per Hz
+# (2pi * l / v) of every layer. T-network: j Z0, 4 Z0, -Z0 / 2 and the half
+# electrical length per Hz (pi * t / v). Capacitor: Zc * f = -j / (2pi * C0).
+# Transformer: 1 / N^2.
+#
+def kernel_constants(compiled=None):
+    Z0 = compiled.Z0_piezo[..., None]
+    constants = {'top': kernel_branch(compiled.Z0_top, compiled.v_top, compiled.l_top),
+                 'bottom': kernel_branch(compiled.Z0_bottom, compiled.v_bottom, compiled.l_bottom),
+                 'jZ0': read_only(1j * Z0),
+                 'Z0_4': read_only(4 * Z0),
+                 'Z0_half': read_only(-Z0 / 2),
+                 'k_half': read_only((np.pi * compiled.t_piezo / compiled.v_piezo)[..., None]),
+                 'k_cap': read_only((-1j / (2 * np.pi * compiled.C0))[..., None]),
+                 'inv_N2': read_only((1 / compiled.N ** 2)[..., None])}
+    constants['shape'] = compiled.shape
+    return constants
+
+
+def kernel_branch(Z0, v, l):
+    Z0 = np.asarray(Z0, dtype=float)
+    return {'Z_load': read_only(Z0[..., 0:1]),
+            'Z0': read_only(Z0[..., 1:]),
+            'Y0': read_only(1 / Z0[..., 1:]),
+            'k': read_only(2 * np.pi * np.asarray(l, dtype=float)[..., 1:] / np.asarray(v, dtype=float)[..., 1:])}
+
+
+# Workspace of fused_mason_impedance for an output shape
+#
+def allocate_buffers(shape=None):
+    buffers = {name: np.empty(shape) for name in ['A', 'B', 'C', 'D', 't', 'u', 'w']}
+    buffers.update({name: np.empty(shape, dtype=complex) for name in ['Z_top', 'Z_bottom', 'work']})
+    return buffers
+
+
+# FUSED MASON CHAIN
+#
+# Frequency -> electrical impedance in one pass over preallocated buffers:
+# one tan per layer and frequency for the transmission lines (normalized
+# ABCD cascade, see ports.cascade_chain_matrix) and a single tan(theta/2) for
+# the T-network. The acoustic port uses the closed form
+#
+#   Z_ac = Z_center + (Z_side + Z_top) || (Z_side + Z_bottom)
+#        = -j Z0 / (2T) + (a S + 2 Z_top Z_bottom) / (2 (2a + S))
+#
+#   T = tan(theta / 2), a = j Z0 T, S = Z_top + Z_bottom
+#
+# which avoids the cancellation of the two diverging terms at the half-wave
+# resonances of the piezo (theta = k pi), where 1/sin(theta) and
+# tan(theta/2) blow up.
+#
+# out, buffers: optional preallocated output and workspace (allocate_buffers)
+#
+def fused_mason_impedance(frequency=None, constants=None, out=None, buffers=None):
+    frequency = np.asarray(frequency, dtype=float)
+    shape = np.broadcast_shapes(constants['shape'] + (1,), frequency.shape)
+    if buffers is None:
+        buffers = allocate_buffers(shape)
+    if out is None:
+        out = np.empty(shape, dtype=complex)
+
+    Z_top = branch_kernel(frequency, constants['top'], buffers, buffers['Z_top'])
+    Z_bottom = branch_kernel(frequency, constants['bottom'], buffers, buffers['Z_bottom'])
+    work, T, u = buffers['work'], buffers['t'], buffers['u']
+
+    # T-network and acoustic port
+    #
+    np.multiply(frequency, constants['k_half'], out=T)
+    np.tan(T, out=T)
+    np.add(Z_top, Z_bottom, out=work)                      # S
+    np.multiply(Z_top, Z_bottom, out=Z_bottom)
+    np.multiply(Z_bottom, 2, out=Z_bottom)                 # 2 Z_top Z_bottom
+    np.multiply(work, T, out=Z_top)
+    np.multiply(Z_top, constants['jZ0'], out=Z_top)        # a S
+    np.add(Z_bottom, Z_top, out=Z_bottom)
+    np.multiply(work, 2, out=work)
+    np.multiply(T, constants['Z0_4'], out=u)
+    np.add(work.imag, u, out=work.imag)                    # 2 (2a + S)
+    np.divide(Z_bottom, work, out=Z_bottom)
+    np.divide(constants['Z0_half'], T, out=u)
+    np.add(Z_bottom.imag, u, out=Z_bottom.imag)            # Z_ac
+
+    # Transformer and capacitor network, Zc || (-Zc + Z_ac / N^2)
+    #
+    np.divide(constants['k_cap'], frequency, out=work)     # Zc
+    np.multiply(Z_bottom, constants['inv_N2'], out=Z_bottom)
+    np.subtract(Z_bottom, work, out=Z_bottom)
+    np.multiply(work, Z_bottom, out=out)
+    np.add(work, Z_bottom, out=Z_bottom)
+    np.divide(out, Z_bottom, out=out)
+    return out
+
+
+# Load impedance of a transmission line branch written into Z
+#
+def branch_kernel(frequency, branch, buffers, Z):
+    A, B, C, D = buffers['A'], buffers['B'], buffers['C'], buffers['D']
+    t, u, w = buffers['t'], buffers['u'], buffers['w']
+    A.fill(1)
+    B.fill(0)
+    C.fill(0)
+    D.fill(1)
+
+    for layer_idx in range(branch['k'].shape[-1] - 1, -1, -1):
+        layer = slice(layer_idx, layer_idx + 1)
+        Z0, Y0 = branch['Z0'][..., layer], branch['Y0'][..., layer]
+        np.multiply(frequency, branch['k'][..., layer], out=t)
+        np.tan(t, out=t)
+
+        np.multiply(B, t, out=u)
+        np.multiply(A, t, out=w)
+        np.multiply(w, Z0, out=w)
+        np.add(B, w, out=B)                                # B + A b
+        np.multiply(u, Y0, out=u)
+        np.subtract(A, u, out=A)                           # A - B c
+        np.multiply(C, t, out=u)
+        np.multiply(D, t, out=w)
+        np.multiply(w, Y0, out=w)
+        np.add(C, w, out=C)                                # C + D c
+        np.multiply(u, Z0, out=u)
+        np.subtract(D, u, out=D)                           # D - C b
+
+    # Zin = (A ZL + jB) / (D + jC ZL)
+    #
+    work = buffers['work']
+    np.multiply(A, branch['Z_load'], out=Z.real)
+    np.copyto(Z.imag, B)
+    np.copyto(work.real, D)
+    np.multiply(C, branch['Z_load'], out=work.imag)
+    np.divide(Z, work, out=Z)
+    return Z
+
+
+def read_only(array):
+    array = np.array(array)
+    array.setflags(write=False)
+    return array
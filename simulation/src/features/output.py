@@ -0,0 +1,144 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+
+
+QUANTITIES = ['impedance', 'magnitude', 'phase']
+
+# (complex, real) dtypes of the output precisions
+PRECISION = {'double': (np.complex128, np.float64),
+             'single': (np.complex64, np.float32)}
+
+
+class SpectrumOutput():
+    #
+    # Reduced, low-memory representation of impedance spectra (..., n_freqs)
+    #
+    # quantities: subset of QUANTITIES, 'impedance' (complex Z), 'magnitude'
+    #             (|Z| [Ohm]) and 'phase' ([deg])
+    # precision:  'single' (complex64 / float32) or 'double' (complex128 / float64)
+    # decimate:   keep every n-th frequency point
+    # n_points:   peak preserving downsampling to n_points per spectrum. The
+    #             band is cut into n_points / 2 buckets and the points of
+    #             minimum and maximum |Z| of every bucket are kept, so the
+    #             resonances and antiresonances survive at any reduction. The
+    #             kept frequencies differ per spectrum and are returned with
+    #             the shape of the quantities.
+    #
+    # Outputs are written into preallocated buffers (allocate, reduce(out=)),
+    # e.g. one row block of a sweep at a time.
+    #
+    def __init__(self, quantities=('magnitude', 'phase'), precision='single', decimate=None, n_points=None):
+        unknown = set(quantities) - set(QUANTITIES)
+        if not quantities or unknown:
+            raise ValueError(f'Invalid quantities {sorted(unknown)}, use a subset of {QUANTITIES}.')
+        if precision not in PRECISION:
+            raise ValueError(f"Unknown precision '{precision}', use one of {list(PRECISION)}.")
+        if decimate is not None and n_points is not None:
+            raise ValueError('Use either decimate or n_points.')
+        if n_points is not None and n_points < 2:
+            raise ValueError('n_points must be at least 2.')
+
+        self.quantities = list(quantities)
+        self.precision = precision
+        self.decimate = decimate
+        self.n_points = n_points
+
+
+    # Number of output points per spectrum of a n_freqs grid
+    #
+    def size(self, n_freqs=None):
+        if self.decimate is not None:
+            return len(range(0, n_freqs, self.decimate))
+        if self.n_points is not None and self.n_points < n_freqs:
+            return 2 * (self.n_points // 2)
+        return n_freqs
+
+
+    # Empty output buffers for spectra of shape (..., n_freqs)
+    #
+    def allocate(self, shape=(), n_freqs=None):
+        complex_type, real_type = PRECISION[self.precision]
+        shape = tuple(shape) + (self.size(n_freqs),)
+        buffers = {name: np.empty(shape, dtype=complex_type if name == 'impedance' else real_type)
+                   for name in self.quantities}
+        buffers['frequency'] = np.empty(shape if self.__peaks(n_freqs) else shape[-1:], dtype=float)
+        return buffers
+
+
+    # Reduce the spectra `impedance` (..., n_freqs) on `frequency` (n_freqs,)
+    #
+    # out: optional buffers of allocate(impedance.shape[:-1], n_freqs), filled in place
+    #
+    # returns: {'frequency', *quantities}
+    #
+    def reduce(self, frequency=None, impedance=None, out=None):
+        frequency = np.asarray(frequency)
+        impedance = np.asarray(impedance)
+        n_freqs = impedance.shape[-1]
+        if out is None:
+            out = self.allocate(impedance.shape[:-1], n_freqs)
+
+        magnitude = None
+        if self.decimate is not None:
+            impedance = impedance[..., ::self.decimate]
+            out['frequency'][...] = frequency[::self.decimate]
+        elif self.__peaks(n_freqs):
+            magnitude = np.abs(impedance)
+            idx = peak_indices(magnitude, self.n_points // 2)
+            impedance = np.take_along_axis(impedance, idx, axis=-1)
+            magnitude = np.take_along_axis(magnitude, idx, axis=-1)
+            out['frequency'][...] = frequency[idx]
+        else:
+            out['frequency'][...] = frequency
+
+        if 'impedance' in out:
+            out['impedance'][...] = impedance
+        if 'magnitude' in out:
+            if magnitude is None:
+                np.abs(impedance, out=out['magnitude'], casting='same_kind')
+            else:
+                out['magnitude'][...] = magnitude
+        if 'phase' in out:
+            np.arctan2(impedance.imag, impedance.real, out=out['phase'], casting='same_kind')
+            np.rad2deg(out['phase'], out=out['phase'])
+        return out
+
+
+    def __peaks(self, n_freqs):
+        return self.decimate is None and self.n_points is not None and self.n_points < n_freqs
+
+
+
+# Indices of the minimum and maximum of every bucket (in frequency order)
+#
+# magnitude: (..., n_freqs)
+# returns:   (..., 2 * n_buckets)
+#
+def peak_indices(magnitude=None, n_buckets=None):
+    n_freqs = magnitude.shape[-1]
+    width = -(-n_freqs // n_buckets)
+    padding = [(0, 0)] * (magnitude.ndim - 1) + [(0, n_buckets * width - n_freqs)]
+    buckets = np.pad(magnitude, padding, mode='edge').reshape(magnitude.shape[:-1] + (n_buckets, width))
+
+    offset = np.arange(n_buckets) * width
+    low = np.argmin(buckets, axis=-1) + offset
+    high = np.argmax(buckets, axis=-1) + offset
+    idx = np.stack((np.minimum(low, high), np.maximum(low, high)), axis=-1)
+    return np.minimum(idx.reshape(magnitude.shape[:-1] + (2 * n_buckets,)), n_freqs - 1)
@@ -25,6 +25,34 @@ def frequency_spectrum(F):
     return np.arange(F[0] * 10 ** 6, F[1] * 10 ** 6, 1 * 10 ** 3, dtype=int)
 
 
+# The 1 kHz grid of frequency_spectrum in blocks of at most chunk_size points
+# (the full grid is never materialized)
+#
+def frequency_spectrum_chunks(F, chunk_size=2 ** 16):
+    start, stop, step = F[0] * 10 ** 6, F[1] * 10 ** 6, 1 * 10 ** 3
+    n_points = max(int(np.ceil((stop - start) / step)), 0)
+    for offset in range(0, n_points, chunk_size):
+        yield (start + step * np.arange(offset, min(offset + chunk_size, n_points))).astype(int)
+
+
+# Logarithmically spaced grid over the band F = [f_low, f_high] in MHz
+#
+def log_frequency_spectrum(F, n_points=1000):
+    return np.geomspace(F[0] * 10 ** 6, F[1] * 10 ** 6, n_points)
+
+
+# Frequency points [Hz] of a simulation
+#
+# frequency: any user supplied frequency vector in Hz (e.g. log spaced or the
+#            frequency column of a VNA measurement), takes precedence
+# fband:     [f_low, f_high] in MHz, sampled on the default 1 kHz grid
+#
+def frequency_points(fband=None, frequency=None):
+    if frequency is not None:
+        return np.asarray(frequency, dtype=float)
+    return frequency_spectrum(fband)
+
+
 # PROPAGATION CONSTANT (gamma)
 #
 # gamma = alpha + 1j*beta
@@ -44,94 +72,231 @@ def parallel_circuit_impedance(Z1, Z2):
     return (Z1 * Z2) / (Z1 + Z2)
 
 
+# TRANSMISSION LINE INPUT IMPEDANCE (Zin)
+#
+# Zin = Z0 * (ZL + 1j * Z0 * tan(beta*l)) / (Z0 + 1j * ZL * tan(beta*l))
+#
+# All arguments broadcast, e.g. Z0/l with shape (n_designs, 1) against
+# beta with shape (n_designs, n_freqs).
+#
+def transmission_line_impedance(Z0, ZL, beta, l):
+    tan_bl = np.tan(beta * l)
+    return Z0 * (ZL + 1j * Z0 * tan_bl) / (Z0 + 1j * ZL * tan_bl)
 
 
-class acoustic_transmission_line():
-    def __init__(self, transducer=None, init=None, fband=None):
+# ACOUSTIC CHAIN (ABCD) MATRIX of a lossless layer
+#
+# [[A, B], [C, D]] = [[cos(beta*l), 1j*Z0*sin(beta*l)], [1j*sin(beta*l)/Z0, cos(beta*l)]]
+#
+# The input impedance Zin = (A*ZL + B) / (C*ZL + D) does not change when the
+# matrix is scaled, so every layer is normalized by cos(beta*l):
+#
+# [[1, 1j*Z0*tan(beta*l)], [1j*tan(beta*l)/Z0, 1]]
+#
+# which needs a single trig evaluation per layer. For lossless layers A and D
+# are real and B and C purely imaginary, hence only the real factors
+# (A, B/1j, C/1j, D) are carried through the cascade.
+#
+def chain_matrix(Z0, beta, l):
+    tan_bl = np.tan(beta * l)
+    return 1, Z0 * tan_bl, tan_bl / Z0, 1
 
-        self._transducer_stack = transducer.stack
-        self._transducer_stack_idx = transducer.midx_stack
-        self._Z0 = init
-        self._frequency_band = frequency_spectrum(fband)
 
-        self._speed_of_sound = transducer.material.loc[:, ['v']].T
-        self._transmission_line_length = transducer.geometry.loc[:, ['Thickness']].T
+# Cascade the chain matrices of a stack of layers
+#
+# Z0, v, l: (..., n_layers) ordered from the outer load towards the piezo
+# frequency: (n_freqs,)
+# returns: (A, B/1j, C/1j, D) each broadcastable to (..., n_freqs)
+#
+# The product runs from the piezo side outwards, M = M_n @ ... @ M_1, and
+# costs one tan and four real multiplications per layer and frequency.
+#
+def cascade_chain_matrix(Z0, v, l, frequency):
+    Z0 = np.asarray(Z0)
+    v = np.asarray(v)
+    l = np.asarray(l)
+    A, B, C, D = 1, 0, 0, 1
+    for layer_idx in range(Z0.shape[-1] - 1, -1, -1):
+        _, b, c, _ = chain_matrix(Z0=Z0[..., layer_idx:layer_idx + 1],
+                                  beta=calculate_beta(frequency, v[..., layer_idx:layer_idx + 1]),
+                                  l=l[..., layer_idx:layer_idx + 1])
+        A, B, C, D = A - B * c, A * b + B, C + D * c, D - C * b
+    return A, B, C, D
+
+
+# Input impedance of a cascaded chain terminated by ZL
+#
+def chain_input_impedance(chain, ZL):
+    A, B, C, D = chain
+    return (A * ZL + 1j * B) / (1j * C * ZL + D)
 
 
-######### Calculate Transmission Line
-        #
-        self._Z_Top_transmission_line = self.transform_Top2Bottom(char_impedance=self._Z0.loc[:, (slice(None), ['Top'], slice(None))],
-                                                                  length=self._transmission_line_length.loc[:, (slice(None), ['Top'], slice(None))],
-                                                                  frequency=self._frequency_band,
-                                                                  sos=self._speed_of_sound.loc[:, (slice(None), ['Top'], slice(None))])
+# Propagate a load through a stack of transmission lines
+#
+# Z0, v, l: (..., n_layers) ordered from the outer load towards the piezo.
+# Index 0 is the load itself (only its Z0 is used), indices 1.. are the layers.
+# frequency: (n_freqs,)
+# returns: (..., n_freqs)
+#
+def propagate_load_impedance(Z0, v, l, frequency):
+    Z0 = np.asarray(Z0)
+    chain = cascade_chain_matrix(Z0=Z0[..., 1:],
+                                 v=np.asarray(v)[..., 1:],
+                                 l=np.asarray(l)[..., 1:],
+                                 frequency=frequency)
+    return chain_input_impedance(chain, Z0[..., 0:1]) * np.ones(np.shape(frequency))
 
-        self._Z_Bottom_transmission_line = self.transform_Top2Bottom(char_impedance=self._Z0.loc[:, (slice(None), slice(None), ['Bottom'])].iloc[:, ::-1],
-                                                                  length=self._transmission_line_length.loc[:, (slice(None), slice(None), ['Bottom'])].iloc[:, ::-1],
-                                                                  frequency=self._frequency_band,
-                                                                  sos=self._speed_of_sound.loc[:, (slice(None), slice(None), ['Bottom'])].iloc[:, ::-1])
 
+# T-Network
+#
+# Z_Top = Z_Bottom = 1j * Z0 * tan(beta*t/2)
+# Z_Center = -1j * Z0 * 1/sin(beta*t)
+#
+def t_network_impedance(Z0, beta, t):
+    Z_side = 1j * Z0 * np.tan((beta * t) / 2)
+    Z_center = -1j * Z0 / np.sin(beta * t)
+    return Z_side, Z_center
 
-        self._Z_impedance_acoustic_transmission_line = pd.DataFrame(np.column_stack((self._Z_Top_transmission_line,
-                                                                                     self._Z_Bottom_transmission_line)),
-                                                                    columns=['Top', 'Bottom'])
 
+# ACOUSTIC PORT of the T-network between the top and bottom branches
+#
+# Z_ac = Z_center + (Z_side + Z_top) || (Z_side + Z_bottom)
+#
+# in the closed form of kernel.fused_mason_impedance. With a = Z_side and
+# Z_center = Z0^2 / (2a) - a / 2:
+#
+#   Z_ac = Z0^2 / (2a) + (a S + 2 Z_top Z_bottom) / (2 (2a + S)),  S = Z_top + Z_bottom
+#
+# Z_center is never formed, which avoids the cancellation of the two
+# diverging terms at the half-wave resonances of the piezo (theta = k pi).
+#
+def acoustic_port_impedance(Z0, Z_side, Z_top, Z_bottom):
+    S = Z_top + Z_bottom
+    return Z0 ** 2 / (2 * Z_side) + (Z_side * S + 2 * Z_top * Z_bottom) / (2 * (2 * Z_side + S))
 
 
-    # Convolve transmission through the individual acoustic layers
-    #
-    def transform_Top2Bottom(self, char_impedance=None, length=None, frequency=None, sos=None):
+def capacitive_impedance(frequency, C0):
+    return 1 / (1j * 2 * np.pi * frequency * C0)
 
-        # Retrieve number of necessary transformations
-        #
-        electrode_column_name = char_impedance.columns.get_level_values(0)[int(np.argwhere(char_impedance.columns.get_level_values(0).str.contains('electrode')))]
-        electrode_idx_position = int(np.argwhere(char_impedance.columns.get_loc(electrode_column_name, method=None)))
-        nbr_transformations = electrode_idx_position
 
-        # Initilize arrays for transformation
+# Acoustic branch -> electrical port
+#
+# Z_el = Zc || (-Zc + Z_ac / N^2)
+#
+def electric_port_impedance(Z_acoustic, frequency, C0, N):
+    Z_cap = capacitive_impedance(frequency, C0)
+    return parallel_circuit_impedance(Z_cap, (-1 * Z_cap) + Z_acoustic * ((1 / N) ** 2))
+
+
+# FULL MASON CHAIN
+#
+# Broadcasts the transmission lines, the T-network, the transformer and the
+# capacitor network over any leading (design) axes and the frequency axis.
+#
+# Z0_top, v_top, l_top:          (..., n_top) from top load towards the piezo
+# Z0_bottom, v_bottom, l_bottom: (..., n_bottom) from bottom load towards the piezo
+# Z0_piezo, v_piezo, t_piezo, C0, N: (...)
+# frequency: (n_freqs,)
+# returns: (..., n_freqs)
+#
+def mason_chain_impedance(frequency,
+                          Z0_top, v_top, l_top,
+                          Z0_bottom, v_bottom, l_bottom,
+                          Z0_piezo, v_piezo, t_piezo,
+                          C0, N):
+    Z_top = propagate_load_impedance(Z0_top, v_top, l_top, frequency)
+    Z_bottom = propagate_load_impedance(Z0_bottom, v_bottom, l_bottom, frequency)
+
+    Z0_piezo = np.asarray(Z0_piezo)[..., None]
+    Z_side, _ = t_network_impedance(Z0=Z0_piezo,
+                                    beta=calculate_beta(frequency, np.asarray(v_piezo)[..., None]),
+                                    t=np.asarray(t_piezo)[..., None])
+
+    Z_acoustic = acoustic_port_impedance(Z0=Z0_piezo, Z_side=Z_side, Z_top=Z_top, Z_bottom=Z_bottom)
+
+    return electric_port_impedance(Z_acoustic=Z_acoustic,
+                                   frequency=frequency,
+                                   C0=np.asarray(C0)[..., None],
+                                   N=np.asarray(N)[..., None])
+
+
+
+
+# CIRCUIT STAGES
+#
+# Every stage consumes the arrays of a CompiledStack (init) and keeps its
+# result as a numpy array (values). The pandas view (impedance) is only built
+# on request.
+#
+class acoustic_transmission_line():
+    def __init__(self, transducer=None, init=None, fband=None, frequency=None):
+
+        self._stack = init
+        self._frequency_band = frequency_points(fband, frequency)
+
+
+######### Calculate Transmission Line
         #
-        Z0 = char_impedance.to_numpy()
-        l = length.to_numpy()
-        v = sos.to_numpy()
-        Z_load = np.zeros((nbr_transformations, len(frequency))).astype(complex)
+        self._Z_Top_transmission_line = self.transform_Top2Bottom(char_impedance=self._stack.Z0_top,
+                                                                  length=self._stack.l_top,
+                                                                  frequency=self._frequency_band,
+                                                                  sos=self._stack.v_top)
+
+        self._Z_Bottom_transmission_line = self.transform_Top2Bottom(char_impedance=self._stack.Z0_bottom,
+                                                                     length=self._stack.l_bottom,
+                                                                     frequency=self._frequency_band,
+                                                                     sos=self._stack.v_bottom)
+
+        self._Z_impedance_acoustic_transmission_line = None
 
-        for load_idx in range(nbr_transformations):
-            transmission_line_idx = load_idx + 1
-            if np.all(Z_load == Z_load[0]):
-                Zin = Z0[:, 0]
-            else:
-                Zin = Z_load[load_idx - 1, :]
 
-            Z_load[load_idx, :] = self.transmission_line(Z0=Z0[:, transmission_line_idx],
-                                                         ZL=Zin,
-                                                         beta=calculate_beta(frequency, v[:, transmission_line_idx]),
-                                                         l=l[:, transmission_line_idx])
 
-        return Z_load[load_idx]
+    # Convolve transmission through the individual acoustic layers
+    # (arrays ordered from the outer load towards the piezo)
+    #
+    def transform_Top2Bottom(self, char_impedance=None, length=None, frequency=None, sos=None):
+        return propagate_load_impedance(Z0=char_impedance, v=sos, l=length, frequency=frequency)
 
 
     # CALCULATE TRANSMISSION LINE (Zin)
     #
     def transmission_line(self, Z0=None, ZL=None, beta=None, l=None):
-        Zin = Z0 * (ZL + 1j * Z0 * np.tan(beta * l)) / (Z0 + 1j * ZL * np.tan(beta * l))
-        return Zin
+        return transmission_line_impedance(Z0, ZL, beta, l)
+
 
+    @property
+    def values(self):
+        return np.column_stack((self._Z_Top_transmission_line,
+                                self._Z_Bottom_transmission_line))
+
+    @property
+    def top(self):
+        return self._Z_Top_transmission_line
+
+    @property
+    def bottom(self):
+        return self._Z_Bottom_transmission_line
 
     @property
     def impedance(self):
+        if self._Z_impedance_acoustic_transmission_line is None:
+            self._Z_impedance_acoustic_transmission_line = pd.DataFrame(self.values, columns=['Top', 'Bottom'])
         return self._Z_impedance_acoustic_transmission_line
 
 
 
 class mason_piezo():
-    def __init__(self, transducer=None, init=None, fband=None):
+    def __init__(self, transducer=None, init=None, fband=None, frequency=None):
 
-        self._v = float(transducer.material.loc['piezo', 'v'].values)
-        self._t = float(transducer.geometry.loc['piezo', 'Thickness'].values)
-        self._Z0 = float(init['piezo'].values)
-        self._frequency_band = frequency_spectrum(fband)
+        self._v = init.v_piezo
+        self._t = init.t_piezo
+        self._Z0 = init.Z0_piezo
+        self._frequency_band = frequency_points(fband, frequency)
 
-        self._impedance_mason_piezo = pd.DataFrame(self.Tattenuator(),
-                                                   columns=['Top', 'Center', 'Bottom'])
+        self._Z_side, self._Z_center = t_network_impedance(Z0=self._Z0,
+                                                           beta=calculate_beta(self._frequency_band, self._v),
+                                                           t=self._t)
+        self._impedance_mason_piezo = None
 
 
     # T-Network
@@ -140,62 +305,69 @@ class mason_piezo():
     # Z_Center = -1j * Z0 * 1/sin(beta*t)
     #
     def Tattenuator(self):
-        Z_Top = Z_Bottom = 1j * self._Z0 * np.tan((calculate_beta(self._frequency_band, self._v) * self._t) / 2)
-        Z_Center = -1j * self._Z0 / np.sin(calculate_beta(self._frequency_band, self._v) * self._t)
-        return np.column_stack((Z_Top, Z_Center, Z_Bottom))
+        return np.column_stack((self._Z_side, self._Z_center, self._Z_side))
+
 
+    @property
+    def side(self):
+        return self._Z_side
+
+    @property
+    def center(self):
+        return self._Z_center
+
+    @property
+    def values(self):
+        return self.Tattenuator()
 
     @property
     def impedance(self):
+        if self._impedance_mason_piezo is None:
+            self._impedance_mason_piezo = pd.DataFrame(self.Tattenuator(), columns=['Top', 'Center', 'Bottom'])
         return self._impedance_mason_piezo
 
 
 
 class mason_ac_transducer():
-    def __init__(self, acoustic_struct=None, piezo=None):
+    #
+    # acoustic_struct: [Top, Bottom] transmission line impedances
+    # piezo: [Top, Center, Bottom] T-network impedances
+    # init: CompiledStack (Z0 of the piezo)
+    #
+    # The port is evaluated in the closed form of acoustic_port_impedance
+    # from the side impedance and Z0, the center impedance is not used.
+    #
+    def __init__(self, acoustic_struct=None, piezo=None, init=None):
+        if init is None:
+            raise ValueError('mason_ac_transducer needs init (the CompiledStack) for the Z0 of the piezo.')
 
-        self._Z_acoustic_structure = acoustic_struct
-        self._Z_piezo = piezo
+        self._Z_acoustic_structure = np.asarray(acoustic_struct)
+        self._Z_piezo = np.asarray(piezo)
+        self._Z0 = float(init.Z0_piezo)
 
         # Fuse Mason Impedance with Transmission Line Impedance
         #
-        self._impedance_transducer_elements = self.serial_fuse_acoustic_circuit_impedance()
-
-
-        # Fuse parallel impedance in Mason
-        #
-        self._impedance_parallel = parallel_circuit_impedance(self._impedance_transducer_elements['Top'].to_numpy(),
-                                                              self._impedance_transducer_elements['Bottom'].to_numpy())
-
-
-        # Fuse serial impedance in Mason
-        #
-        self._impedance_transducer = self._impedance_transducer_elements['Center'] + self._impedance_parallel
-
-
-    def serial_fuse_acoustic_circuit_impedance(self):
-        Z_structures = pd.concat([self._Z_piezo,
-                              self._Z_acoustic_structure], axis=1)
-
-        Z_transducer = pd.DataFrame(np.zeros_like(self._Z_piezo), columns=self._Z_piezo.columns)
-        Z_transducer['Top'] = Z_structures[['Top']].sum(axis=1)
-        Z_transducer['Bottom'] = Z_structures[['Bottom']].sum(axis=1)
-        Z_transducer['Center'] = self._Z_piezo['Center']
-        return Z_transducer
+        self._impedance_transducer = acoustic_port_impedance(Z0=self._Z0,
+                                                             Z_side=self._Z_piezo[:, 0],
+                                                             Z_top=self._Z_acoustic_structure[:, 0],
+                                                             Z_bottom=self._Z_acoustic_structure[:, 1])
 
 
+    @property
+    def values(self):
+        return self._impedance_transducer
 
     @property
     def impedance(self):
-        return self._impedance_transducer
+        return pd.Series(self._impedance_transducer, name='Center')
 
 
 
 class mason_transformer():
     def __init__(self, acoustic_struct=None, init=None):
 
-        self._Z_acoustic_structure = acoustic_struct
-        self._N = complex(init['N'].values)
+        self._Z_acoustic_structure = np.asarray(acoustic_struct)
+        self._N = complex(init.N)
 
         self._transfromed_impedance_ac2el = self.transform()
 
@@ -206,34 +378,42 @@ class mason_transformer():
         return Z_transfromed_ac2el
 
     @property
-    def impedance(self):
+    def values(self):
         return self._transfromed_impedance_ac2el
 
+    @property
+    def impedance(self):
+        return pd.Series(self._transfromed_impedance_ac2el, name='Center')
+
 
 
 class mason_el_transducer():
-    def __init__(self, impedance=None, init=None, fband=None):
+    def __init__(self, impedance=None, init=None, fband=None, frequency=None):
 
-        self._Z_transformed = impedance
-        self._C0 = complex(init['C0'].values)
-        self._frequency_band = frequency_spectrum(fband)
+        self._Z_transformed = np.asarray(impedance)
+        self._C0 = complex(init.C0)
+        self._frequency_band = frequency_points(fband, frequency)
 
         # Fuse the transformed impedance with negative serial capacitor impedance
         #
-        self.serial_fuse_impedance = (-1 * self.capacitive_impedance()) + self._Z_transformed
+        Z_cap = self.capacitive_impedance()
+        self.serial_fuse_impedance = (-1 * Z_cap) + self._Z_transformed
 
         # Fuse the serial impedance with parallel capacitor impedance
         #
-        self.parallel_fuse_impedance = parallel_circuit_impedance(self.capacitive_impedance(), self.serial_fuse_impedance)
+        self.parallel_fuse_impedance = parallel_circuit_impedance(Z_cap, self.serial_fuse_impedance)
 
         # Resulting electrical impedances
         #
         self.el_impedance_transducer = self.parallel_fuse_impedance
 
     def capacitive_impedance(self):
-        Z_cap = (1 / (1j * 2 * np.pi * self._frequency_band * self._C0))
-        return Z_cap
+        return capacitive_impedance(self._frequency_band, self._C0)
 
     @property
-    def impedance(self):
+    def values(self):
         return self.el_impedance_transducer
+
+    @property
+    def impedance(self):
+        return pd.Series(self.el_impedance_transducer, name='Center')
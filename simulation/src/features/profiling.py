@@ -0,0 +1,157 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from contextlib import nullcontext
+from time import perf_counter
+import tracemalloc
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+# PROFILING HOOKS
+#
+# Pipeline stages are wrapped in `with stage(name, **sizes):`. Without
+# registered hooks this returns a shared no-op context, so instrumented code
+# stays silent and pays only one check per stage.
+#
+# A hook is any callable taking a record dict:
+#   stage:     stage name, e.g. 'mason_piezo'
+#   seconds:   perf_counter duration
+#   allocated: net bytes allocated in the stage if tracemalloc is tracing,
+#              otherwise None
+#   + the keyword sizes given to stage(), e.g. n_freqs
+#
+# with Profiler() as profiler:
+#     simulate_xMason(...)
+# profiler.summary()
+#
+_hooks = ()
+_hooks_lock = threading.Lock()
+_NULL = nullcontext()
+
+
+def add_hook(hook=None):
+    global _hooks
+    with _hooks_lock:
+        _hooks = _hooks + (hook,)
+
+
+def remove_hook(hook=None):
+    global _hooks
+    with _hooks_lock:
+        hooks = list(_hooks)
+        hooks.remove(hook)
+        _hooks = tuple(hooks)
+
+
+def stage(name=None, **sizes):
+    if not _hooks:
+        return _NULL
+    return _StageTimer(name, sizes, _hooks)
+
+
+class _StageTimer():
+    __slots__ = ('_name', '_sizes', '_hooks', '_start', '_memory')
+
+    def __init__(self, name, sizes, hooks):
+        self._name = name
+        self._sizes = sizes
+        self._hooks = hooks
+
+    def __enter__(self):
+        self._memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = perf_counter() - self._start
+        allocated = None
+        if self._memory is not None and tracemalloc.is_tracing():
+            allocated = tracemalloc.get_traced_memory()[0] - self._memory
+        record = dict(self._sizes, stage=self._name, seconds=seconds, allocated=allocated)
+        for hook in self._hooks:
+            hook(record)
+        return False
+
+
+
+class Profiler():
+    #
+    # Hook that aggregates the stage records of any number of calls
+    # (thread-safe). Use as a context manager or register with add_hook.
+    #
+    # summary(): one row per stage with calls, total/mean/min/max seconds,
+    #            mean allocated bytes and the totals of numeric sizes, e.g.
+    #            n_freqs, with their throughput per second
+    #
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+
+    def __call__(self, record=None):
+        with self._lock:
+            entry = self._stages.get(record['stage'])
+            if entry is None:
+                entry = self._stages[record['stage']] = {'calls': 0, 'total': 0.0, 'min': np.inf, 'max': 0.0,
+                                                         'allocated': 0, 'traced': 0, 'sizes': {}}
+            seconds = record['seconds']
+            entry['calls'] += 1
+            entry['total'] += seconds
+            entry['min'] = min(entry['min'], seconds)
+            entry['max'] = max(entry['max'], seconds)
+            if record['allocated'] is not None:
+                entry['allocated'] += record['allocated']
+                entry['traced'] += 1
+            for key, value in record.items():
+                if key not in ['stage', 'seconds', 'allocated'] and isinstance(value, (int, float, np.number)):
+                    entry['sizes'][key] = entry['sizes'].get(key, 0) + value
+
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, *exc):
+        remove_hook(self)
+        return False
+
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+
+    def summary(self):
+        with self._lock:
+            rows = []
+            for name, entry in self._stages.items():
+                row = {'stage': name,
+                       'calls': entry['calls'],
+                       'total_s': entry['total'],
+                       'mean_s': entry['total'] / entry['calls'],
+                       'min_s': entry['min'],
+                       'max_s': entry['max'],
+                       'mean_allocated': entry['allocated'] / entry['traced'] if entry['traced'] else np.nan}
+                for key, value in entry['sizes'].items():
+                    row[key] = value
+                    row[f'{key}_per_s'] = value / entry['total'] if entry['total'] > 0 else np.nan
+                rows.append(row)
+        return pd.DataFrame(rows).set_index('stage') if rows else pd.DataFrame()
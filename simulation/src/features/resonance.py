@@ -0,0 +1,238 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+
+import numpy as np
+import pandas as pd
+
+
+# Columns of the VNA experiments (see VNA_Dataloader)
+FREQUENCY = 0
+MAGNITUDE = 6
+PHASE = 7
+
+GOLDEN = (np.sqrt(5) - 1) / 2
+
+
+# RESONANCE TABLE of a batch of impedance spectra
+#
+# frequency: (n_freqs,) or (n_spectra, n_freqs) [Hz]
+# impedance: (n_spectra, n_freqs) complex
+# mask:      optional (n_spectra, n_freqs) boolean array of valid points
+# evaluate:  optional callable frequency (n_spectra, 1) -> impedance (n_spectra, 1),
+#            e.g. the batched CompiledStack.electric_impedance that produced the
+#            spectra. The extrema are then refined on the model itself,
+#            otherwise by parabolic interpolation on the grid.
+#
+# mode:      'strongest' or 'first' (lowest frequency) resonance/antiresonance
+#            pair whose rise in ln|Z| exceeds `prominence`
+#
+# Resonance fr is a minimum of |Z|*f, i.e. |Z| with the capacitive 1/f trend
+# removed, and antiresonance fa the following maximum.
+#
+# returns: DataFrame with fr, fa, Zr, Za [Ohm], keff (effective coupling
+#          factor), bandwidth (-3 dB of the admittance at fr) and Qm = fr / bandwidth
+#
+def resonance_table(frequency=None, impedance=None, mask=None, evaluate=None, names=None,
+                    mode='strongest', prominence=0.1):
+    impedance = np.atleast_2d(impedance)
+    frequency = np.broadcast_to(frequency, impedance.shape).astype(float)
+    valid = np.isfinite(impedance) & (np.abs(impedance) > 0) & (frequency > 0)
+    if mask is not None:
+        valid &= np.asarray(mask, dtype=bool)
+
+    magnitude = np.where(valid, np.abs(impedance), np.nan)
+    y = np.log(magnitude) + np.log(np.where(valid, frequency, np.nan))
+
+    # Coarse bracket on the grid
+    #
+    i_r, i_a = select_mode(y, mode=mode, prominence=prominence)
+
+    if evaluate is None:
+        fr, yr = parabolic_vertex(frequency, y, i_r)
+        fa, ya = parabolic_vertex(frequency, y, i_a)
+    else:
+        fr, yr = golden_section(evaluate, *bracket(frequency, i_r), sign=1)
+        fa, ya = golden_section(evaluate, *bracket(frequency, i_a), sign=-1)
+
+    found = (i_r >= 0) & (i_a >= 0)
+    fr = np.where(found, fr, np.nan)
+    fa = np.where(found, fa, np.nan)
+
+    Zr = np.exp(yr) / fr
+    bandwidth = half_power_bandwidth(frequency, magnitude, i_r, evaluate=evaluate, Zr=Zr)
+    table = pd.DataFrame({'fr': fr,
+                          'fa': fa,
+                          'Zr': Zr,
+                          'Za': np.exp(ya) / fa,
+                          'keff': np.sqrt(np.clip((fa ** 2 - fr ** 2) / fa ** 2, 0, None)),
+                          'bandwidth': np.where(found, bandwidth, np.nan),
+                          'Qm': fr / bandwidth}, index=names)
+    table.loc[~found, ['Zr', 'Za', 'keff', 'Qm']] = np.nan
+    return table
+
+
+# Resonance table of VNA_Dataloader.experiments (n_freqs, n_columns, n_samples)
+#
+def vna_resonance_table(experiments=None, mask=None, names=None, mode='strongest', prominence=0.1):
+    frequency = experiments[:, FREQUENCY, :].T
+    impedance = experiments[:, MAGNITUDE, :].T * np.exp(1j * np.deg2rad(experiments[:, PHASE, :].T))
+    if mask is not None:
+        mask = np.asarray(mask).T
+    return resonance_table(frequency=np.nan_to_num(frequency), impedance=impedance, mask=mask, names=names,
+                           mode=mode, prominence=prominence)
+
+
+# Pair every local minimum of y with the next local maximum and keep the pair
+# with the largest rise ('strongest') or the first pair rising by at least
+# `prominence` ('first'). Returns grid indices (-1 if no pair exists).
+#
+def select_mode(y, mode='strongest', prominence=0.1):
+    n_spectra, n_freqs = y.shape
+    index = np.arange(n_freqs)
+    inner = np.zeros_like(y, dtype=bool)
+    inner[:, 1:-1] = True
+
+    left = np.full_like(y, np.nan)
+    right = np.full_like(y, np.nan)
+    left[:, 1:] = y[:, :-1]
+    right[:, :-1] = y[:, 1:]
+    minimum = inner & (y <= left) & (y < right)
+    maximum = inner & (y >= left) & (y > right)
+
+    # index of the next local maximum after every point
+    #
+    candidates = np.where(maximum, index, n_freqs)
+    next_maximum = np.minimum.accumulate(candidates[:, ::-1], axis=1)[:, ::-1]
+    next_maximum = np.concatenate((next_maximum[:, 1:], np.full((n_spectra, 1), n_freqs)), axis=1)
+
+    paired = minimum & (next_maximum < n_freqs)
+    y_next = np.take_along_axis(np.concatenate((y, np.full((n_spectra, 1), np.nan)), axis=1),
+                                np.minimum(next_maximum, n_freqs), axis=1)
+    rise = np.where(paired & (y_next - y >= prominence), y_next - y, -np.inf)
+
+    if mode == 'strongest':
+        i_r = np.argmax(rise, axis=1)
+    elif mode == 'first':
+        i_r = np.argmax(np.isfinite(rise), axis=1)
+    else:
+        raise ValueError(f"Unknown mode '{mode}', use 'strongest' or 'first'.")
+    i_a = np.take_along_axis(next_maximum, i_r[:, None], axis=1)[:, 0]
+    found = np.isfinite(np.take_along_axis(rise, i_r[:, None], axis=1)[:, 0])
+    return np.where(found, i_r, -1), np.where(found, i_a, -1)
+
+
+# Neighbouring grid points [f(i-1), f(i+1)] of the extrema
+#
+def bracket(frequency, idx):
+    rows = np.arange(len(frequency))
+    idx = np.clip(idx, 1, frequency.shape[1] - 2)
+    return frequency[rows, idx - 1], frequency[rows, idx + 1]
+
+
+# Vertex of the parabola through the extremum and its neighbours
+# (non-uniform spacing), falls back to the grid point at the band edges
+#
+def parabolic_vertex(frequency, y, idx):
+    rows = np.arange(len(y))
+    i = np.clip(idx, 1, y.shape[1] - 2)
+    x0, x1, x2 = frequency[rows, i - 1], frequency[rows, i], frequency[rows, i + 1]
+    y0, y1, y2 = y[rows, i - 1], y[rows, i], y[rows, i + 1]
+
+    numerator = (x1 - x0) ** 2 * (y1 - y2) - (x1 - x2) ** 2 * (y1 - y0)
+    denominator = (x1 - x0) * (y1 - y2) - (x1 - x2) * (y1 - y0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(denominator != 0, 0.5 * numerator / denominator, 0)
+    x_vertex = np.clip(x1 - np.nan_to_num(shift), x0, x2)
+
+    # value of the parabola at the vertex (Lagrange form)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y_vertex = (y0 * (x_vertex - x1) * (x_vertex - x2) / ((x0 - x1) * (x0 - x2))
+                    + y1 * (x_vertex - x0) * (x_vertex - x2) / ((x1 - x0) * (x1 - x2))
+                    + y2 * (x_vertex - x0) * (x_vertex - x1) / ((x2 - x0) * (x2 - x1)))
+    return x_vertex, np.where(np.isfinite(y_vertex), y_vertex, y1)
+
+
+# Vectorized golden section search of sign * (ln|Z(f)| + ln f) within [low, high]
+#
+def golden_section(evaluate=None, low=None, high=None, sign=1, iterations=40):
+    def objective(f):
+        return sign * (np.log(np.abs(np.asarray(evaluate(f[:, None]))[:, 0])) + np.log(f))
+
+    a, b = low.copy(), high.copy()
+    c = b - GOLDEN * (b - a)
+    d = a + GOLDEN * (b - a)
+    fc, fd = objective(c), objective(d)
+    for _ in range(iterations):
+        left = fc < fd
+        b = np.where(left, d, b)
+        a = np.where(left, a, c)
+        d_new = np.where(left, c, a + GOLDEN * (b - a))
+        c_new = np.where(left, b - GOLDEN * (b - a), d)
+        evaluated = objective(np.where(left, c_new, d_new))
+        fd, fc = np.where(left, fc, evaluated), np.where(left, evaluated, fd)
+        c, d = c_new, d_new
+
+    f = (a + b) / 2
+    return f, sign * objective(f)
+
+
+# -3 dB bandwidth of the admittance around the resonance, i.e. the span in
+# which |Z| stays below sqrt(2) * |Z(fr)|. The crossings are interpolated
+# linearly on the grid or bisected on the model if `evaluate` is given.
+# NaN if a crossing lies outside the band.
+#
+def half_power_bandwidth(frequency, magnitude, idx, evaluate=None, Zr=None, iterations=40):
+    low, high = half_power_crossings(frequency, magnitude, idx, evaluate=evaluate, Zr=Zr, iterations=iterations)
+    return high - low
+
+
+# Lower and upper -3 dB crossings (see half_power_bandwidth)
+#
+def half_power_crossings(frequency, magnitude, idx, evaluate=None, Zr=None, iterations=40):
+    rows = np.arange(len(magnitude))
+    n_freqs = magnitude.shape[1]
+    index = np.arange(n_freqs)
+    i = np.clip(idx, 0, n_freqs - 1)
+    if Zr is None:
+        Zr = magnitude[rows, i]
+    threshold = np.sqrt(2) * Zr
+    above = magnitude > threshold[:, None]
+
+    i_left = np.max(np.where(above & (index < i[:, None]), index, -1), axis=1)
+    i_right = np.min(np.where(above & (index > i[:, None]), index, n_freqs), axis=1)
+    found = (i_left >= 0) & (i_right < n_freqs)
+    i_left = np.clip(i_left, 0, n_freqs - 2)
+    i_right = np.clip(i_right, 1, n_freqs - 1)
+
+    def crossing(outside, inside):
+        f_out, f_in = frequency[rows, outside], frequency[rows, inside]
+        if evaluate is not None:
+            for _ in range(iterations):
+                f_mid = (f_out + f_in) / 2
+                out = np.abs(np.asarray(evaluate(f_mid[:, None]))[:, 0]) > threshold
+                f_out, f_in = np.where(out, f_mid, f_out), np.where(out, f_in, f_mid)
+            return (f_out + f_in) / 2
+
+        m_out, m_in = magnitude[rows, outside], magnitude[rows, inside]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return f_out + (threshold - m_out) * (f_in - f_out) / (m_in - m_out)
+
+    low = np.where(found, crossing(i_left, i_left + 1), np.nan)
+    high = np.where(found, crossing(i_right, i_right - 1), np.nan)
+    return low, high
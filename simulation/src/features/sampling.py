@@ -0,0 +1,69 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+
+import numpy as np
+
+
+# ADAPTIVE FREQUENCY SAMPLING
+#
+# Start on a coarse grid and bisect only the intervals in which log|Z| or the
+# phase of Z change by more than `tolerance` between neighbouring points.
+# Resonances and antiresonances end up densely sampled while the smooth parts
+# of the band keep the coarse spacing.
+#
+# evaluate:   callable frequency [Hz] -> impedance (..., n_freqs),
+#             e.g. CompiledStack.electric_impedance
+# fband:      [f_low, f_high] in MHz
+# frequency:  optional initial grid [Hz], replaces the coarse linear grid
+# n_initial:  number of points of the coarse linear grid
+# tolerance:  maximum change of ln|Z| and of the phase [rad] per interval
+# resolution: smallest interval [Hz] that is still bisected
+# max_points: upper bound of evaluated frequency points
+#
+# returns: (frequency, impedance) sorted by frequency
+#
+def adaptive_frequency_sampling(evaluate=None, fband=None, frequency=None,
+                                n_initial=256, tolerance=0.05, resolution=1 * 10 ** 3, max_points=20000):
+    if frequency is None:
+        frequency = np.linspace(fband[0] * 10 ** 6, fband[1] * 10 ** 6, n_initial)
+    frequency = np.unique(np.asarray(frequency, dtype=float))
+    impedance = np.asarray(evaluate(frequency))
+
+    while len(frequency) < max_points:
+        refine = (interval_variation(impedance) > tolerance) & (np.diff(frequency) >= 2 * resolution)
+        if not refine.any():
+            break
+
+        new_frequency = ((frequency[:-1] + frequency[1:]) / 2)[refine][:max_points - len(frequency)]
+        new_impedance = np.asarray(evaluate(new_frequency))
+
+        order = np.argsort(np.concatenate((frequency, new_frequency)), kind='stable')
+        frequency = np.concatenate((frequency, new_frequency))[order]
+        impedance = np.concatenate((impedance, new_impedance), axis=-1)[..., order]
+
+    return frequency, impedance
+
+
+# Largest change of ln|Z| and phase between neighbouring frequency points,
+# reduced over any leading (design) axes
+#
+def interval_variation(impedance):
+    ratio = impedance[..., 1:] / impedance[..., :-1]
+    variation = np.maximum(np.abs(np.log(np.abs(ratio))), np.abs(np.angle(ratio)))
+    return variation.reshape(-1, variation.shape[-1]).max(axis=0)
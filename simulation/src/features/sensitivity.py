@@ -0,0 +1,116 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+
+import numpy as np
+
+
+# SENSITIVITIES OF THE MASON CHAIN
+#
+# Forward mode derivatives of the electrical impedance with respect to n_p
+# design variables x, evaluated in the same vectorized pass as the impedance.
+#
+# The variables act on the CompiledStack fields through logarithmic
+# sensitivities e = d ln(field) / dx, e.g. a relative change of the radius
+# scales every circular Z0 and C0 with e = 2 (area), a relative change of a
+# thickness scales l (or t_piezo) with e = 1 and C0, N with e = -1.
+#
+# stack:     CompiledStack
+# exponents: {field: (n_p,) + field.shape} for every CompiledStack field
+# frequency: (n_freqs,)
+#
+# returns: Z (..., n_freqs) and dZ/dx (n_p, ..., n_freqs)
+#
+def mason_chain_sensitivity(frequency=None, stack=None, exponents=None):
+    frequency = np.asarray(frequency, dtype=float)
+
+    Z_top, dZ_top = branch_sensitivity(frequency, stack.Z0_top, stack.v_top, stack.l_top,
+                                       exponents['Z0_top'], exponents['v_top'], exponents['l_top'])
+    Z_bottom, dZ_bottom = branch_sensitivity(frequency, stack.Z0_bottom, stack.v_bottom, stack.l_bottom,
+                                             exponents['Z0_bottom'], exponents['v_bottom'], exponents['l_bottom'])
+
+    # T-network and acoustic port in the closed form of
+    # ports.acoustic_port_impedance, written with u = 1 / Z_side
+    # = -j cot(theta/2) / Z0, which stays finite at the half-wave
+    # resonances (u -> 0 at theta = k pi):
+    #
+    #   Z_ac = Z0^2 u / 2 + (S + 2 P u) / (2 (2 + S u)),  S = Z_top + Z_bottom, P = Z_top Z_bottom
+    #
+    Z0 = stack.Z0_piezo[..., None]
+    e_Z0 = exponents['Z0_piezo'][..., None]
+    theta = 2 * np.pi * frequency * (stack.t_piezo / stack.v_piezo)[..., None]
+    d_theta = theta * (exponents['t_piezo'] - exponents['v_piezo'])[..., None]
+
+    cot_half = 1 / np.tan(theta / 2)
+    u = -1j * cot_half / Z0
+    du = 1j * (1 + cot_half ** 2) / (2 * Z0) * d_theta - u * e_Z0
+
+    S, dS = Z_top + Z_bottom, dZ_top + dZ_bottom
+    P, dP = Z_top * Z_bottom, dZ_top * Z_bottom + Z_top * dZ_bottom
+    numerator, d_numerator = S + 2 * P * u, dS + 2 * (dP * u + P * du)
+    denominator, d_denominator = 2 * (2 + S * u), 2 * (dS * u + S * du)
+    Z_acoustic = Z0 ** 2 * u / 2 + numerator / denominator
+    dZ_acoustic = (Z0 ** 2 * (2 * e_Z0 * u + du) / 2
+                   + (d_numerator * denominator - numerator * d_denominator) / denominator ** 2)
+
+    # Transformer and capacitor network: Zc || (-Zc + Z_ac / N^2)
+    #
+    Z_cap = 1 / (1j * 2 * np.pi * frequency * stack.C0[..., None])
+    dZ_cap = -Z_cap * exponents['C0'][..., None]
+    inverse_N2 = 1 / stack.N[..., None] ** 2
+    W = -Z_cap + Z_acoustic * inverse_N2
+    dW = -dZ_cap + (dZ_acoustic - 2 * Z_acoustic * exponents['N'][..., None]) * inverse_N2
+
+    Z = Z_cap * W / (Z_cap + W)
+    dZ = (W ** 2 * dZ_cap + Z_cap ** 2 * dW) / (Z_cap + W) ** 2
+    return Z, dZ
+
+
+# Load impedance of a transmission line branch and its derivatives
+# (normalized ABCD cascade as ports.cascade_chain_matrix, index 0 is the load)
+#
+def branch_sensitivity(frequency, Z0, v, l, e_Z0, e_v, e_l):
+    A, B, C, D = 1, 0, 0, 1
+    dA, dB, dC, dD = 0, 0, 0, 0
+    for layer_idx in range(Z0.shape[-1] - 1, 0, -1):
+        layer = slice(layer_idx, layer_idx + 1)
+        Z0_layer, e_Z0_layer = Z0[..., layer], e_Z0[..., layer]
+
+        theta = 2 * np.pi * frequency * (l[..., layer] / v[..., layer])
+        d_theta = theta * (e_l[..., layer] - e_v[..., layer])
+        tan_bl = np.tan(theta)
+        d_tan = (1 + tan_bl ** 2) * d_theta
+
+        b, db = Z0_layer * tan_bl, Z0_layer * (tan_bl * e_Z0_layer + d_tan)
+        c, dc = tan_bl / Z0_layer, (d_tan - tan_bl * e_Z0_layer) / Z0_layer
+
+        A, B, C, D, dA, dB, dC, dD = (A - B * c, A * b + B, C + D * c, D - C * b,
+                                      dA - dB * c - B * dc, dA * b + A * db + dB,
+                                      dC + dD * c + D * dc, dD - dC * b - C * db)
+
+    Z_load = Z0[..., 0:1]
+    dZ_load = Z_load * e_Z0[..., 0:1]
+    numerator = A * Z_load + 1j * B
+    denominator = 1j * C * Z_load + D
+    d_numerator = dA * Z_load + A * dZ_load + 1j * dB
+    d_denominator = 1j * (dC * Z_load + C * dZ_load) + dD
+
+    shape = np.shape(frequency)
+    Z = numerator / denominator * np.ones(shape)
+    dZ = (d_numerator * denominator - numerator * d_denominator) / denominator ** 2 * np.ones(shape)
+    return Z, dZ
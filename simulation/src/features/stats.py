@@ -20,7 +20,232 @@
 import numpy as np
 
 
-def meanSD_curves(data):
-    Zmn = np.mean(data[: ,6 , :], axis=1)
-    Zsd = np.std(data[: ,6 , :], axis=1)
-    return Zmn, Zsd
\ No newline at end of file
+# Mean and standard deviation of one column of VNA experiments
+# (n_freqs, n_columns, n_samples), computed in chunks of samples
+#
+def meanSD_curves(data, column=6):
+    statistics = column_statistics(data, columns=[column])[column]
+    return statistics.mean, statistics.std
+
+
+# Streaming statistics of several columns of VNA experiments
+#
+# chunks:  a (n_freqs, n_columns, n_samples) array or an iterable of such
+#          blocks, e.g. VNA_Dataloader.chunks(), so only one block has to be
+#          in memory at a time
+# columns: columns to accumulate (default all)
+#
+# returns: {column: StreamingStatistics} over the samples of every frequency row
+#
+def column_statistics(chunks=None, columns=None, chunk_size=64, n_bins=256):
+    if isinstance(chunks, np.ndarray):
+        data = chunks
+        chunks = (data[:, :, start:start + chunk_size] for start in range(0, data.shape[2], chunk_size))
+
+    statistics = None
+    for chunk in chunks:
+        if statistics is None:
+            columns = range(chunk.shape[1]) if columns is None else columns
+            statistics = {column: StreamingStatistics(n_bins=n_bins) for column in columns}
+        for column in columns:
+            statistics[column].update(chunk[:, column, :].T)
+    return statistics
+
+
+class StreamingStatistics():
+    #
+    # Per-point statistics of a stream of curves without keeping the curves.
+    #
+    # Accumulators of parallel workers over the same points can be combined
+    # with merge().
+    #
+    # update() takes chunks of shape (n_curves, n_points); NaN entries are
+    # skipped (e.g. padded VNA sweeps). Mean and variance are accumulated
+    # with the chunked Welford (Chan et al.) update.
+    #
+    # Quantiles come from a histogram of n_bins bins per point on the
+    # log-like scale y = asinh(x / scale): relative resolution for
+    # |x| >> scale (|Z|, heavy tails near resonance), linear around zero
+    # (phase). All histograms share one grid, bin i of level k covers
+    # [i, i + 1) * BASE_WIDTH * 2^k in y. Every point uses the finest level
+    # whose n_bins cover its [min, max], a coarser level merges pairs of
+    # bins exactly. The quantile error is at most one bin, i.e. a factor
+    # of exp(width) (see relative_error), and merge() yields the very
+    # histogram a single accumulator fed with all curves would hold.
+    # Memory is O(n_points * n_bins).
+    #
+    BASE_WIDTH = 2.0 ** -12
+
+    def __init__(self, n_bins=256, scale=1e-6):
+        if n_bins < 2:
+            raise ValueError('n_bins must be at least 2.')
+        self._n_bins = n_bins
+        self._scale = scale
+        self._count = None
+
+
+    def update(self, chunk=None):
+        chunk = np.atleast_2d(np.asarray(chunk, dtype=float))
+        valid = np.isfinite(chunk)
+        if self._count is None:
+            self.__initialize(chunk.shape[1])
+
+        count = valid.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, np.where(valid, chunk, 0).sum(axis=0) / count, 0)
+        self.__combine(count=count,
+                       mean=mean,
+                       M2=np.where(valid, (chunk - mean) ** 2, 0).sum(axis=0),
+                       minimum=np.where(valid, chunk, np.inf).min(axis=0),
+                       maximum=np.where(valid, chunk, -np.inf).max(axis=0))
+
+        # Histogram
+        #
+        self.__cover(self._level)
+        point = np.broadcast_to(np.arange(chunk.shape[1]), chunk.shape)[valid]
+        bins = self.__index(chunk[valid], self._level[point]) - self._offset[point]
+        bins = np.clip(bins, 0, self._n_bins - 1)
+        self._counts += np.bincount(point * self._n_bins + bins,
+                                    minlength=self._counts.size).reshape(self._counts.shape)
+        return self
+
+
+    # Add the curves accumulated by another StreamingStatistics (same points)
+    #
+    # Both histograms live on the same grid, the counts of `other` are
+    # merged into the (possibly coarser) bins of this one without loss.
+    #
+    def merge(self, other=None):
+        if other._count is None:
+            return self
+        if (other._n_bins, other._scale) != (self._n_bins, self._scale):
+            raise ValueError('Cannot merge statistics with different n_bins or scale.')
+        if self._count is None:
+            self.__initialize(len(other._count))
+        if len(other._count) != len(self._count):
+            raise ValueError('Cannot merge statistics of different numbers of points.')
+
+        self.__combine(count=other._count, mean=other._mean, M2=other._M2,
+                       minimum=other._min, maximum=other._max)
+        self.__cover(np.maximum(self._level, other._level))
+        self._counts += self.__rebin(other._counts, other._level, other._offset)
+        return self
+
+
+    # Approximate q-quantile (0 <= q <= 1) of every point
+    #
+    def quantile(self, q=None):
+        cumulative = np.cumsum(self._counts, axis=1)
+        target = q * self._count
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            bins = np.argmax(cumulative >= np.maximum(target, 1e-12)[:, None], axis=1)
+            rows = np.arange(len(bins))
+            below = cumulative[rows, bins] - self._counts[rows, bins]
+            fraction = np.clip((target - below) / self._counts[rows, bins], 0, 1)
+            value = self._scale * np.sinh((self._offset + bins + fraction) * self.__width(self._level))
+        return np.where(self._count > 0, np.clip(value, self._min, self._max), np.nan)
+
+
+    def __initialize(self, n_points):
+        self._count = np.zeros(n_points, dtype=np.int64)
+        self._mean = np.zeros(n_points)
+        self._M2 = np.zeros(n_points)
+        self._min = np.full(n_points, np.nan)
+        self._max = np.full(n_points, np.nan)
+        self._level = np.zeros(n_points, dtype=np.int64)
+        self._offset = np.zeros(n_points, dtype=np.int64)
+        self._counts = np.zeros((n_points, self._n_bins), dtype=np.int64)
+
+
+    # Chan et al. update of count, mean and sum of squared deviations with
+    # the moments of another set of curves
+    #
+    def __combine(self, count, mean, M2, minimum, maximum):
+        total = self._count + count
+        delta = mean - self._mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(total > 0, count / total, 0)
+        self._mean = self._mean + delta * weight
+        self._M2 = self._M2 + M2 + delta ** 2 * self._count * weight
+        self._count = total
+        self._min = np.fmin(self._min, minimum)
+        self._max = np.fmax(self._max, maximum)
+
+
+    # Move every histogram to the finest level >= `level` whose bins cover
+    # [min, max] and start its window at the bin of min
+    #
+    def __cover(self, level):
+        level = level.copy()
+        filled = self._count > 0
+        low, high = np.where(filled, self._min, 0), np.where(filled, self._max, 0)
+        while True:
+            grow = self.__index(high, level) - self.__index(low, level) >= self._n_bins
+            if not grow.any():
+                break
+            level[grow] += 1
+        offset = self.__index(low, level)
+
+        moved = (level != self._level) | (offset != self._offset)
+        if moved.any():
+            counts = self._counts
+            self._counts = np.zeros_like(counts)
+            self._counts[~moved] = counts[~moved]
+            self._counts[moved] = self.__rebin(counts[moved], self._level[moved], self._offset[moved],
+                                               level[moved], offset[moved])
+        self._level, self._offset = level, offset
+
+
+    # Counts of histograms (level, offset) in the bins of (new_level, new_offset),
+    # by default the current ones. Levels are nested, so this is exact.
+    #
+    def __rebin(self, counts, level, offset, new_level=None, new_offset=None):
+        new_level = self._level if new_level is None else new_level
+        new_offset = self._offset if new_offset is None else new_offset
+        index = offset[:, None] + np.arange(self._n_bins)
+        bins = (index // 2 ** (new_level - level)[:, None]) - new_offset[:, None]
+        bins = np.where(counts > 0, bins, 0)
+        rows = np.arange(len(counts))[:, None] * self._n_bins
+        return np.bincount((rows + bins).ravel(), weights=counts.ravel(),
+                           minlength=counts.size).reshape(counts.shape).astype(np.int64)
+
+
+    def __width(self, level):
+        return np.ldexp(self.BASE_WIDTH, level)
+
+
+    def __index(self, x, level):
+        return np.floor(np.arcsinh(x / self._scale) / self.__width(level)).astype(np.int64)
+
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        return np.where(self._count > 0, self._mean, np.nan)
+
+    @property
+    def variance(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self._count > 0, self._M2 / self._count, np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def min(self):
+        return self._min
+
+    @property
+    def max(self):
+        return self._max
+
+    # Bound of the quantile error as a factor minus one, exp(bin width) - 1
+    # (for |x| >> scale)
+    #
+    @property
+    def relative_error(self):
+        return np.expm1(self.__width(self._level))
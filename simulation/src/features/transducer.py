@@ -20,6 +20,8 @@
 import numpy as np
 import pandas as pd
 
+from simulation.src.data.loader import MaterialLibrary
+
 class Transducer():
     def __init__(self,
                  radius=None,
@@ -37,38 +39,47 @@ class Transducer():
         self._transducer_stack = self.__transducer_indexing(self._transducer_stack)
 
 
-######### Create pandas array with the geometry of transducer elements
+######### Geometry of transducer elements (stack order)
         #
-        geometry_cols = ['Radius', 'Width', 'Height', 'Thickness']
-        self._geometry = pd.DataFrame(np.zeros((len(self._stack_index[0]), len(geometry_cols))),
-                                      index=self._stack_index,
-                                      columns=geometry_cols)
+        # Stored as plain arrays, the pandas view is only built on request
+        #
+        n_layers = len(self._stack_index[0])
+        self._radius = np.full(n_layers, radius, dtype=float)
+        self._width = np.full(n_layers, np.nan)
+        self._height = np.full(n_layers, np.nan)
         if substrateWHratio:
-            self._geometry.loc[['Tload', 'Telectrode', 'piezo', 'Belectrode', 'Bload'], 'Radius'] = radius
-            self._geometry.loc[['Bsubstrate'], 'Width'] = substrateWHratio[0]
-            self._geometry.loc[['Bsubstrate'], 'Height'] = substrateWHratio[1]
-        else:
-            self._geometry.loc[['Tload', 'Telectrode', 'piezo', 'Belectrode', 'Bsubstrate', 'Bload'], 'Radius'] = radius
+            substrate_idx = self._stack_index[0].index('Bsubstrate')
+            self._radius[substrate_idx] = np.nan
+            self._width[substrate_idx] = substrateWHratio[0]
+            self._height[substrate_idx] = substrateWHratio[1]
 
+        self._thickness = np.array([np.nan,
+                                    thickness_el,
+                                    thickness_td,
+                                    thickness_el,
+                                    thickness_sub,
+                                    np.nan], dtype=float)
 
-        self._geometry.loc[:, 'Thickness'] = [np.nan,
-                                          thickness_el,
-                                          thickness_td,
-                                          thickness_el,
-                                          thickness_sub,
-                                          np.nan]
-        self._geometry.replace(0, np.nan, inplace=True)
+        for geometry in [self._radius, self._width, self._height, self._thickness]:
+            geometry[geometry == 0] = np.nan
+        self._geometry = None
 
 
-######### Create a pandas array with the materials of transducer elements
+######### Materials of transducer elements
+        #
+        # material: MaterialLibrary (or a raw materials table)
         #
-        self._material = material
-        self._Tload = self._material.loc[(self._material == kwargs.pop('Tload')).any(axis=1)]
-        self._Telectrode = self._material.loc[(self._material == kwargs.pop('Telectrode')).any(axis=1)]
-        self._piezo = self._material.loc[(self._material == kwargs.pop('piezo')).any(axis=1)]
-        self._Belectrode = self._material.loc[(self._material == kwargs.pop('Belectrode')).any(axis=1)]
-        self._Bsubstrate = self._material.loc[(self._material == kwargs.pop('Bsubstrate')).any(axis=1)]
-        self._Bload = self._material.loc[(self._material == kwargs.pop('Bload')).any(axis=1)]
+        if isinstance(material, MaterialLibrary):
+            self._library = material
+        else:
+            self._library = MaterialLibrary(frame=material)
+
+        self._Tload = kwargs.pop('Tload')
+        self._Telectrode = kwargs.pop('Telectrode')
+        self._piezo = kwargs.pop('piezo')
+        self._Belectrode = kwargs.pop('Belectrode')
+        self._Bsubstrate = kwargs.pop('Bsubstrate')
+        self._Bload = kwargs.pop('Bload')
 
         if kwargs.__len__() != 0:
             print(f'ERROR: Wrong keyword for transducer structure encountered.')
@@ -76,19 +87,34 @@ class Transducer():
             print('Stopping execution')
             exit()
 
+        self._material_names = [self._Tload,
+                                self._Telectrode,
+                                self._piezo,
+                                self._Belectrode,
+                                self._Bsubstrate,
+                                self._Tload]
 
-        self._transducer = pd.concat([self._Tload,
-                                      self._Telectrode,
-                                      self._piezo,
-                                      self._Belectrode,
-                                      self._Bsubstrate,
-                                      self._Tload]).reset_index(drop=True)
-        midx = pd.MultiIndex.from_arrays(self._stack_index)
-        self._transducer = self._transducer.set_index(midx)
+        self._roh = self._library.values(self._material_names, 'roh')
+        self._v = self._library.values(self._material_names, 'v')
+        self._eps33 = self._library.values(self._material_names, 'eps33')
+        self._h33 = self._library.values(self._material_names, 'h33')
+        self._transducer = None
 
-        self._transducer = self._transducer.drop(['Details', 'Source', 'Material'], level=0, axis=1)
 
 
+    def __geometry_frame(self):
+        geometry_cols = ['Radius', 'Width', 'Height', 'Thickness']
+        return pd.DataFrame(np.column_stack((self._radius, self._width, self._height, self._thickness)),
+                            index=self._stack_index,
+                            columns=geometry_cols)
+
+
+    def __material_frame(self):
+        transducer = pd.concat([self._library.row(name) for name in self._material_names]).reset_index(drop=True)
+        midx = pd.MultiIndex.from_arrays(self._stack_index)
+        transducer = transducer.set_index(midx)
+        return transducer.drop(['Details', 'Source', 'Material'], level=0, axis=1)
+
 
     def __stack_indexing(self, layers=None):
         stack = layers
@@ -120,12 +146,30 @@ class Transducer():
 
     @property
     def geometry(self):
+        if self._geometry is None:
+            self._geometry = self.__geometry_frame()
         return self._geometry
 
     @property
     def material(self):
+        if self._transducer is None:
+            self._transducer = self.__material_frame()
         return self._transducer
 
+    # Numeric layer properties in stack order (see midx_stack)
+    #
+    @property
+    def properties(self):
+        return {'layers': self._stack_index[0],
+                'roh': self._roh,
+                'v': self._v,
+                'eps33': self._eps33,
+                'h33': self._h33,
+                'radius': self._radius,
+                'width': self._width,
+                'height': self._height,
+                'thickness': self._thickness}
+
     @property
     def stack(self):
         return self._transducer_stack
@@ -134,4 +178,8 @@ class Transducer():
     def midx_stack(self):
         return self._stack_index
 
+    @property
+    def material_index(self):
+        return list(zip(*self._stack_index))
+
 
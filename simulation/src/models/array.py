@@ -0,0 +1,164 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+import pandas as pd
+
+from simulation.src.data.loader import Material
+from simulation.src.features.characteristics import compile_stack
+from simulation.src.features.kernel import kernel_constants, fused_mason_impedance, allocate_buffers
+from simulation.src.features.transducer import Transducer
+from simulation.src.features.ports import frequency_points
+from simulation.src.features.resonance import resonance_table
+from simulation.src.models.sweep import GEOMETRY, LAYERS, MATERIAL
+
+
+SUBSTRATE = ['substrate_width', 'substrate_height']
+
+
+class array_xMason():
+    #
+    # Multi-element array with per-element geometry in one batch.
+    #
+    # parameters, matpath: stack shared by all elements as for simulate_xMason
+    #                      (materials, band and the nominal geometry)
+    # elements:   {name: (n_elements,)} or DataFrame with per-element values
+    #             of GEOMETRY and optionally SUBSTRATE (width and height of a
+    #             rectangular substrate, e.g. elements on a shared foil).
+    #             Missing entries take the value of parameters.
+    # batch_size: elements per vectorized block (small blocks keep the
+    #             workspace of the fused kernel small, the work per element
+    #             is the same)
+    #
+    # The material rows are resolved once (a single Transducer) and only the
+    # element geometry is passed as arrays to characteristics.compile_stack,
+    # which applies the Mason conventions. All elements are compiled into one
+    # CompiledStack (n_elements,) and evaluated block by block on the shared
+    # frequency grid straight into the (n_elements, n_freqs) result (fused
+    # kernel, one workspace for all blocks).
+    #
+    def __init__(self, parameters=None, matpath=None, elements=None, batch_size=4):
+
+        self._frequency = frequency_points(parameters.get('fband'), parameters.get('frequency'))
+        self._materials = {layer: parameters[layer] for layer in LAYERS}
+        substrateWHratio = parameters.get('substrateWHratio')
+
+        # Element table
+        #
+        elements = pd.DataFrame(elements)
+        unknown = set(elements.columns) - set(GEOMETRY) - set(SUBSTRATE)
+        if unknown:
+            raise ValueError(f'Unknown element columns {sorted(unknown)}, use {GEOMETRY + SUBSTRATE}.')
+        for name in GEOMETRY:
+            if name not in elements:
+                elements[name] = float(parameters[name])
+        if substrateWHratio and not set(SUBSTRATE).intersection(elements.columns):
+            elements['substrate_width'], elements['substrate_height'] = substrateWHratio
+        if set(SUBSTRATE).intersection(elements.columns) and not set(SUBSTRATE).issubset(elements.columns):
+            raise ValueError(f'A rectangular substrate needs both {SUBSTRATE}.')
+        self._elements = elements.reset_index(drop=True)
+
+
+        ################################################################
+        # Shared material constants --------->
+        ################################################################
+        nominal = self._elements.iloc[0]
+        transducer = Transducer(radius=nominal['radius'],
+                                thickness_td=nominal['thickness_td'],
+                                thickness_el=nominal['thickness_el'],
+                                thickness_sub=nominal['thickness_sub'],
+                                material=Material(matpath).library,
+                                **self._materials)
+        properties = transducer.properties
+        self._constants = {name: dict(zip(properties['layers'], properties[name])) for name in MATERIAL}
+
+        self._compiled = self.compile(self._elements)
+
+
+        ################################################################
+        # Simulate IMPEDANCE of all elements --------->
+        ################################################################
+        # one workspace for all blocks of the same size
+        #
+        n_elements = len(self._elements)
+        frequency = np.asarray(self._frequency, dtype=float)
+        self._impedance = np.empty((n_elements, len(frequency)), dtype=complex)
+        buffers = {}
+        for start in range(0, n_elements, batch_size):
+            block = self._compiled[start:start + batch_size]
+            shape = (len(block), len(frequency))
+            if shape not in buffers:
+                buffers = {shape: allocate_buffers(shape)}
+            fused_mason_impedance(frequency, kernel_constants(block), out=self._impedance[start:start + batch_size],
+                                  buffers=buffers[shape])
+
+
+
+    # CompiledStack (n_elements,) of an element table (characteristics.compile_stack
+    # with per-element geometry arrays)
+    #
+    def compile(self, elements=None):
+        def column(name):
+            return elements[name].to_numpy(dtype=float)
+
+        n_elements = len(elements)
+        empty = np.full(n_elements, np.nan)
+        radius = {layer: column('radius') for layer in LAYERS}
+        width = {layer: empty for layer in LAYERS}
+        height = {layer: empty for layer in LAYERS}
+        if 'substrate_width' in elements:
+            radius['Bsubstrate'] = empty
+            width['Bsubstrate'] = column('substrate_width')
+            height['Bsubstrate'] = column('substrate_height')
+
+        thickness = {'Tload': empty,
+                     'Telectrode': column('thickness_el'),
+                     'piezo': column('thickness_td'),
+                     'Belectrode': column('thickness_el'),
+                     'Bsubstrate': column('thickness_sub'),
+                     'Bload': empty}
+        for values in [radius, width, height, thickness]:
+            for layer, value in values.items():
+                values[layer] = np.where(value == 0, np.nan, value)
+
+        return compile_stack(radius=radius, width=width, height=height, thickness=thickness, **self._constants)
+
+
+    # Resonance features of every element (see resonance_table)
+    #
+    def resonances(self, mode='strongest', prominence=0.1):
+        table = resonance_table(frequency=self._frequency, impedance=self._impedance,
+                                evaluate=self._compiled.electric_impedance, mode=mode, prominence=prominence)
+        return pd.concat((self._elements, table), axis=1)
+
+
+    @property
+    def impedance(self):
+        return self._impedance
+
+    @property
+    def elements(self):
+        return self._elements
+
+    @property
+    def compiled(self):
+        return self._compiled
+
+    @property
+    def frequency(self):
+        return self._frequency
@@ -0,0 +1,239 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from contextlib import contextmanager
+import hashlib
+import tempfile
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # Windows: no inter-process lock, writes stay atomic
+    fcntl = None
+
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'xmason')
+
+# Version of the simulated numerics, part of every cache key. Bump it whenever
+# a change of the model alters the spectra, so entries of older versions are
+# no longer served (they age out by eviction).
+#
+#   1: stage by stage Mason chain
+#   2: closed-form acoustic port at the half-wave resonances (fused kernel)
+#
+MODEL_VERSION = 2
+
+
+class SimulationCache():
+    #
+    # Content addressed on-disk store of simulated impedance spectra.
+    #
+    # An entry is keyed by a SHA-256 of MODEL_VERSION, the simulation
+    # parameters, the resolved material constants and the frequency grid, so
+    # editing materials.csv, any parameter or the model leads to a new entry. Entries are .npy
+    # files holding the frequency [Hz] and the complex impedance as a
+    # (2, n_freqs) complex array and are returned memory-mapped.
+    #
+    # path:     cache directory
+    # max_size: upper bound of all entries in bytes, the least recently used
+    #           entries are removed once it is exceeded
+    #
+    # Entries are written to a temporary file and renamed, so readers never see
+    # partial results. Writing and eviction are serialized between processes
+    # with a lock file (fcntl, POSIX only).
+    #
+    SUFFIX = '.npy'
+
+    def __init__(self, path=DEFAULT_PATH, max_size=2 ** 30):
+        self._path = os.path.abspath(path)
+        self._max_size = max_size
+        os.makedirs(self._path, exist_ok=True)
+
+
+    # Hash of everything that determines the simulated spectrum
+    #
+    def key(self, parameters=None, library=None, frequency=None):
+        materials = sorted(set(material_names(parameters)) & set(library.names))
+        constants = {name: {column: repr(complex(values[library.index(name)]))
+                            for column, values in sorted(library.properties.items())}
+                     for name in materials}
+
+        content = hashlib.sha256()
+        content.update(f'xMason model {MODEL_VERSION}'.encode())
+        content.update(json.dumps(canonical(parameters), sort_keys=True).encode())
+        content.update(json.dumps(constants, sort_keys=True).encode())
+        if frequency is not None:
+            content.update(np.ascontiguousarray(frequency, dtype=float).tobytes())
+        return content.hexdigest()
+
+
+    # (frequency, impedance) memory-mapped, or None if the entry does not exist
+    #
+    def load(self, key=None):
+        path = self.__entry(key)
+        try:
+            entry = np.load(path, mmap_mode='r')
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return entry[0].real, entry[1]
+
+
+    def store(self, key=None, frequency=None, impedance=None):
+        entry = np.empty((2, len(frequency)), dtype=complex)
+        entry[0] = frequency
+        entry[1] = impedance
+
+        path = self.__entry(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.__locked():
+            handle, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as tmp_file:
+                    np.save(tmp_file, entry)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            self.__evict()
+
+
+    def clear(self):
+        with self.__locked():
+            for path, _, _ in self.entries():
+                os.remove(path)
+
+
+    # [(path, size, last access)] of all entries
+    #
+    def entries(self):
+        entries = []
+        for directory, _, files in os.walk(self._path):
+            for name in files:
+                if name.endswith(self.SUFFIX):
+                    path = os.path.join(directory, name)
+                    try:
+                        status = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((path, status.st_size, status.st_mtime))
+        return entries
+
+
+    # Remove the least recently used entries until max_size is met
+    #
+    def __evict(self):
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        for path, entry_size, _ in entries:
+            if size <= self._max_size:
+                break
+            try:
+                os.remove(path)  # open memmaps of the entry stay valid
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+
+    def __entry(self, key):
+        return os.path.join(self._path, key[:2], key + self.SUFFIX)
+
+
+    @contextmanager
+    def __locked(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self._path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def size(self):
+        return sum(entry[1] for entry in self.entries())
+
+
+
+class CachedCircuit():
+    #
+    # Stand-in for Transducer_acoustic_circuit when the spectrum comes from
+    # a SimulationCache (same electric_impedance and frequency properties)
+    #
+    def __init__(self, frequency=None, impedance=None):
+        self._frequency = frequency
+        self._impedance = impedance
+
+    @property
+    def electric_impedance(self):
+        return pd.Series(self._impedance, name='Center', copy=False)
+
+    @property
+    def frequency(self):
+        return self._frequency
+
+    @property
+    def characteristics(self):
+        return None
+
+    @property
+    def compiled(self):
+        return None
+
+
+
+# JSON representation of a parameter dict (arrays are hashed, floats kept exact)
+#
+def canonical(value):
+    if isinstance(value, dict):
+        return {str(key): canonical(item) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        return ['ndarray', str(array.dtype), list(array.shape), hashlib.sha256(array.tobytes()).hexdigest()]
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if isinstance(value, (bool, np.bool_)) or value is None:
+        return value
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating, complex, np.complexfloating)):
+        return repr(complex(value))
+    return str(value)
+
+
+# All strings in the parameters, i.e. candidate material names
+#
+def material_names(value):
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [name for item in value for name in material_names(item)]
+    return []
@@ -0,0 +1,281 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from simulation.src.data.loader import Material
+from simulation.src.features.compiled import CompiledStack
+from simulation.src.features.resonance import FREQUENCY, MAGNITUDE, PHASE
+from simulation.src.models.simulate import simulate_xMason
+
+
+FIT_PARAMETERS = ['thickness_td', 'eps33', 'h33']
+
+
+class fit_xMason():
+    #
+    # Fit piezo thickness, eps33 and h33 of a nominal stack to measured
+    # impedance curves, all samples at once.
+    #
+    # parameters, matpath: nominal stack as for simulate_xMason (fband is not used)
+    # experiments:  (n_freqs, n_columns, n_samples) VNA array, see VNA_Dataloader
+    # mask:         optional (n_freqs, n_samples) boolean array of valid points
+    # fit:          subset of FIT_PARAMETERS to adjust
+    # bounds:       {name: (low, high)} factors relative to the nominal value,
+    #               default (0.2, 5)
+    # phase_weight: weight of the phase residual [rad] against the ln|Z| residual
+    #
+    # n_grid:       log spaced thickness candidates of the initial search
+    # n_factors:    log spaced eps33 / h33 candidates of the initial search
+    # n_refine:     thickness candidates within two grid steps of the coarse optimum
+    #
+    # The model is only evaluated at the measured frequencies. The resonances
+    # make the cost multimodal, in the piezo thickness so sharply that the
+    # Levenberg-Marquardt basin is only a few tenths of a percent wide. Every
+    # sample is therefore seeded by a joint log grid over thickness x eps33
+    # (eps33 sets the capacitive baseline of ln|Z|), refined by a finer
+    # thickness x h33 grid around the coarse optimum. Every sample then gets
+    # its own damped Gauss-Newton (Levenberg-Marquardt) iteration on the log of
+    # the fitted factors; the residuals and finite difference Jacobians of all
+    # samples are evaluated as one batched Mason chain per iteration.
+    #
+    # A sample is reported converged when its step or its gradient (relative
+    # to the residual and Jacobian norms) became small and no fitted factor
+    # sits on a bound.
+    #
+    def __init__(self, parameters=None, matpath=None, experiments=None, mask=None,
+                 fit=FIT_PARAMETERS, bounds=None, phase_weight=1.0,
+                 n_grid=321, n_factors=9, n_refine=41, max_iterations=50, tolerance=1e-8):
+
+        unknown = set(fit) - set(FIT_PARAMETERS)
+        if unknown:
+            raise ValueError(f'Cannot fit {sorted(unknown)}, valid parameters are {FIT_PARAMETERS}.')
+
+        self._fit = list(fit)
+        self._nominal = simulate_xMason(parameters=parameters, matpath=matpath, compute=False).compiled
+        library = Material(matpath).library
+        self._eps33 = library.value(parameters['piezo'], 'eps33')
+        self._h33 = library.value(parameters['piezo'], 'h33')
+        self._phase_weight = phase_weight
+
+        # Measured curves, one row per sample
+        #
+        self._frequency = np.nan_to_num(experiments[:, FREQUENCY, :].T)
+        self._magnitude = experiments[:, MAGNITUDE, :].T
+        self._phase = np.deg2rad(experiments[:, PHASE, :].T)
+        valid = np.isfinite(self._magnitude) & np.isfinite(self._phase) & (self._magnitude > 0)
+        if mask is not None:
+            valid &= np.asarray(mask, dtype=bool).T
+        self._valid = valid
+
+        bounds = bounds or {}
+        self._lower = np.log([bounds.get(name, (0.2, 5))[0] for name in self._fit])
+        self._upper = np.log([bounds.get(name, (0.2, 5))[1] for name in self._fit])
+
+        x = self.initial_guess(n_grid=n_grid, n_factors=n_factors, n_refine=n_refine)
+        self._x, self._cost, self._iterations, self._converged = self.solve(x=x,
+                                                                            max_iterations=max_iterations,
+                                                                            tolerance=tolerance)
+        self._stack = self.stack(self._x)
+
+
+
+    # Best factors of every sample on a coarse thickness x eps33 log grid,
+    # refined on a finer thickness x h33 grid around it (other factors nominal)
+    #
+    def initial_guess(self, n_grid=None, n_factors=9, n_refine=41, block=32):
+        n_samples = self._frequency.shape[0]
+        x = np.zeros((n_samples, len(self._fit)))
+
+        def candidates(name, n):
+            position = self._fit.index(name)
+            return position, np.linspace(self._lower[position], self._upper[position], n)
+
+        coarse = {}
+        if 'thickness_td' in self._fit and n_grid >= 2:
+            coarse['thickness_td'] = candidates('thickness_td', n_grid)
+        if 'eps33' in self._fit and n_factors >= 2:
+            coarse['eps33'] = candidates('eps33', n_factors)
+        x = self.__grid_search(x, list(coarse.values()), block)
+
+        fine = []
+        if 'thickness_td' in coarse and n_refine >= 2:
+            position, grid = coarse['thickness_td']
+            offsets = np.linspace(-2, 2, n_refine) * (grid[1] - grid[0])
+            fine.append((position, np.clip(x[:, position, None] + offsets, grid[0], grid[-1])))
+        if 'h33' in self._fit and n_factors >= 2:
+            fine.append(candidates('h33', n_factors))
+        return self.__grid_search(x, fine, block)
+
+
+    # Cheapest point of the product grid of `axes` around x. Every axis is
+    # (position, values) with values shared by all samples (n,) or per sample
+    # (n_samples, n).
+    #
+    def __grid_search(self, x, axes, block):
+        if not axes:
+            return x
+        n_samples = x.shape[0]
+        rows = np.ones(n_samples, dtype=bool)
+        values = [np.broadcast_to(values, (n_samples, values.shape[-1])) for _, values in axes]
+        grid = np.array(list(itertools.product(*[range(v.shape[1]) for v in values])))
+
+        cost = np.empty((n_samples, len(grid)))
+        for start in range(0, len(grid), block):
+            indices = grid[start:start + block]
+            probes = np.repeat(x[:, None, :], len(indices), axis=1)
+            for axis, (position, _) in enumerate(axes):
+                probes[..., position] = values[axis][:, indices[:, axis]]
+            cost[:, start:start + block] = np.sum(self.residuals(probes, rows) ** 2, axis=-1)
+
+        best = grid[np.argmin(cost, axis=1)]
+        x = x.copy()
+        for axis, (position, _) in enumerate(axes):
+            x[:, position] = values[axis][np.arange(n_samples), best[:, axis]]
+        return x
+
+
+    # Batched Levenberg-Marquardt
+    #
+    def solve(self, x=None, max_iterations=None, tolerance=None):
+        n_samples = self._frequency.shape[0]
+        n_parameters = len(self._fit)
+        step = 1e-6
+
+        x = x.copy()
+        damping = np.full(n_samples, 1e-3)
+        iterations = np.zeros(n_samples, dtype=int)
+        stopped = np.zeros(n_samples, dtype=bool)
+        converged = np.zeros(n_samples, dtype=bool)
+
+        for iteration in range(max_iterations):
+            active = ~stopped
+            if not active.any():
+                break
+
+            # residuals and forward differences of the active samples in one batch
+            #
+            probes = x[active, None, :] + np.concatenate((np.zeros((1, n_parameters)),
+                                                          step * np.eye(n_parameters)))[None, :, :]
+            r_probes = self.residuals(probes, active)
+            r = r_probes[:, 0, :]
+            J = np.swapaxes((r_probes[:, 1:, :] - r[:, None, :]) / step, 1, 2)
+            cost = np.sum(r ** 2, axis=-1)
+
+            JTJ = np.einsum('nmi,nmj->nij', J, J)
+            gradient = np.einsum('nmi,nm->ni', J, r)
+            regularized = JTJ + damping[active, None, None] * (JTJ * np.eye(n_parameters) + 1e-12 * np.eye(n_parameters))
+            delta = -np.linalg.solve(regularized, gradient[..., None])[..., 0]
+
+            x_active = x[active]
+            x_trial = np.clip(x_active + delta, self._lower, self._upper)
+            r_trial = self.residuals(x_trial[:, None, :], active)[:, 0, :]
+            cost_trial = np.sum(r_trial ** 2, axis=-1)
+
+            improved = cost_trial < cost
+            idx = np.flatnonzero(active)
+            x[idx[improved]] = x_trial[improved]
+            damping[idx] = np.where(improved, damping[idx] / 3, damping[idx] * 3)
+            iterations[idx] += 1
+
+            # stalled samples (no gain, or no improving step at any damping) stop
+            # without being converged
+            #
+            small_step = improved & (np.max(np.abs(x_trial - x_active), axis=-1) < tolerance)
+            # scale free gradient: cosine between the residual and every Jacobian column
+            #
+            scale = np.linalg.norm(J, axis=1) * np.sqrt(cost)[:, None]
+            small_gradient = np.max(np.abs(gradient) / np.maximum(scale, 1e-300), axis=-1) <= np.sqrt(tolerance)
+            small_gain = improved & (cost - cost_trial <= tolerance * np.maximum(cost, 1e-300))
+            converged[idx] = small_step | small_gradient
+            stopped[idx] = converged[idx] | small_gain | (damping[idx] > 1e10)
+
+        on_bound = np.any((x <= self._lower) | (x >= self._upper), axis=-1)
+        final = self.residuals(x[:, None, :], np.ones(n_samples, dtype=bool))[:, 0, :]
+        return x, np.sum(final ** 2, axis=-1), iterations, converged & ~on_bound
+
+
+    # Residuals [ln|Z| error, weighted phase error] of the samples selected by
+    # `rows` for log-factors x of shape (n_rows, n_probes, n_parameters)
+    #
+    def residuals(self, x, rows):
+        n_rows, n_probes, _ = x.shape
+        stack = self.stack(x.reshape(n_rows * n_probes, -1))
+        frequency = np.repeat(self._frequency[rows], n_probes, axis=0)
+        impedance = stack.electric_impedance(frequency).reshape(n_rows, n_probes, -1)
+
+        valid = self._valid[rows][:, None, :]
+        magnitude_error = np.log(np.abs(impedance)) - np.log(np.where(valid, self._magnitude[rows][:, None, :], 1))
+        phase_error = np.angle(impedance * np.exp(-1j * np.nan_to_num(self._phase[rows][:, None, :])))
+        residual = np.concatenate((magnitude_error, self._phase_weight * phase_error), axis=-1)
+        return np.where(np.concatenate((valid, valid), axis=-1), residual, 0)
+
+
+    # Nominal stack with the piezo parameters scaled by exp(x)
+    #
+    # C0 = eps33 * A / t and N = C0 * h33, so the scale factors act directly
+    # on the compiled C0 and N of the nominal stack.
+    #
+    def stack(self, x):
+        scale = {name: np.ones(x.shape[0]) for name in FIT_PARAMETERS}
+        scale.update({name: np.exp(x[:, position]) for position, name in enumerate(self._fit)})
+
+        C0_scale = scale['eps33'] / scale['thickness_td']
+        nominal = self._nominal
+        arrays = {name: np.broadcast_to(value, (x.shape[0],) + value.shape) for name, value in nominal.arrays.items()}
+        arrays.update({'t_piezo': nominal.t_piezo * scale['thickness_td'],
+                       'C0': nominal.C0 * C0_scale,
+                       'N': nominal.N * C0_scale * scale['h33']})
+        return CompiledStack(**arrays)
+
+
+    @property
+    def results(self):
+        scale = np.exp(self._x)
+        table = pd.DataFrame({'cost': self._cost,
+                              'iterations': self._iterations,
+                              'converged': self._converged})
+        for position, name in enumerate(self._fit):
+            table[f'{name}_factor'] = scale[:, position]
+        fitted = {name: np.ones(len(table)) for name in FIT_PARAMETERS}
+        fitted.update({name: scale[:, position] for position, name in enumerate(self._fit)})
+        table['thickness_td'] = self._stack.t_piezo
+        table['eps33'] = self._eps33 * fitted['eps33']
+        table['h33'] = self._h33 * fitted['h33']
+        table['C0'] = self._stack.C0
+        table['N'] = self._stack.N
+        return table
+
+    @property
+    def factors(self):
+        return np.exp(self._x)
+
+    @property
+    def stacks(self):
+        return self._stack
+
+    @property
+    def impedance(self):
+        return self._stack.electric_impedance(self._frequency)
+
+    @property
+    def frequency(self):
+        return self._frequency
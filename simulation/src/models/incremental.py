@@ -0,0 +1,159 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+
+from simulation.src.features.ports import frequency_points, parallel_circuit_impedance, capacitive_impedance
+from simulation.src.features.ports import t_network_impedance, acoustic_port_impedance, calculate_beta
+from simulation.src.features.kernel import kernel_branch, branch_kernel, allocate_buffers
+from simulation.src.models.simulate import simulate_xMason
+
+
+# Circuit stages: (name, CompiledStack fields, upstream stages)
+#
+STAGES = [('top', ['Z0_top', 'v_top', 'l_top'], []),
+          ('bottom', ['Z0_bottom', 'v_bottom', 'l_bottom'], []),
+          ('t_network', ['Z0_piezo', 'v_piezo', 't_piezo'], []),
+          ('capacitor', ['C0'], []),
+          ('acoustic', [], ['top', 'bottom', 't_network']),
+          ('electric', ['N'], ['acoustic', 'capacitor'])]
+
+
+class incremental_xMason():
+    #
+    # Stack on a fixed frequency grid that re-evaluates only what changed.
+    #
+    # parameters, matpath: as for simulate_xMason (fband / frequency set the grid)
+    #
+    # update(**changes) recompiles the stack (cheap) and compares the new
+    # CompiledStack field by field with the previous one. A stage of STAGES is
+    # recomputed only if one of its fields or one of its upstream stages
+    # changed, e.g. a new substrate thickness only touches the bottom branch,
+    # the acoustic port and the electric port, while the top branch, the
+    # T-network and C0 are reused. .recomputed lists the stages of the last
+    # update.
+    #
+    def __init__(self, parameters=None, matpath=None):
+        self._parameters = dict(parameters)
+        self._matpath = matpath
+        self._frequency = frequency_points(parameters.get('fband'), parameters.get('frequency'))
+        self._compiled = None
+        self._stages = {'top': self.__top,
+                        'bottom': self.__bottom,
+                        't_network': self.__t_network,
+                        'capacitor': self.__capacitor,
+                        'acoustic': self.__acoustic,
+                        'electric': self.__electric}
+        self._values = {}
+        self._recomputed = []
+        self.update()
+
+
+    def update(self, **changes):
+        self._parameters.update(changes)
+        compiled = simulate_xMason(parameters=self._parameters, matpath=self._matpath, compute=False).compiled
+
+        changed = set(compiled.__slots__)
+        if self._compiled is not None:
+            changed = {name for name in compiled.__slots__
+                       if not np.array_equal(getattr(compiled, name), getattr(self._compiled, name), equal_nan=True)}
+        self._compiled = compiled
+        self.__run(changed)
+        return self.impedance
+
+
+    # Evaluate all stages on a new frequency grid [Hz]
+    #
+    def set_frequency(self, frequency=None):
+        self._frequency = np.asarray(frequency, dtype=float)
+        self.__run(set(self._compiled.__slots__))
+        return self.impedance
+
+
+    def __run(self, changed):
+        dirty = set()
+        for name, fields, upstream in STAGES:
+            if changed.intersection(fields) or dirty.intersection(upstream):
+                self._values[name] = self._stages[name]()
+                dirty.add(name)
+        self._recomputed = [name for name, _, _ in STAGES if name in dirty]
+
+
+    ######### Stages
+
+    def __top(self):
+        c = self._compiled
+        return self.__branch(c.Z0_top, c.v_top, c.l_top)
+
+    def __bottom(self):
+        c = self._compiled
+        return self.__branch(c.Z0_bottom, c.v_bottom, c.l_bottom)
+
+    # Load impedance of a transmission line branch (kernel.branch_kernel)
+    #
+    def __branch(self, Z0, v, l):
+        frequency = np.asarray(self._frequency, dtype=float)
+        shape = np.broadcast_shapes(self._compiled.shape + (1,), frequency.shape)
+        return branch_kernel(frequency, kernel_branch(Z0, v, l), allocate_buffers(shape),
+                             np.empty(shape, dtype=complex))
+
+    def __t_network(self):
+        c = self._compiled
+        return t_network_impedance(Z0=c.Z0_piezo[..., None],
+                                   beta=calculate_beta(self._frequency, c.v_piezo[..., None]),
+                                   t=c.t_piezo[..., None])
+
+    def __capacitor(self):
+        return capacitive_impedance(self._frequency, self._compiled.C0[..., None])
+
+    # closed form of the port, see ports.acoustic_port_impedance
+    #
+    def __acoustic(self):
+        Z_side, _ = self._values['t_network']
+        return acoustic_port_impedance(Z0=self._compiled.Z0_piezo[..., None], Z_side=Z_side,
+                                       Z_top=self._values['top'], Z_bottom=self._values['bottom'])
+
+    def __electric(self):
+        Z_cap = self._values['capacitor']
+        N = self._compiled.N[..., None]
+        return parallel_circuit_impedance(Z_cap, (-1 * Z_cap) + self._values['acoustic'] * ((1 / N) ** 2))
+
+
+    @property
+    def impedance(self):
+        return self._values['electric']
+
+    @property
+    def frequency(self):
+        return self._frequency
+
+    @property
+    def compiled(self):
+        return self._compiled
+
+    @property
+    def parameters(self):
+        return dict(self._parameters)
+
+    @property
+    def recomputed(self):
+        return self._recomputed
+
+    @property
+    def values(self):
+        return dict(self._values)
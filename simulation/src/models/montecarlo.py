@@ -0,0 +1,154 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+import pandas as pd
+
+from simulation.src.features.characteristics import COMPILED_CONSTANTS
+from simulation.src.features.stats import StreamingStatistics
+from simulation.src.models.sweep import sweep_xMason, GEOMETRY, LAYERS, MATERIAL
+
+
+class montecarlo_xMason():
+    #
+    # Monte Carlo tolerance analysis of a single nominal stack.
+    #
+    # parameters, matpath: nominal design as for simulate_xMason
+    # tolerances: {name: distribution} with name one of GEOMETRY or
+    #             '<layer>.<constant>' (e.g. 'piezo.eps33', constants in MATERIAL
+    #             that the stack reads, see characteristics.COMPILED_CONSTANTS)
+    #             and distribution one of
+    #               0.05                 -> normal, relative standard deviation
+    #               ('normal', 0.05)
+    #               ('uniform', 0.05)    -> uniform within +-5 %
+    #               ('lognormal', 0.05)  -> exp(N(0, 0.05))
+    #               callable(rng, n)     -> n multiplicative factors
+    #             Complex constants are scaled as a whole (loss tangent kept).
+    # n_draws:    number of randomized stacks
+    # batch_size: stacks pushed through the Mason chain per batch
+    # quantiles:  reported quantile levels
+    # n_bins:     histogram bins per frequency of the quantiles (see StreamingStatistics)
+    #
+    # Every batch is evaluated as one broadcast CompiledStack and folded into
+    # streaming statistics of |Z| and of the phase [deg], so memory does not
+    # grow with n_draws. The drawn factors are kept in .draws.
+    #
+    def __init__(self, parameters=None, matpath=None, tolerances=None, n_draws=1000, batch_size=256,
+                 quantiles=(0.05, 0.5, 0.95), seed=None, n_bins=256):
+
+        self._sweep = sweep_xMason(parameters=parameters, matpath=matpath, mode='zip', compute=False)
+        self._nominal = self._sweep.designs.iloc[0]
+        self._quantiles = quantiles
+
+        rng = np.random.default_rng(seed)
+        self._draws = pd.DataFrame({name: draw(rng, distribution, n_draws)
+                                    for name, distribution in (tolerances or {}).items()})
+        for name in self._draws:
+            if name not in GEOMETRY and parse_constant(name) is None:
+                raise ValueError(f"Unknown tolerance '{name}', use one of {GEOMETRY} or '<layer>.<constant>' "
+                                 f"with a layer in {LAYERS} and a constant in {MATERIAL}.")
+        ignored = [name for name in self._draws if name not in GEOMETRY
+                   and parse_constant(name)[0] not in COMPILED_CONSTANTS[parse_constant(name)[1]]]
+        if ignored:
+            raise ValueError(f'Tolerances {ignored} have no effect, the compiled stack only reads the '
+                             f'constants {COMPILED_CONSTANTS} (both loads use Tload).')
+        self._draws = self._draws.reindex(range(n_draws))
+
+        # the phase [deg] crosses zero, its bins are linear within +-1 deg
+        #
+        self._magnitude = StreamingStatistics(n_bins=n_bins)
+        self._phase = StreamingStatistics(n_bins=n_bins, scale=1.0)
+        for start in range(0, n_draws, batch_size):
+            impedance = self.evaluate(self._draws.iloc[start:start + batch_size])
+            self._magnitude.update(np.abs(impedance))
+            self._phase.update(np.angle(impedance, deg=True))
+
+
+
+    # Impedance of a block of drawn factors, (n_block, n_freqs)
+    #
+    def evaluate(self, draws=None):
+        n_block = len(draws)
+        designs = pd.DataFrame({name: np.full(n_block, self._nominal[name]) for name in GEOMETRY})
+        scale = {}
+        for name in draws:
+            if name in GEOMETRY:
+                designs[name] = designs[name] * draws[name].to_numpy()
+            else:
+                layer, constant = parse_constant(name)
+                scale.setdefault(constant, {})[layer] = draws[name].to_numpy()
+        return self._sweep.compile(designs, scale=scale).electric_impedance(self._sweep.frequency)
+
+
+    # Per-frequency summary of |Z| or of the phase ('magnitude' or 'phase')
+    #
+    def statistics(self, quantity='magnitude'):
+        accumulator = {'magnitude': self._magnitude, 'phase': self._phase}[quantity]
+        table = pd.DataFrame({'frequency': self._sweep.frequency,
+                              'mean': accumulator.mean,
+                              'std': accumulator.std,
+                              'min': accumulator.min,
+                              'max': accumulator.max})
+        for q in self._quantiles:
+            table[f'q{q:g}'] = accumulator.quantile(q)
+        return table
+
+
+    @property
+    def magnitude(self):
+        return self._magnitude
+
+    @property
+    def phase(self):
+        return self._phase
+
+    @property
+    def draws(self):
+        return self._draws
+
+    @property
+    def frequency(self):
+        return self._sweep.frequency
+
+
+
+# n multiplicative factors of a tolerance distribution
+#
+def draw(rng, distribution, n):
+    if callable(distribution):
+        return np.asarray(distribution(rng, n), dtype=float)
+    if np.isscalar(distribution):
+        distribution = ('normal', distribution)
+
+    kind, width = distribution
+    if kind == 'normal':
+        return 1 + rng.normal(0, width, n)
+    if kind == 'uniform':
+        return 1 + rng.uniform(-width, width, n)
+    if kind == 'lognormal':
+        return np.exp(rng.normal(0, width, n))
+    raise ValueError(f"Unknown distribution '{kind}', use 'normal', 'uniform' or 'lognormal'.")
+
+
+# 'piezo.eps33' -> ('piezo', 'eps33'), None if not a material constant
+#
+def parse_constant(name):
+    layer, _, constant = name.partition('.')
+    if layer in LAYERS and constant in MATERIAL:
+        return layer, constant
+    return None
@@ -0,0 +1,255 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+import pandas as pd
+
+from simulation.src.features.compiled import CompiledStack
+from simulation.src.features.resonance import select_mode, bracket, golden_section, half_power_crossings
+from simulation.src.features.sensitivity import mason_chain_sensitivity
+from simulation.src.models.montecarlo import parse_constant
+from simulation.src.models.sweep import sweep_xMason, GEOMETRY, LAYERS, MATERIAL
+
+
+TARGETS = ['fr', 'bandwidth', 'Zr']
+
+
+class optimize_xMason():
+    #
+    # Tune a stack towards a target resonance frequency, bandwidth and |Z| at
+    # resonance with analytic derivatives of the Mason chain.
+    #
+    # parameters, matpath: start design as for simulate_xMason, fband /
+    #                      frequency define the band searched for the resonance
+    # targets:    {name: value} with names of TARGETS, any subset
+    #             ('fr' [Hz], 'bandwidth' [Hz, -3 dB of the admittance], 'Zr' [Ohm])
+    # variables:  names of GEOMETRY or '<layer>.<constant>' (constants in MATERIAL)
+    # bounds:     {name: (low, high)} factors relative to the start, default (0.5, 2)
+    # weights:    {target: weight} of the residuals, default 1
+    # mode, prominence: resonance selection, see resonance_table
+    #
+    # The compiled fields (Z0, v, l, C0, N) are monomials of the geometry and
+    # the material constants, so the logarithmic sensitivity of every field to
+    # every variable is a constant exponent (read off once from two compiled
+    # stacks). mason_chain_sensitivity propagates them through the Mason chain
+    # in one vectorized pass, which gives dZ/dx at any frequency. The targets
+    # follow by implicit differentiation: fr is a minimum of ln|Z| + ln f, the
+    # -3 dB crossings are level crossings of ln|Z| (their slopes in f are
+    # taken by central differences on the model).
+    #
+    # The residuals ln(value / target) are minimized by Levenberg-Marquardt on
+    # the log of the variable factors, clipped to the bounds. Every iteration
+    # evaluates a single design (grid, refinement of fr and the crossings,
+    # one sensitivity pass); .history lists them.
+    #
+    def __init__(self, parameters=None, matpath=None, targets=None, variables=None, bounds=None, weights=None,
+                 mode='strongest', prominence=0.1, max_iterations=50, tolerance=1e-8):
+
+        targets = dict(targets or {})
+        unknown = set(targets) - set(TARGETS)
+        if not targets or unknown:
+            raise ValueError(f'Invalid targets {sorted(unknown)}, use a subset of {TARGETS}.')
+        variables = list(variables or ['thickness_td', 'radius'])
+        for name in variables:
+            if name not in GEOMETRY and parse_constant(name) is None:
+                raise ValueError(f"Unknown variable '{name}', use one of {GEOMETRY} or '<layer>.<constant>' "
+                                 f"with a layer in {LAYERS} and a constant in {MATERIAL}.")
+
+        self._targets = targets
+        self._variables = variables
+        self._mode = mode
+        self._prominence = prominence
+        self._weights = np.array([(weights or {}).get(name, 1.0) for name in targets])
+        self._log_targets = np.log([targets[name] for name in targets])
+
+        bounds = bounds or {}
+        self._lower = np.log([bounds.get(name, (0.5, 2))[0] for name in variables])
+        self._upper = np.log([bounds.get(name, (0.5, 2))[1] for name in variables])
+
+        self._sweep = sweep_xMason(parameters=parameters, matpath=matpath, mode='zip', compute=False)
+        self._nominal = self._sweep.designs.iloc[[0]].reset_index(drop=True)
+        self._exponents = self.exponents()
+        self._evaluations = 0
+
+        self._x, self._history, self._converged = self.solve(max_iterations=max_iterations, tolerance=tolerance)
+
+
+
+    # d ln(field) / dx for every CompiledStack field, (n_variables,) + field.shape
+    #
+    def exponents(self):
+        n_variables = len(self._variables)
+        probes = self.stack(np.vstack((np.zeros(n_variables), np.log(2) * np.eye(n_variables))))
+        exponents = {}
+        for name in CompiledStack.__slots__:
+            field = np.abs(getattr(probes, name))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                exponents[name] = np.nan_to_num(np.log2(field[1:] / field[:1]))[:, None]
+        return exponents
+
+
+    # Levenberg-Marquardt on the log factors within the bounds
+    #
+    def solve(self, max_iterations=None, tolerance=None):
+        x = np.zeros(len(self._variables))
+        r, J, features = self.residuals(x)
+        damping = 1e-3
+        history = [dict(features, cost=r @ r, damping=damping, accepted=True)]
+        converged = False
+
+        for _ in range(max_iterations):
+            cost = r @ r
+            if cost <= tolerance:
+                converged = True
+                break
+
+            JTJ = J.T @ J
+            regularized = JTJ + damping * (np.diag(np.diag(JTJ)) + 1e-12 * np.eye(len(x)))
+            x_trial = np.clip(x - np.linalg.solve(regularized, J.T @ r), self._lower, self._upper)
+            if np.max(np.abs(x_trial - x)) < tolerance:
+                converged = True
+                break
+
+            try:
+                r_trial, J_trial, features_trial = self.residuals(x_trial)
+                cost_trial = r_trial @ r_trial
+            except ValueError:
+                features_trial, cost_trial = {}, np.inf
+
+            improved = cost_trial < cost
+            history.append(dict(features_trial, cost=cost_trial, damping=damping, accepted=improved))
+            if improved:
+                x, r, J = x_trial, r_trial, J_trial
+                damping /= 3
+                if cost - cost_trial <= tolerance * cost:
+                    converged = True
+                    break
+            else:
+                damping *= 3
+                if damping > 1e10:
+                    break
+
+        return x, pd.DataFrame(history), converged
+
+
+    # Weighted residuals ln(value / target), their Jacobian (n_targets, n_variables)
+    # and the resonance features of the design exp(x)
+    #
+    def residuals(self, x):
+        features, jacobian = self.features(x)
+        values = np.array([features[name] for name in self._targets])
+        if not np.all(np.isfinite(values)):
+            raise ValueError(f'Targets {list(self._targets)} are not defined for the design {np.exp(x)}.')
+        r = self._weights * (np.log(values) - self._log_targets)
+        J = self._weights[:, None] * np.array([jacobian[name] for name in self._targets])
+        return r, J, features
+
+
+    # Resonance features and their log derivatives {name: (n_variables,)}
+    #
+    def features(self, x):
+        self._evaluations += 1
+        stack = self.stack(x[None, :])
+        frequency = self._sweep.frequency[None, :]
+        magnitude = np.abs(stack.electric_impedance(frequency[0]))
+        y = np.log(magnitude) + np.log(frequency)
+
+        i_r, _ = select_mode(y, mode=self._mode, prominence=self._prominence)
+        if i_r[0] < 0:
+            raise ValueError(f'No resonance in the band for the design {np.exp(x)}.')
+        fr, yr = golden_section(stack.electric_impedance, *bracket(frequency, i_r), sign=1)
+        Zr = np.exp(yr) / fr
+        low, high = half_power_crossings(frequency, magnitude, i_r, evaluate=stack.electric_impedance, Zr=Zr)
+        fr, Zr, low, high = fr[0], Zr[0], low[0], high[0]
+
+        # ln|Z| and d ln|Z| / dx around fr and the crossings
+        #
+        bandwidth = high - low
+        h = 1e-3 * bandwidth if np.isfinite(bandwidth) else 1e-6 * fr
+        centers = np.nan_to_num(np.array([fr, low, high]), nan=fr)
+        points = (centers[:, None] + np.array([-h, 0, h])).ravel()
+        Z, dZ = mason_chain_sensitivity(points, stack, self._exponents)
+        y = np.log(np.abs(Z[0])).reshape(3, 3)
+        dy = np.real(dZ[:, 0] / Z[0]).reshape(-1, 3, 3)
+
+        Y = y[0] + np.log(points[:3])
+        d_fr = -((dy[:, 0, 2] - dy[:, 0, 0]) / (2 * h)) / ((Y[0] - 2 * Y[1] + Y[2]) / h ** 2)
+        d_ln_Zr = dy[:, 0, 1] - d_fr / fr
+        d_low, d_high = [-(dy[:, k, 1] - d_ln_Zr) / ((y[k, 2] - y[k, 0]) / (2 * h)) for k in (1, 2)]
+
+        features = {'fr': fr, 'bandwidth': bandwidth, 'Zr': Zr}
+        jacobian = {'fr': d_fr / fr, 'bandwidth': (d_high - d_low) / bandwidth, 'Zr': d_ln_Zr}
+        return features, jacobian
+
+
+    # Compiled stacks of the log factors x (n_designs, n_variables)
+    #
+    def stack(self, x):
+        factors = np.exp(np.atleast_2d(x))
+        designs = pd.DataFrame({name: np.repeat(self._nominal[name].to_numpy(), len(factors)) for name in GEOMETRY})
+        scale = {}
+        for position, name in enumerate(self._variables):
+            if name in GEOMETRY:
+                designs[name] = designs[name] * factors[:, position]
+            else:
+                layer, constant = parse_constant(name)
+                scale.setdefault(constant, {})[layer] = factors[:, position]
+        return self._sweep.compile(designs, scale=scale)
+
+
+    # Impedance and dZ/d ln(variable) of the optimized design
+    #
+    # returns: Z (n_freqs,), dZ (n_variables, n_freqs)
+    #
+    def sensitivity(self, frequency=None):
+        Z, dZ = mason_chain_sensitivity(frequency, self.stack(self._x), self._exponents)
+        return Z[0], dZ[:, 0]
+
+
+    @property
+    def results(self):
+        features = self._history[self._history['accepted']].iloc[-1]
+        return pd.DataFrame({'target': pd.Series(self._targets),
+                             'value': pd.Series({name: features[name] for name in self._targets})})
+
+    @property
+    def factors(self):
+        return pd.Series(np.exp(self._x), index=self._variables)
+
+    @property
+    def design(self):
+        factors = self.factors
+        design = {name: self._nominal[name].iloc[0] for name in GEOMETRY}
+        design.update({name: design[name] * factors[name] for name in self._variables if name in GEOMETRY})
+        return design
+
+    @property
+    def history(self):
+        return self._history
+
+    @property
+    def evaluations(self):
+        return self._evaluations
+
+    @property
+    def converged(self):
+        return self._converged
+
+    @property
+    def frequency(self):
+        return self._sweep.frequency
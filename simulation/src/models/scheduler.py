@@ -0,0 +1,191 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import multiprocessing
+import threading
+import tempfile
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from simulation.src.models.sweep import sweep_xMason
+
+
+class SweepScheduler():
+    #
+    # Run a sweep_xMason parameter grid on a process pool.
+    #
+    # The grid is split into chunks of `chunk_size` designs. Every worker writes
+    # its complex impedances straight into a memory-mapped (n_designs, n_freqs)
+    # output array, only the chunk bounds travel back to the parent.
+    #
+    # parameters, matpath, mode: see sweep_xMason
+    # n_workers:  number of processes (default: all cores)
+    # chunk_size: designs per task
+    # output:     path of the result file, the returned array stays memory-mapped
+    #             on it. Without a path a temporary file is used, it is removed
+    #             from the directory once the workers are done and freed with
+    #             the returned array.
+    # progress:   True for a progress bar or a callable(n_done, n_designs)
+    #
+    # cancel() may be called from another thread (e.g. a GUI), run() then stops
+    # after the chunks in flight and completed marks the finished designs.
+    #
+    def __init__(self, parameters=None, matpath=None, mode='grid',
+                 n_workers=None, chunk_size=64, output=None, progress=None):
+
+        self._sweep = sweep_xMason(parameters=parameters, matpath=matpath, mode=mode, compute=False)
+        self._n_workers = n_workers or os.cpu_count()
+        self._chunk_size = chunk_size
+        self._output_path = output
+        self._progress = progress
+
+        self._cancel = threading.Event()
+        self._completed = np.zeros(len(self._sweep.designs), dtype=bool)
+        self._impedance = None
+
+
+    def run(self):
+        n_designs = len(self._sweep.designs)
+        shape = (n_designs, len(self._sweep.frequency))
+        chunks = [(start, min(start + self._chunk_size, n_designs)) for start in range(0, n_designs, self._chunk_size)]
+
+        if self._output_path is None:
+            handle, path = tempfile.mkstemp(suffix='.xmason')
+            os.close(handle)
+        else:
+            path = self._output_path
+        output = np.memmap(path, dtype=complex, mode='w+', shape=shape)
+
+        self._cancel.clear()
+        self._completed[:] = False
+        report = self.__reporter(n_designs)
+        try:
+            if self._n_workers == 1:
+                for start, stop in chunks:
+                    output[start:stop] = self._sweep.evaluate_block(start, stop)
+                    self.__finished(start, stop, report)
+                    if self._cancel.is_set():
+                        break
+            else:
+                self.__run_pool(chunks, path, shape, report)
+            output.flush()
+        finally:
+            report(None)
+            self._impedance = output
+            if self._output_path is None:
+                # the mapping keeps the data, only the name goes (kept where the OS refuses, e.g. Windows)
+                #
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        return self._impedance
+
+
+    def cancel(self):
+        self._cancel.set()
+
+
+    def __run_pool(self, chunks, path, shape, report):
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+
+        pool = context.Pool(self._n_workers, initializer=_init_worker, initargs=(self._sweep, path, shape))
+        try:
+            for start, stop in pool.imap_unordered(_run_chunk, chunks):
+                self.__finished(start, stop, report)
+                if self._cancel.is_set():
+                    pool.terminate()
+                    break
+            else:
+                pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+    def __finished(self, start, stop, report):
+        self._completed[start:stop] = True
+        report(stop - start)
+
+
+    # progress reporting, report(None) closes the reporter
+    #
+    def __reporter(self, n_designs):
+        if self._progress is True:
+            bar = tqdm(total=n_designs, unit='designs')
+
+            def report(n_done):
+                if n_done is None:
+                    bar.close()
+                else:
+                    bar.update(n_done)
+            return report
+
+        if callable(self._progress):
+            def report(n_done):
+                if n_done is not None:
+                    self._progress(int(self._completed.sum()), n_designs)
+            return report
+
+        return lambda n_done: None
+
+
+    @property
+    def impedance(self):
+        return self._impedance
+
+    @property
+    def completed(self):
+        return self._completed
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def designs(self):
+        return self._sweep.designs
+
+    @property
+    def frequency(self):
+        return self._sweep.frequency
+
+
+
+# Worker state, set once per process by the pool initializer
+#
+_worker = {}
+
+
+def _init_worker(sweep, path, shape):
+    _worker['sweep'] = sweep
+    _worker['output'] = np.memmap(path, dtype=complex, mode='r+', shape=shape)
+
+
+def _run_chunk(chunk):
+    start, stop = chunk
+    _worker['output'][start:stop] = _worker['sweep'].evaluate_block(start, stop)
+    return start, stop
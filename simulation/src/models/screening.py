@@ -0,0 +1,192 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+import pandas as pd
+
+from simulation.src.data.loader import MaterialLibrary
+from simulation.src.features.characteristics import compile_stack
+from simulation.src.features.ports import frequency_points
+from simulation.src.features.resonance import resonance_table
+from simulation.src.models.sweep import GEOMETRY, MATERIAL
+
+
+# Screened material roles and the stack layers they fill
+ROLES = {'piezo': ['piezo'],
+         'electrode': ['Telectrode', 'Belectrode'],
+         'substrate': ['Bsubstrate'],
+         'load': ['Tload', 'Bload']}
+
+
+class screen_xMason():
+    #
+    # Combinatorial material screening.
+    #
+    # parameters: geometry and band as for simulate_xMason, every entry of
+    #             GEOMETRY may be a 1-D array of options (full product)
+    # matpath:    materials.csv
+    # materials:  optional {role: [names]} for the ROLES, by default every
+    #             material of the library that fits the role (piezo: finite
+    #             eps33 and h33, electrode / substrate: positive density and
+    #             speed of sound, load: any)
+    # rank_by:    result columns ranked in descending order (see resonance_table,
+    #             fractional_bandwidth = bandwidth / fr), stacks without a
+    #             resonance or bandwidth in the band are ranked last
+    # top_k:      number of full spectra kept
+    # batch_size: stacks per vectorized block
+    #
+    # The density, speed of sound, eps33 and h33 of every candidate are
+    # gathered into arrays once. The cartesian product of the roles and the
+    # geometry options is then compiled and evaluated block by block as
+    # broadcast CompiledStacks; only the resonance features of every stack
+    # and the top_k spectra stay in memory. Both electrodes take the
+    # electrode material and both loads the load material (conventions of
+    # characteristics.compile_stack).
+    #
+    def __init__(self, parameters=None, matpath=None, materials=None, rank_by=('keff', 'fractional_bandwidth'),
+                 top_k=10, batch_size=256, mode='strongest', prominence=0.1):
+
+        library = MaterialLibrary.load(matpath)
+        self._frequency = frequency_points(parameters.get('fband'), parameters.get('frequency'))
+        self._substrateWHratio = parameters.get('substrateWHratio')
+        self._rank_by = list(rank_by)
+        self._top_k = top_k
+
+        # Candidates and their constants
+        #
+        self._materials = {role: list(names) for role, names in (materials or self.candidates(library)).items()}
+        unknown = set(self._materials) - set(ROLES)
+        if unknown or set(ROLES) - set(self._materials):
+            raise ValueError(f'materials needs exactly the roles {list(ROLES)}.')
+        constants = {role: {name: library.values(names, name) for name in MATERIAL}
+                     for role, names in self._materials.items()}
+
+        geometry = np.meshgrid(*[np.atleast_1d(np.asarray(parameters[key], dtype=float)) for key in GEOMETRY],
+                               indexing='ij')
+        self._geometry = {key: value.ravel() for key, value in zip(GEOMETRY, geometry)}
+
+        shape = tuple(len(self._materials[role]) for role in ROLES) + (len(self._geometry['radius']),)
+        n_stacks = int(np.prod(shape))
+
+        tables = []
+        top, spectra = None, {}
+        for start in range(0, n_stacks, batch_size):
+            idx = np.unravel_index(np.arange(start, min(start + batch_size, n_stacks)), shape)
+            choice = dict(zip(ROLES, idx[:-1]))
+            stack = self.compile({role: {name: value[choice[role]] for name, value in constants[role].items()}
+                                  for role in ROLES},
+                                 {key: value[idx[-1]] for key, value in self._geometry.items()})
+            impedance = stack.electric_impedance(self._frequency)
+
+            table = resonance_table(frequency=self._frequency, impedance=impedance,
+                                    evaluate=stack.electric_impedance, mode=mode, prominence=prominence)
+            table.index = np.arange(start, start + len(table))
+            table['fractional_bandwidth'] = table['bandwidth'] / table['fr']
+            for role in ROLES:
+                table[role] = np.asarray(self._materials[role], dtype=object)[choice[role]]
+            for key, value in self._geometry.items():
+                table[key] = value[idx[-1]]
+            tables.append(table)
+
+            # keep the spectra of the current top_k only
+            #
+            top = self.rank(table if top is None else pd.concat((top, table))).iloc[:top_k]
+            spectra.update({i: impedance[i - start] for i in top.index if start <= i})
+            spectra = {i: spectra[i] for i in top.index}
+
+        columns = list(ROLES) + GEOMETRY + ['fr', 'fa', 'Zr', 'Za', 'keff', 'bandwidth', 'fractional_bandwidth', 'Qm']
+        self._table = self.rank(pd.concat(tables))[columns]
+        self._spectra = np.array([spectra[i] for i in self._table.index[:top_k]])
+        self._table = self._table.rename_axis('stack')
+
+
+
+    # Every library material that fits the roles
+    #
+    @staticmethod
+    def candidates(library=None):
+        names = np.asarray(library.names, dtype=object)
+        roh = library.properties['roh']
+        v = library.properties['v']
+        with np.errstate(invalid='ignore'):
+            piezo = np.isfinite(library.properties['eps33']) & np.isfinite(library.properties['h33'])
+            layer = (roh > 0) & (v > 0)
+        return {'piezo': names[piezo].tolist(),
+                'electrode': names[layer].tolist(),
+                'substrate': names[layer].tolist(),
+                'load': names[np.isfinite(roh) & np.isfinite(v)].tolist()}
+
+
+    # CompiledStack of one block
+    #
+    # constants: {role: {constant: (n_block,)}}, geometry: {GEOMETRY name: (n_block,)}
+    #
+    def compile(self, constants=None, geometry=None):
+        n_block = len(geometry['radius'])
+        materials = {name: {layer: constants[role][name] for role, layers in ROLES.items() for layer in layers}
+                     for name in MATERIAL}
+
+        radius = {layer: geometry['radius'] for layers in ROLES.values() for layer in layers}
+        width = {layer: np.full(n_block, np.nan) for layer in radius}
+        height = {layer: np.full(n_block, np.nan) for layer in radius}
+        if self._substrateWHratio:
+            radius['Bsubstrate'] = np.full(n_block, np.nan)
+            width['Bsubstrate'] = np.full(n_block, float(self._substrateWHratio[0]))
+            height['Bsubstrate'] = np.full(n_block, float(self._substrateWHratio[1]))
+
+        thickness = {'Tload': np.full(n_block, np.nan),
+                     'Telectrode': geometry['thickness_el'],
+                     'piezo': geometry['thickness_td'],
+                     'Belectrode': geometry['thickness_el'],
+                     'Bsubstrate': geometry['thickness_sub'],
+                     'Bload': np.full(n_block, np.nan)}
+        for values in [radius, width, height, thickness]:
+            for layer, value in values.items():
+                values[layer] = np.where(value == 0, np.nan, value)
+
+        return compile_stack(radius=radius, width=width, height=height, thickness=thickness, **materials)
+
+
+    # Descending by rank_by, stacks missing one of the features last
+    #
+    def rank(self, table=None):
+        complete = table[self._rank_by].notna().all(axis=1).rename('_complete')
+        order = pd.concat((complete, table[self._rank_by]), axis=1).sort_values(['_complete'] + self._rank_by,
+                                                                                ascending=False, kind='stable')
+        return table.loc[order.index]
+
+
+    # Ranked features of every screened stack
+    #
+    @property
+    def table(self):
+        return self._table
+
+    # Impedance of the top_k stacks (top_k, n_freqs), rows as in .table
+    #
+    @property
+    def spectra(self):
+        return self._spectra
+
+    @property
+    def materials(self):
+        return self._materials
+
+    @property
+    def frequency(self):
+        return self._frequency
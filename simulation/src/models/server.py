@@ -0,0 +1,345 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+#
+# Local simulation service
+#
+#   python -m simulation.src.models.server --matpath data/materials.csv --port 8765
+#   python -m simulation.src.models.server --matpath data/materials.csv --unix /tmp/xmason.sock
+#
+# HTTP/1.1 with keep-alive:
+#
+#   POST /impedance   body: JSON {"parameters": {...}} with the keys of
+#                     simulate_xMason (fband or frequency list [Hz])
+#                     response: application/octet-stream, n float64 frequencies
+#                     followed by the complex128 impedances (little endian)
+#                     of shape X-Shape + (n,), n in the X-Points header and
+#                     X-Shape the design axes of the stack (empty for one)
+#   GET /health       JSON status
+#
+# The material library and the compiled stacks stay in memory. Requests
+# queued while a batch runs (or arriving within `window` seconds) are grouped by frequency count and layer
+# count and evaluated as one batched CompiledStack on a worker thread.
+#
+
+from collections import OrderedDict
+import http.client
+import hashlib
+import argparse
+import asyncio
+import socket
+import json
+
+import numpy as np
+
+from simulation.src.features.compiled import CompiledStack
+from simulation.src.features.ports import frequency_points
+from simulation.src.models.simulate import simulate_xMason
+from simulation.src.models.cache import canonical
+
+
+class SimulationServer():
+    #
+    # matpath:    materials.csv used for all requests
+    # window:     seconds to wait for further requests after the first one.
+    #             With 0, requests queued while a batch is evaluated form the
+    #             next batch (no added latency when idle).
+    # max_batch:  upper bound of stacks evaluated together
+    # n_compiled: compiled stacks kept (least recently used are dropped)
+    #
+    def __init__(self, matpath=None, window=0.0, max_batch=256, n_compiled=1024):
+        self._matpath = matpath
+        self._window = window
+        self._max_batch = max_batch
+        self._n_compiled = n_compiled
+        self._compiled = OrderedDict()
+        self._queue = None
+        self._batches = 0
+        self._requests = 0
+
+
+    async def serve(self, host='127.0.0.1', port=8765, path=None):
+        self._queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.__batcher())
+        if path is None:
+            server = await asyncio.start_server(self.__connection, host=host, port=port)
+        else:
+            server = await asyncio.start_unix_server(self.__connection, path=path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+    # Compiled stack and frequency grid of a parameter dict (cached)
+    #
+    def compile(self, parameters=None):
+        key, parameters = self.__key(parameters)
+        entry = self.__cached(key)
+        if entry is None:
+            entry = self.__store(key, self.__build(parameters))
+        return entry
+
+
+    # Cache key and normalized parameters
+    #
+    def __key(self, parameters):
+        if parameters.get('sampling') is not None:
+            raise ValueError('Adaptive sampling is not available in server mode.')
+        frequency = parameters.get('frequency')
+        parameters = dict(parameters, frequency=None if frequency is None else np.asarray(frequency, dtype=float))
+        return hashlib.sha256(json.dumps(canonical(parameters), sort_keys=True).encode()).hexdigest(), parameters
+
+
+    # Material lookup and Transducer build, run on a worker thread by the server
+    #
+    def __build(self, parameters):
+        compiled = simulate_xMason(parameters=parameters, matpath=self._matpath, compute=False).compiled
+        return compiled, frequency_points(parameters.get('fband'), parameters['frequency'])
+
+
+    def __cached(self, key):
+        entry = self._compiled.get(key)
+        if entry is not None:
+            self._compiled.move_to_end(key)
+        return entry
+
+
+    def __store(self, key, entry):
+        self._compiled[key] = entry
+        if len(self._compiled) > self._n_compiled:
+            self._compiled.popitem(last=False)
+        return entry
+
+
+    # Evaluate requests [(compiled, frequency)] with identical layer and
+    # frequency counts as one batch
+    #
+    # Stacks with design axes are flattened into the batch and their rows
+    # split off again, returns [(..., n_freqs)] in the order of the requests
+    #
+    @staticmethod
+    def evaluate(requests=None):
+        sizes = [len(compiled) for compiled, _ in requests]
+        stacks = CompiledStack.concatenate([flatten(compiled) for compiled, _ in requests])
+        grids = [frequency for _, frequency in requests]
+        if all(grid is grids[0] or np.array_equal(grid, grids[0]) for grid in grids):
+            impedance = stacks.electric_impedance(grids[0])
+        else:
+            impedance = stacks.electric_impedance(np.concatenate([np.broadcast_to(grid, (size, len(grid)))
+                                                                  for grid, size in zip(grids, sizes)]))
+        offsets = np.cumsum([0] + sizes)
+        return [impedance[start:stop].reshape(compiled.shape + impedance.shape[-1:])
+                for (compiled, _), start, stop in zip(requests, offsets[:-1], offsets[1:])]
+
+
+    async def __batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self._max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            deadline = loop.time() + self._window
+            while len(batch) < self._max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+            for compiled, frequency, future in batch:
+                key = (len(frequency), compiled.Z0_top.shape[-1], compiled.Z0_bottom.shape[-1])
+                groups.setdefault(key, []).append((compiled, frequency, future))
+
+            for group in groups.values():
+                self._batches += 1
+                try:
+                    impedance = await loop.run_in_executor(None, self.evaluate,
+                                                           [(compiled, frequency) for compiled, frequency, _ in group])
+                except Exception as error:
+                    for _, _, future in group:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+                for (_, frequency, future), result in zip(group, impedance):
+                    if not future.done():
+                        future.set_result((frequency, result))
+
+
+    async def __connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                    headers = {}
+                    while True:
+                        line = (await reader.readline()).decode('latin-1').strip()
+                        if not line:
+                            break
+                        name, _, value = line.partition(':')
+                        headers[name.strip().lower()] = value.strip()
+                    body = await reader.readexactly(int(headers.get('content-length', 0)))
+                except ValueError as error:
+                    message = json.dumps({'error': f'Malformed request: {error}'})
+                    await self.__respond(writer, '400 Bad Request', 'application/json', message.encode(),
+                                         {'Connection': 'close'})
+                    break
+
+                status, content_type, payload, extra = await self.__handle(method, target, body)
+                await self.__respond(writer, status, content_type, payload, extra)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+    @staticmethod
+    async def __respond(writer, status, content_type, payload, extra):
+        head = [f'HTTP/1.1 {status}',
+                f'Content-Type: {content_type}',
+                f'Content-Length: {len(payload)}'] + [f'{name}: {value}' for name, value in extra.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        writer.write(payload)
+        await writer.drain()
+
+
+    async def __handle(self, method, target, body):
+        if method == 'GET' and target == '/health':
+            status = {'requests': self._requests, 'batches': self._batches, 'compiled': len(self._compiled)}
+            return '200 OK', 'application/json', json.dumps(status).encode(), {}
+        if method != 'POST' or target != '/impedance':
+            return '404 Not Found', 'application/json', b'{"error": "not found"}', {}
+
+        # compile on a worker thread, the material lookup and Transducer
+        # build would block all other connections
+        #
+        loop = asyncio.get_running_loop()
+        try:
+            key, parameters = self.__key(json.loads(body)['parameters'])
+            entry = self.__cached(key)
+            if entry is None:
+                entry = self.__store(key, await loop.run_in_executor(None, self.__build, parameters))
+            compiled, frequency = entry
+        except Exception as error:
+            message = json.dumps({'error': f'{type(error).__name__}: {error}'})
+            return '400 Bad Request', 'application/json', message.encode(), {}
+
+        future = loop.create_future()
+        self._requests += 1
+        await self._queue.put((compiled, frequency, future))
+        try:
+            frequency, impedance = await future
+        except Exception as error:
+            message = json.dumps({'error': f'{type(error).__name__}: {error}'})
+            return '500 Internal Server Error', 'application/json', message.encode(), {}
+
+        payload = (np.asarray(frequency, dtype='<f8').tobytes()
+                   + np.asarray(impedance, dtype='<c16').tobytes())
+        return '200 OK', 'application/octet-stream', payload, {'X-Points': len(frequency),
+                                                               'X-Shape': ','.join(map(str, np.shape(impedance)[:-1]))}
+
+
+
+class SimulationClient():
+    #
+    # Blocking client of a SimulationServer (one kept-alive connection)
+    #
+    # client = SimulationClient(port=8765)  or  SimulationClient(path='/tmp/xmason.sock')
+    # frequency, impedance = client.impedance(parameters)
+    #
+    def __init__(self, host='127.0.0.1', port=8765, path=None, timeout=60):
+        if path is None:
+            self._connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        else:
+            self._connection = _UnixHTTPConnection(path, timeout=timeout)
+
+
+    def impedance(self, parameters=None):
+        body = json.dumps({'parameters': canonical_request(parameters)})
+        self._connection.request('POST', '/impedance', body=body, headers={'Content-Type': 'application/json'})
+        response = self._connection.getresponse()
+        payload = response.read()
+        if response.status != 200:
+            raise RuntimeError(json.loads(payload)['error'])
+
+        n_points = int(response.getheader('X-Points'))
+        shape = tuple(int(n) for n in response.getheader('X-Shape', '').split(',') if n)
+        frequency = np.frombuffer(payload, dtype='<f8', count=n_points)
+        impedance = np.frombuffer(payload, dtype='<c16', offset=8 * n_points).reshape(shape + (n_points,))
+        return frequency, impedance
+
+
+    def close(self):
+        self._connection.close()
+
+
+
+# Stack with its design axes flattened into one, shape (n,)
+#
+def flatten(compiled=None):
+    n = len(compiled)
+    return CompiledStack(**{name: np.reshape(value, (n,) + np.shape(value)[compiled.Z0_piezo.ndim:])
+                            for name, value in compiled.arrays.items()})
+
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+# Parameters as plain JSON types (arrays -> lists)
+#
+def canonical_request(parameters):
+    if isinstance(parameters, dict):
+        return {key: canonical_request(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple, np.ndarray)):
+        return [canonical_request(value) for value in parameters]
+    if isinstance(parameters, np.generic):
+        return parameters.item()
+    return parameters
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='xMason simulation service')
+    parser.add_argument('--matpath', required=True, help='materials.csv')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='serve on a Unix socket instead of TCP')
+    parser.add_argument('--window', type=float, default=0.0, help='batching window [s]')
+    arguments = parser.parse_args()
+
+    server = SimulationServer(matpath=arguments.matpath, window=arguments.window)
+    asyncio.run(server.serve(host=arguments.host, port=arguments.port, path=arguments.unix))
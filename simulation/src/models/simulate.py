@@ -18,37 +18,37 @@
 
 from simulation.src.data.loader import Material
 from simulation.src.features.transducer import Transducer
+from simulation.src.features.characteristics import compile_layers, compile_transducer
 from simulation.src.features.circuit import Transducer_acoustic_circuit
+from simulation.src.features.ports import frequency_points
+from simulation.src.models.cache import SimulationCache, CachedCircuit
 
 
 class simulate_xMason():
-    def __init__(self, parameters=None, matpath=None):
+    #
+    # compute: False only prepares the transducer and its compiled stack
+    #          (see .compiled) without simulating the frequency band
+    # cache:   SimulationCache or cache directory. Identical simulations
+    #          (parameters, material constants and frequency grid) are then
+    #          read back memory-mapped instead of being simulated again.
+    # output:  optional features.output.SpectrumOutput, e.g. float32 |Z| and
+    #          phase of a downsampled spectrum (see .output). The full
+    #          circuit is then released after the reduction.
+    #
+    def __init__(self, parameters=None, matpath=None, compute=True, cache=None, output=None):
 
         # Material Path
         self.matpath = matpath
 
         # Frequency Band
-        self._fband = parameters['fband']
-
-        # Geometries
-        self._radius = parameters['radius']
-        if 'substrateWHratio' in parameters:
-            self._substrateWHratio = parameters['substrateWHratio']
-        else:
-            self._substrateWHratio = None
-        self._thickness_td= parameters['thickness_td']
-        self._thickness_el = parameters['thickness_el']
-        self._thickness_sub = parameters['thickness_sub']
-
-        # Materials
-        self._Tload = parameters['Tload']
-        self._Telectrode = parameters['Telectrode']
-        self._piezo = parameters['piezo']
-        self._Belectrode = parameters['Belectrode']
-        self._Bsubstrate = parameters['Bsubstrate']
-        self._Bload = parameters['Bload']
-
-
+        #
+        # fband: [f_low, f_high] in MHz, or
+        # frequency: frequency vector in Hz (e.g. log spaced or VNA points)
+        # sampling: None or 'adaptive'
+        #
+        self._fband = parameters.get('fband')
+        self._frequency = parameters.get('frequency')
+        self._sampling = parameters.get('sampling')
 
         ################################################################
         # LOAD MATERIALS --------->
@@ -56,35 +56,128 @@ class simulate_xMason():
         MatData = Material(self.matpath)
 
 
-        ################################################################
-        # Initialize TRANSDUCER --------->
-        ################################################################
+        # Layered stacks: any number of top and bottom layers
         #
-        # Define Materials using following *kwargs:
-        # Tload, Telectrode, piezo, Belectrode, Bsubstrate, Bload
-        # T = Top orientation
-        # B = Bottom orientation
+        # top_layers / bottom_layers list the layers from the piezo outwards,
+        # e.g. [('Silverink', 0.5e-6), ('Epoxy', 2e-6), ('Kapton', 13e-6)]
+        # (see characteristics.compile_layers). Tload terminates both
+        # branches, Bload may be omitted (or equal Tload).
         #
-        xMason_Transducer = Transducer(radius=self._radius,
-                                       substrateWHratio=self._substrateWHratio,
-                                       thickness_td=self._thickness_td,
-                                       thickness_el=self._thickness_el,
-                                       thickness_sub=self._thickness_sub,
-                                       material=MatData.material,
-                                       Tload=self._Tload,
-                                       Telectrode=self._Telectrode,
-                                       piezo=self._piezo,
-                                       Belectrode=self._Belectrode,
-                                       Bsubstrate=self._Bsubstrate,
-                                       Bload=self._Bload)
+        if 'top_layers' in parameters or 'bottom_layers' in parameters:
+            self._radius = parameters['radius']
+            self._thickness_td = parameters['thickness_td']
+            self._piezo = parameters['piezo']
+            self._Tload = parameters['Tload']
+            self._Bload = parameters.get('Bload', self._Tload)
+            if self._Bload != self._Tload:
+                raise ValueError(f"Layered stacks are terminated by Tload on both sides, "
+                                 f"got Bload '{self._Bload}' != Tload '{self._Tload}'.")
+
+            self._transducer = None
+            self._compiled = compile_layers(library=MatData.library,
+                                            radius=self._radius,
+                                            piezo=self._piezo,
+                                            thickness_td=self._thickness_td,
+                                            top_layers=parameters.get('top_layers', ()),
+                                            bottom_layers=parameters.get('bottom_layers', ()),
+                                            Tload=self._Tload)
+
+        else:
+            # Geometries
+            self._radius = parameters['radius']
+            if 'substrateWHratio' in parameters:
+                self._substrateWHratio = parameters['substrateWHratio']
+            else:
+                self._substrateWHratio = None
+            self._thickness_td= parameters['thickness_td']
+            self._thickness_el = parameters['thickness_el']
+            self._thickness_sub = parameters['thickness_sub']
+
+            # Materials
+            self._Tload = parameters['Tload']
+            self._Telectrode = parameters['Telectrode']
+            self._piezo = parameters['piezo']
+            self._Belectrode = parameters['Belectrode']
+            self._Bsubstrate = parameters['Bsubstrate']
+            self._Bload = parameters['Bload']
+
+
+            ################################################################
+            # Initialize TRANSDUCER --------->
+            ################################################################
+            #
+            # Define Materials using following *kwargs:
+            # Tload, Telectrode, piezo, Belectrode, Bsubstrate, Bload
+            # T = Top orientation
+            # B = Bottom orientation
+            #
+            self._transducer = Transducer(radius=self._radius,
+                                          substrateWHratio=self._substrateWHratio,
+                                          thickness_td=self._thickness_td,
+                                          thickness_el=self._thickness_el,
+                                          thickness_sub=self._thickness_sub,
+                                          material=MatData.library,
+                                          Tload=self._Tload,
+                                          Telectrode=self._Telectrode,
+                                          piezo=self._piezo,
+                                          Belectrode=self._Belectrode,
+                                          Bsubstrate=self._Bsubstrate,
+                                          Bload=self._Bload)
+            self._compiled = None
+
 
         ################################################################
         # Simulate IMPEDANCE for defined frequency band --------->
         ################################################################
-        self._xMason_Simulation = Transducer_acoustic_circuit(transducer=xMason_Transducer,
-                                                             fband=self._fband)
+        self._xMason_Simulation = None
+        if compute and cache is not None:
+            if not isinstance(cache, SimulationCache):
+                cache = SimulationCache(path=cache)
+            grid = frequency_points(self._fband, self._frequency) if self._sampling is None else None
+            key = cache.key(parameters=parameters, library=MatData.library, frequency=grid)
+            cached = cache.load(key)
+            if cached is not None:
+                self._xMason_Simulation = CachedCircuit(*cached)
+                compute = False
+
+        if compute:
+            self._xMason_Simulation = Transducer_acoustic_circuit(transducer=self._transducer,
+                                                                 compiled=self._compiled,
+                                                                 fband=self._fband,
+                                                                 frequency=self._frequency,
+                                                                 sampling=self._sampling)
+            self._compiled = self._xMason_Simulation.compiled
+            if cache is not None:
+                cache.store(key, frequency=self._xMason_Simulation.frequency,
+                            impedance=self._xMason_Simulation.electric_impedance.to_numpy())
+
+        self._output = None
+        if output is not None and self._xMason_Simulation is not None:
+            self._output = output.reduce(frequency=self._xMason_Simulation.frequency,
+                                         impedance=self._xMason_Simulation.electric_impedance.to_numpy())
+            self._xMason_Simulation = None
 
 
     @property
     def impedance(self):
         return self._xMason_Simulation
+
+    @property
+    def frequency(self):
+        if self._output is not None:
+            return self._output['frequency']
+        return self._xMason_Simulation.frequency
+
+    @property
+    def output(self):
+        return self._output
+
+    @property
+    def transducer(self):
+        return self._transducer
+
+    @property
+    def compiled(self):
+        if self._compiled is None:
+            self._compiled = compile_transducer(self._transducer)
+        return self._compiled
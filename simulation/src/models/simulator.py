@@ -0,0 +1,90 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from simulation.src.features.compiled import CompiledStack
+from simulation.src.features.kernel import kernel_constants, fused_mason_impedance
+from simulation.src.models.simulate import simulate_xMason
+
+
+class simulator_xMason():
+    #
+    # Compile once, evaluate many.
+    #
+    # parameters, matpath: stack as for simulate_xMason (the frequency entries
+    #                      are not used), or
+    # compiled:            a ready CompiledStack (any design shape)
+    #
+    # Everything that does not depend on frequency is folded into constants
+    # at construction (kernel.kernel_constants): the electrical length per Hz
+    # of every layer (2pi * l / v), Z0 and 1/Z0 of the transmission lines,
+    # 1/(2pi * C0) and 1/N^2. evaluate(frequency) then only runs the fused
+    # Mason chain (kernel.fused_mason_impedance).
+    #
+    # The constants are read-only and evaluate() keeps no state (every call
+    # gets its own workspace), so one simulator can serve concurrent threads.
+    # replace(**changes) returns a new simulator for changed parameters or
+    # CompiledStack fields.
+    #
+    def __init__(self, parameters=None, matpath=None, compiled=None):
+        self._parameters = dict(parameters or {})
+        self._matpath = matpath
+        if compiled is None:
+            compiled = simulate_xMason(parameters=self._parameters, matpath=matpath, compute=False).compiled
+        self._compiled = compiled
+        self._constants = kernel_constants(compiled)
+
+
+    # Electrical impedance at any frequency vector [Hz], (..., n_freqs)
+    #
+    # out: optional preallocated complex output
+    #
+    def evaluate(self, frequency=None, out=None):
+        return fused_mason_impedance(frequency, self._constants, out=out)
+
+
+    # New simulator with changed fields
+    #
+    # changes: CompiledStack fields (Z0_top, ..., C0, N), applied to the
+    #          compiled stack directly, or simulate_xMason parameters, which
+    #          recompile the stack (only for simulators built from parameters)
+    #
+    def replace(self, **changes):
+        fields = set(changes).intersection(CompiledStack.__slots__)
+        if fields:
+            if fields != set(changes):
+                raise ValueError(f'Change either CompiledStack fields or parameters, '
+                                 f'not both ({sorted(set(changes) - fields)} are parameters).')
+            return simulator_xMason(compiled=CompiledStack(**dict(self._compiled.arrays, **changes)))
+        if not self._parameters:
+            raise ValueError(f'Simulator was built from a CompiledStack without parameters, '
+                             f'change its fields {CompiledStack.__slots__} instead.')
+        return simulator_xMason(parameters=dict(self._parameters, **changes), matpath=self._matpath)
+
+
+    @property
+    def compiled(self):
+        return self._compiled
+
+    @property
+    def parameters(self):
+        return dict(self._parameters)
+
+    @property
+    def shape(self):
+        return self._compiled.shape
+
@@ -0,0 +1,120 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+
+from simulation.src.features.ports import frequency_spectrum_chunks
+from simulation.src.features.profiling import stage
+from simulation.src.models.simulator import simulator_xMason
+
+
+class stream_xMason():
+    #
+    # Chunked evaluation of very wide or very fine frequency bands.
+    #
+    # parameters, matpath: stack as for simulate_xMason, or
+    # compiled:            a ready CompiledStack (any design shape)
+    # chunk_size:          frequency points per chunk
+    #
+    # The band (fband on the 1 kHz grid, or a frequency vector) is walked in
+    # chunks of chunk_size points through the whole Mason chain
+    # (simulator_xMason), so peak memory is bounded by the chunk size and the
+    # design count, not by the band width. The 1 kHz grid itself is generated
+    # chunk by chunk (ports.frequency_spectrum_chunks).
+    #
+    # for frequency, impedance in stream_xMason(parameters, matpath): ...
+    # impedance = stream_xMason(parameters, matpath).to_memmap('survey.npy')
+    #
+    def __init__(self, parameters=None, matpath=None, compiled=None, chunk_size=2 ** 16):
+        parameters = dict(parameters or {})
+        if parameters.get('sampling') is not None:
+            raise ValueError('Adaptive sampling is not available for chunked evaluation.')
+
+        self._fband = parameters.get('fband')
+        self._frequency = parameters.get('frequency')
+        if self._frequency is not None:
+            self._frequency = np.asarray(self._frequency, dtype=float)
+        elif self._fband is None:
+            raise ValueError('Chunked evaluation needs fband or frequency.')
+        self._chunk_size = chunk_size
+        self._simulator = simulator_xMason(parameters=parameters, matpath=matpath, compiled=compiled)
+
+
+    def __iter__(self):
+        for frequency in self.frequencies():
+            with stage('stream_chunk', n_freqs=len(frequency)):
+                impedance = self._simulator.evaluate(frequency)
+            yield frequency, impedance
+
+
+    # Frequency chunks [Hz] of the band
+    #
+    def frequencies(self):
+        if self._frequency is None:
+            yield from frequency_spectrum_chunks(self._fband, chunk_size=self._chunk_size)
+            return
+        for start in range(0, len(self._frequency), self._chunk_size):
+            yield self._frequency[start:start + self._chunk_size]
+
+
+    # Write the impedance (..., n_points) chunk by chunk into a .npy file
+    #
+    # dtype:          complex128 or complex64
+    # frequency_path: optional .npy file for the frequency points
+    #
+    # returns: the memory-mapped impedance (np.load(path, mmap_mode='r') reopens it)
+    #
+    def to_memmap(self, path=None, dtype=np.complex128, frequency_path=None):
+        shape = self.shape + (self.n_points,)
+        impedance = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        frequency = None
+        if frequency_path is not None:
+            frequency = np.lib.format.open_memmap(frequency_path, mode='w+', dtype=float, shape=(self.n_points,))
+
+        start = 0
+        for chunk_frequency, chunk_impedance in self:
+            stop = start + len(chunk_frequency)
+            impedance[..., start:stop] = chunk_impedance
+            if frequency is not None:
+                frequency[start:stop] = chunk_frequency
+            start = stop
+
+        impedance.flush()
+        if frequency is not None:
+            frequency.flush()
+        return impedance
+
+
+    @property
+    def n_points(self):
+        if self._frequency is not None:
+            return len(self._frequency)
+        start, stop, step = self._fband[0] * 10 ** 6, self._fband[1] * 10 ** 6, 1 * 10 ** 3
+        return max(int(np.ceil((stop - start) / step)), 0)
+
+    @property
+    def n_chunks(self):
+        return -(-self.n_points // self._chunk_size)
+
+    @property
+    def shape(self):
+        return self._simulator.shape
+
+    @property
+    def simulator(self):
+        return self._simulator
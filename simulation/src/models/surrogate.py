@@ -0,0 +1,273 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+import pandas as pd
+
+from simulation.src.features.ports import frequency_points
+from simulation.src.features.sampling import adaptive_frequency_sampling
+from simulation.src.models.simulator import simulator_xMason
+
+
+class RationalModel():
+    #
+    # Pole-residue model Z(f) = d + sum_k r_k / (s - p_k), s = 1j * f / f_scale
+    #
+    # poles, residues: (..., n_poles) complex, d: (...) complex
+    #
+    def __init__(self, poles=None, residues=None, d=None, f_scale=None):
+        self.poles = np.asarray(poles, dtype=complex)
+        self.residues = np.asarray(residues, dtype=complex)
+        self.d = np.asarray(d, dtype=complex)
+        self.f_scale = f_scale
+
+    def evaluate(self, frequency=None):
+        s = 1j * np.asarray(frequency, dtype=float)[:, None] / self.f_scale
+        terms = self.residues[..., None, :] / (s - self.poles[..., None, :])
+        return self.d[..., None] + terms.sum(axis=-1)
+
+
+
+# VECTOR FITTING (Gustavsen & Semlyen) of one complex spectrum
+#
+# frequency: (n_freqs,) [Hz], impedance: (n_freqs,)
+# n_poles:   order of the model
+# poles:     optional initial poles (scaled by f_scale), e.g. of a neighbouring
+#            design, otherwise lightly damped poles spread over the band
+#
+# The least squares problems are weighted by 1/|Z| (relative error). Poles
+# keep their order across the relocation steps (nearest match), so the
+# models of neighbouring designs can be interpolated pole by pole.
+#
+def vector_fit(frequency=None, impedance=None, n_poles=16, poles=None, n_iterations=15):
+    frequency = np.asarray(frequency, dtype=float)
+    impedance = np.asarray(impedance, dtype=complex)
+    f_scale = frequency.max()
+    s = 1j * frequency / f_scale
+    weight = 1 / np.abs(impedance)
+
+    if poles is None:
+        beta = np.linspace(frequency.min(), frequency.max(), n_poles) / f_scale
+        poles = -0.01 * beta + 1j * beta
+    poles = np.array(poles, dtype=complex)
+
+    for _ in range(n_iterations):
+        basis = 1 / (s[:, None] - poles[None, :])
+        system = np.hstack((basis, np.ones((len(s), 1)), -impedance[:, None] * basis)) * weight[:, None]
+        solution = np.linalg.lstsq(system, impedance * weight, rcond=None)[0]
+        sigma = solution[n_poles + 1:]
+
+        # zeros of sigma(s) are the relocated poles, unstable ones are flipped
+        relocated = np.linalg.eigvals(np.diag(poles) - np.outer(np.ones(n_poles), sigma))
+        relocated = np.where(relocated.real > 0, -relocated.real + 1j * relocated.imag, relocated)
+        poles = match_poles(poles, relocated)
+
+    basis = 1 / (s[:, None] - poles[None, :])
+    system = np.hstack((basis, np.ones((len(s), 1)))) * weight[:, None]
+    solution = np.linalg.lstsq(system, impedance * weight, rcond=None)[0]
+    return RationalModel(poles=poles, residues=solution[:n_poles], d=solution[n_poles], f_scale=f_scale)
+
+
+# Order `new` like `reference` (greedy nearest neighbours)
+#
+def match_poles(reference, new):
+    distance = np.abs(reference[:, None] - new[None, :])
+    order = np.empty(len(reference), dtype=int)
+    for _ in range(len(reference)):
+        i, j = np.unravel_index(np.argmin(distance), distance.shape)
+        order[i] = j
+        distance[i, :] = np.inf
+        distance[:, j] = np.inf
+    return new[order]
+
+
+
+class surrogate_xMason():
+    #
+    # Reduced order (rational) model of a stack for instant impedance queries.
+    #
+    # parameters, matpath: stack as for simulate_xMason, fband / frequency
+    #                      define the band
+    # n_poles:   order of the pole-residue models (low orders track the poles
+    #            of a sweep more reliably)
+    # sweep:     optional (name, values) of one geometry parameter, e.g.
+    #            ('thickness_td', np.linspace(10e-6, 15e-6, 21)). A model is
+    #            fitted per value (starting from the poles of the previous
+    #            value) and poles, residues and d are interpolated piecewise
+    #            cubic in between.
+    # tolerance: target relative error. Every sweep interval is checked at
+    #            n_checks interior points (log spaced for positive values)
+    #            against the exact compiled model (simulator_xMason, the same
+    #            Mason chain as simulate_xMason) and bisected while the error
+    #            exceeds the tolerance, up to max_samples fitted values.
+    #
+    # .errors holds every interval, its worst checked point and the maximum
+    # relative error over the band, .error_bound the largest of them. Values
+    # outside the fitted range raise a ValueError. Pole tracking can fail where
+    # resonances enter or leave the band; queries inside intervals that still
+    # miss the tolerance are answered by the exact compiled model
+    # (simulator_xMason) unless exact_fallback is False.
+    #
+    def __init__(self, parameters=None, matpath=None, n_poles=8, sweep=None, tolerance=1e-3, max_samples=129,
+                 n_checks=8, exact_fallback=True):
+        self._parameters = dict(parameters)
+        self._matpath = matpath
+        self._n_poles = n_poles
+        self._band = frequency_points(parameters.get('fband'), parameters.get('frequency'))
+        self._simulator = simulator_xMason(parameters=parameters, matpath=matpath)
+        self._tolerance = tolerance
+        self._n_checks = n_checks
+        self._exact_fallback = exact_fallback
+
+        if sweep is None:
+            self._name, self._values = None, np.array([np.nan])
+            self._models = [self.__fit(self._simulator, None)]
+            self._errors = pd.DataFrame({'low': [np.nan], 'high': [np.nan], 'value': [np.nan],
+                                         'error': [self.__error(None)]})
+            return
+
+        self._name = sweep[0]
+        self._values = np.sort(np.asarray(sweep[1], dtype=float))
+        if len(self._values) < 2:
+            raise ValueError('A sweep needs at least two values.')
+
+        self._models = []
+        poles = None
+        for value in self._values:
+            self._models.append(self.__fit(self._simulator.replace(**{self._name: value}), poles))
+            poles = self._models[-1].poles
+        self.__refine(tolerance, max_samples)
+
+
+    # Impedance at any frequency [Hz] (and sweep value)
+    #
+    def evaluate(self, frequency=None, value=None):
+        if self._exact_fallback and not self.within_tolerance(value):
+            simulator = self._simulator if self._name is None else self._simulator.replace(**{self._name: value})
+            return simulator.evaluate(frequency)
+        return self.model(value).evaluate(frequency)
+
+
+    # True if the checked error of the interval containing `value` meets the tolerance
+    #
+    def within_tolerance(self, value=None):
+        if self._name is None:
+            return bool(self._errors['error'].iloc[0] <= self._tolerance)
+        return bool(self._errors['error'].iloc[self.__interval(value)] <= self._tolerance)
+
+
+    # Interpolated RationalModel at a sweep value
+    #
+    def model(self, value=None):
+        if self._name is None:
+            return self._models[0]
+
+        # Lagrange weights of the (up to) four neighbouring samples
+        #
+        n_values = len(self._values)
+        i = self.__interval(value)
+        start = int(np.clip(i - 1, 0, max(n_values - 4, 0)))
+        nodes = self._values[start:start + 4]
+        weights = [np.prod([(value - b) / (a - b) for b in nodes if b != a]) for a in nodes]
+        models = self._models[start:start + 4]
+        return RationalModel(poles=sum(w * m.poles for w, m in zip(weights, models)),
+                             residues=sum(w * m.residues for w, m in zip(weights, models)),
+                             d=sum(w * m.d for w, m in zip(weights, models)),
+                             f_scale=models[0].f_scale)
+
+
+    # Index of the sweep interval containing `value`
+    #
+    def __interval(self, value):
+        if not self._values[0] <= value <= self._values[-1]:
+            raise ValueError(f'{self._name} = {value} is outside the fitted range '
+                             f'[{self._values[0]}, {self._values[-1]}].')
+        return int(np.clip(np.searchsorted(self._values, value) - 1, 0, len(self._values) - 2))
+
+
+    def __fit(self, simulator, poles):
+        frequency, impedance = adaptive_frequency_sampling(evaluate=simulator.evaluate, fband=None,
+                                                           frequency=np.linspace(self._band[0], self._band[-1], 256))
+        return vector_fit(frequency, impedance, n_poles=self._n_poles, poles=poles)
+
+
+    # Maximum relative error over the band against the exact model
+    #
+    def __error(self, value):
+        simulator = self._simulator if value is None else self._simulator.replace(**{self._name: value})
+        exact = simulator.evaluate(self._band)
+        surrogate = self.model(value).evaluate(self._band)
+        return np.max(np.abs(surrogate - exact) / np.abs(exact))
+
+
+    # (worst point, maximum error) over the interior check points of [low, high]
+    #
+    def __check(self, low, high):
+        if low > 0:
+            points = np.geomspace(low, high, self._n_checks + 2)[1:-1]
+        else:
+            points = np.linspace(low, high, self._n_checks + 2)[1:-1]
+        errors = [self.__error(value) for value in points]
+        return points[int(np.argmax(errors))], max(errors)
+
+
+    def __refine(self, tolerance, max_samples):
+        checked = {}
+        while True:
+            intervals = list(zip(self._values[:-1], self._values[1:]))
+            for interval in intervals:
+                if interval not in checked:
+                    checked[interval] = self.__check(*interval)
+            failed = [i for i, interval in enumerate(intervals) if checked[interval][1] > tolerance]
+            if not failed or len(self._values) + len(failed) > max_samples:
+                break
+
+            # a split changes the interpolation window of up to two intervals on either side
+            #
+            for i in range(len(intervals)):
+                if any(abs(i - j) <= 2 for j in failed):
+                    checked.pop(intervals[i], None)
+
+            for i in reversed(failed):
+                value = (self._values[i] + self._values[i + 1]) / 2
+                model = self.__fit(self._simulator.replace(**{self._name: value}), self._models[i].poles)
+                self._values = np.insert(self._values, i + 1, value)
+                self._models.insert(i + 1, model)
+
+        intervals = list(zip(self._values[:-1], self._values[1:]))
+        self._errors = pd.DataFrame({'low': self._values[:-1],
+                                     'high': self._values[1:],
+                                     'value': [checked[interval][0] for interval in intervals],
+                                     'error': [checked[interval][1] for interval in intervals]})
+
+
+    @property
+    def errors(self):
+        return self._errors
+
+    @property
+    def error_bound(self):
+        return self._errors['error'].max()
+
+    @property
+    def values(self):
+        return self._values
+
+    @property
+    def frequency(self):
+        return self._band
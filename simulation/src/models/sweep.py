@@ -0,0 +1,181 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+import pandas as pd
+
+from simulation.src.data.loader import Material
+from simulation.src.features.transducer import Transducer
+from simulation.src.features.characteristics import compile_stack
+from simulation.src.features.ports import frequency_points
+
+
+GEOMETRY = ['radius', 'thickness_td', 'thickness_el', 'thickness_sub']
+LAYERS = ['Tload', 'Telectrode', 'piezo', 'Belectrode', 'Bsubstrate', 'Bload']
+MATERIAL = ['roh', 'v', 'eps33', 'h33']
+
+
+class sweep_xMason():
+    #
+    # Evaluate many transducer stacks in one vectorized pass.
+    #
+    # parameters: same keys as simulate_xMason, but every entry of GEOMETRY
+    #             may be a scalar or a 1-D array.
+    # mode:       'grid' -> full factorial product of all geometry arrays
+    #             'zip'  -> geometry arrays are broadcast element-wise
+    # batch_size: number of designs evaluated per vectorized block
+    #             (bounds the size of the temporaries)
+    # compute:    False only prepares designs and materials, blocks can then be
+    #             evaluated with evaluate_block (see scheduler.SweepScheduler)
+    # output:     optional features.output.SpectrumOutput. Every block is then
+    #             reduced into preallocated (n_designs, n_points) buffers
+    #             (.output) instead of the complex128 .impedance.
+    #
+    def __init__(self, parameters=None, matpath=None, mode='grid', batch_size=256, compute=True, output=None):
+
+        # Material Path
+        self.matpath = matpath
+
+        # Frequency Band
+        self._fband = parameters.get('fband')
+        self._frequency_band = frequency_points(self._fband, parameters.get('frequency'))
+
+        # Geometries
+        if 'substrateWHratio' in parameters:
+            self._substrateWHratio = parameters['substrateWHratio']
+        else:
+            self._substrateWHratio = None
+        self._designs = self.design_table(parameters=parameters, mode=mode)
+
+        # Materials
+        self._materials = {layer: parameters[layer] for layer in LAYERS}
+
+
+        ################################################################
+        # LOAD MATERIALS --------->
+        ################################################################
+        MatData = Material(self.matpath)
+
+        # The material rows do not depend on the geometry, so a single
+        # transducer is enough to resolve them for the whole sweep
+        #
+        first = self._designs.iloc[0]
+        xMason_Transducer = Transducer(radius=first['radius'],
+                                       substrateWHratio=self._substrateWHratio,
+                                       thickness_td=first['thickness_td'],
+                                       thickness_el=first['thickness_el'],
+                                       thickness_sub=first['thickness_sub'],
+                                       material=MatData.library,
+                                       **self._materials)
+        properties = xMason_Transducer.properties
+        self._properties = {name: dict(zip(properties['layers'], properties[name]))
+                            for name in ['roh', 'v', 'eps33', 'h33', 'radius', 'width', 'height', 'thickness']}
+
+
+        ################################################################
+        # Simulate IMPEDANCE for all designs --------->
+        ################################################################
+        self._impedance = None
+        self._output = None
+        if compute and output is not None:
+            n_designs = len(self._designs)
+            self._output = output.allocate((n_designs,), len(self._frequency_band))
+            for start in range(0, n_designs, batch_size):
+                output.reduce(frequency=self._frequency_band,
+                              impedance=self.evaluate_block(start, start + batch_size),
+                              out={name: (buffer if buffer.ndim == 1 else buffer[start:start + batch_size])
+                                   for name, buffer in self._output.items()})
+        elif compute:
+            n_designs = len(self._designs)
+            self._impedance = np.empty((n_designs, len(self._frequency_band)), dtype=complex)
+            for start in range(0, n_designs, batch_size):
+                self._impedance[start:start + batch_size] = self.evaluate_block(start, start + batch_size)
+
+
+
+    def design_table(self, parameters=None, mode=None):
+        values = [np.atleast_1d(np.asarray(parameters[key], dtype=float)) for key in GEOMETRY]
+        for key, value in zip(GEOMETRY, values):
+            if value.ndim != 1:
+                raise ValueError(f'{key} must be a scalar or a 1-D array.')
+
+        if mode == 'grid':
+            values = np.meshgrid(*values, indexing='ij')
+        elif mode == 'zip':
+            values = np.broadcast_arrays(*values)
+        else:
+            raise ValueError(f"Unknown sweep mode '{mode}', use 'grid' or 'zip'.")
+
+        return pd.DataFrame({key: value.ravel() for key, value in zip(GEOMETRY, values)})
+
+
+    def evaluate(self, designs=None):
+        return self.compile(designs).electric_impedance(self._frequency_band)
+
+
+    def evaluate_block(self, start=None, stop=None):
+        return self.evaluate(self._designs.iloc[start:stop])
+
+
+    # Broadcast the design table into the per-layer geometry of a batched
+    # CompiledStack (one entry per design)
+    #
+    # scale: optional per-design factors of the material constants,
+    #        {constant: {layer: factors}}, e.g. {'eps33': {'piezo': array}}
+    #
+    def compile(self, designs=None, scale=None):
+        radius = designs['radius'].to_numpy()
+        thickness = self._properties['thickness'].copy()
+        thickness.update({'Telectrode': designs['thickness_el'].to_numpy(),
+                          'piezo': designs['thickness_td'].to_numpy(),
+                          'Belectrode': designs['thickness_el'].to_numpy(),
+                          'Bsubstrate': designs['thickness_sub'].to_numpy()})
+
+        geometry = {'radius': {layer: (radius if ~np.isnan(value) else value)
+                               for layer, value in self._properties['radius'].items()},
+                    'thickness': thickness}
+        for name in ['radius', 'thickness']:
+            for layer, value in geometry[name].items():
+                geometry[name][layer] = np.where(value == 0, np.nan, value)
+
+        materials = {name: dict(self._properties[name]) for name in MATERIAL}
+        for name, layers in (scale or {}).items():
+            for layer, factor in layers.items():
+                materials[name][layer] = materials[name][layer] * np.asarray(factor)
+
+        return compile_stack(width=self._properties['width'],
+                             height=self._properties['height'],
+                             **materials,
+                             **geometry)
+
+
+    @property
+    def impedance(self):
+        return self._impedance
+
+    @property
+    def output(self):
+        return self._output
+
+    @property
+    def designs(self):
+        return self._designs
+
+    @property
+    def frequency(self):
+        return self._frequency_band
@@ -0,0 +1,151 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+import pandas as pd
+
+from simulation.src.features.resonance import FREQUENCY, MAGNITUDE, PHASE, resonance_table, vna_resonance_table
+from simulation.src.models.simulate import simulate_xMason
+
+
+class validate_xMason():
+    #
+    # Compare the model with measured VNA sweeps on the measured grids.
+    #
+    # parameters, matpath: nominal stack as for simulate_xMason (fband is not used)
+    # compiled:     optional CompiledStack of shape () or (n_samples,) instead,
+    #               e.g. fit_xMason(...).stacks
+    # experiments:  (n_freqs, n_columns, n_samples) VNA array, see VNA_Dataloader
+    # mask:         optional (n_freqs, n_samples) boolean array of valid points
+    # names:        optional sample names (e.g. VNA_Dataloader.files)
+    # mode, prominence: resonance selection, see resonance_table
+    #
+    # The model is evaluated only at the frequency column of every sample, all
+    # samples in one batched Mason chain (n_samples, n_freqs), instead of on
+    # the 1 kHz grid of simulate_xMason and interpolated. The model resonances
+    # are refined on the stack itself, the measured ones by parabolic
+    # interpolation (vna_resonance_table).
+    #
+    # table: per sample
+    #   n_points               valid measured points
+    #   magnitude_rms          RMS of |Z|model - |Z|measured [Ohm]
+    #   magnitude_log_rms      RMS of ln(|Z|model / |Z|measured)
+    #   magnitude_log_bias     mean of ln(|Z|model / |Z|measured)
+    #   phase_rms              RMS of the wrapped phase difference [deg]
+    #   fr_shift, fa_shift     model - measured resonance / antiresonance [Hz]
+    #   fr_relative_shift      fr_shift / measured fr
+    #
+    def __init__(self, parameters=None, matpath=None, compiled=None, experiments=None, mask=None, names=None,
+                 mode='strongest', prominence=0.1):
+
+        if compiled is None:
+            compiled = simulate_xMason(parameters=parameters, matpath=matpath, compute=False).compiled
+        self._compiled = compiled
+
+        # Measured curves, one row per sample
+        #
+        frequency = experiments[:, FREQUENCY, :].T
+        self._magnitude = experiments[:, MAGNITUDE, :].T
+        self._phase = experiments[:, PHASE, :].T
+        valid = np.isfinite(frequency) & (frequency > 0) & np.isfinite(self._magnitude) & np.isfinite(self._phase) \
+                & (self._magnitude > 0)
+        if mask is not None:
+            valid &= np.asarray(mask, dtype=bool).T
+        self._valid = valid
+        n_samples = frequency.shape[0]
+        if compiled.shape not in [(), (n_samples,)]:
+            raise ValueError(f'compiled must have shape () or ({n_samples},), got {compiled.shape}.')
+
+        # padded points are evaluated at 1 Hz and masked
+        #
+        self._frequency = np.where(valid, frequency, 1.0)
+
+
+        ################################################################
+        # Simulate IMPEDANCE on the measured grids --------->
+        ################################################################
+        self._impedance = compiled.electric_impedance(self._frequency)
+
+
+        ################################################################
+        # Residuals --------->
+        ################################################################
+        n_points = np.sum(valid, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            magnitude = np.abs(self._impedance)
+            magnitude_error = np.where(valid, magnitude - self._magnitude, 0)
+            log_error = np.where(valid, np.log(magnitude) - np.log(np.where(valid, self._magnitude, 1)), 0)
+            phase_error = np.where(valid, np.angle(self._impedance
+                                                   * np.exp(-1j * np.deg2rad(np.nan_to_num(self._phase)))), 0)
+
+            def rms(error):
+                return np.sqrt(np.sum(error ** 2, axis=1) / n_points)
+
+            table = pd.DataFrame({'n_points': n_points,
+                                  'magnitude_rms': rms(magnitude_error),
+                                  'magnitude_log_rms': rms(log_error),
+                                  'magnitude_log_bias': np.sum(log_error, axis=1) / n_points,
+                                  'phase_rms': np.rad2deg(rms(phase_error))}, index=names)
+
+        # Resonance shift
+        #
+        self._model = resonance_table(frequency=self._frequency, impedance=self._impedance, mask=valid,
+                                      evaluate=compiled.electric_impedance, names=names,
+                                      mode=mode, prominence=prominence)
+        self._measured = vna_resonance_table(experiments=experiments, mask=valid.T, names=names,
+                                             mode=mode, prominence=prominence)
+        table['fr_shift'] = self._model['fr'] - self._measured['fr']
+        table['fa_shift'] = self._model['fa'] - self._measured['fa']
+        table['fr_relative_shift'] = table['fr_shift'] / self._measured['fr']
+        self._table = table
+
+
+
+    # Per sample error metrics
+    #
+    @property
+    def table(self):
+        return self._table
+
+    # Resonance tables of the model and of the measurement
+    #
+    @property
+    def model(self):
+        return self._model
+
+    @property
+    def measured(self):
+        return self._measured
+
+    # Model impedance on the measured grids (n_samples, n_freqs), padded points masked by .valid
+    #
+    @property
+    def impedance(self):
+        return self._impedance
+
+    @property
+    def frequency(self):
+        return self._frequency
+
+    @property
+    def valid(self):
+        return self._valid
+
+    @property
+    def compiled(self):
+        return self._compiled
@@ -0,0 +1,72 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+import pytest
+
+from simulation.src.features.resonance import FREQUENCY, MAGNITUDE, PHASE
+from simulation.src.models.fitting import fit_xMason
+
+
+MATERIALS = 'data/materials.csv'
+PARAMETERS = {'radius': 0.0088, 'thickness_td': 12.3e-6, 'thickness_el': 0.5e-6, 'thickness_sub': 13e-6,
+              'Tload': 'Air', 'Telectrode': 'Silverink', 'piezo': 'P(VDF-TrFE)', 'Belectrode': 'Silverink',
+              'Bsubstrate': 'Kapton', 'Bload': 'Air'}
+
+# thickness_td, eps33 and h33 factors of the synthetic samples
+TRUTHS = np.array([[1.1, 0.9, 1.05],
+                   [1.2, 0.9, 1.1],
+                   [0.8, 1.3, 0.7],
+                   [1.5, 0.6, 1.4],
+                   [0.95, 1.1, 1.2]])
+
+
+# VNA array of the nominal stack with the piezo scaled by `factors`
+#
+def synthetic_experiments(factors, frequency):
+    experiments = np.zeros((len(frequency), 8, len(factors)))
+    experiments[:, FREQUENCY, :] = frequency[:, None]
+    experiments[:, MAGNITUDE, :] = 1
+    nominal = fit_xMason(parameters=PARAMETERS, matpath=MATERIALS, experiments=experiments,
+                         n_grid=0, max_iterations=0)
+    impedance = nominal.stack(np.log(factors)).electric_impedance(np.tile(frequency, (len(factors), 1)))
+    experiments[:, MAGNITUDE, :] = np.abs(impedance).T
+    experiments[:, PHASE, :] = np.rad2deg(np.angle(impedance)).T
+    return experiments
+
+
+@pytest.fixture(scope='module')
+def experiments():
+    return synthetic_experiments(TRUTHS, np.linspace(20e6, 100e6, 453))
+
+
+def test_recovers_synthetic_samples(experiments):
+    fit = fit_xMason(parameters=PARAMETERS, matpath=MATERIALS, experiments=experiments)
+    np.testing.assert_allclose(fit.factors, TRUTHS, rtol=1e-6)
+    assert np.all(fit.results['converged'])
+    assert np.all(fit.results['cost'] < 1e-12)
+
+
+# A fit pinned to a bound is not reported converged
+#
+def test_bound_is_not_converged(experiments):
+    fit = fit_xMason(parameters=PARAMETERS, matpath=MATERIALS, experiments=experiments,
+                     bounds={'h33': (0.2, 1.0)})
+    pinned = TRUTHS[:, 2] > 1
+    np.testing.assert_allclose(fit.factors[pinned, 2], 1.0)
+    assert not np.any(fit.results['converged'][pinned])
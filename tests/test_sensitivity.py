@@ -0,0 +1,69 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+
+from simulation.src.data.loader import Material
+from simulation.src.features.characteristics import compile_layers
+from simulation.src.features.compiled import CompiledStack
+from simulation.src.features.sensitivity import mason_chain_sensitivity
+
+
+MATERIALS = 'data/materials.csv'
+
+
+def stack():
+    return compile_layers(library=Material(MATERIALS).library, radius=0.0088, piezo='P(VDF-TrFE)',
+                          thickness_td=12.3e-6, top_layers=[('Silverink', 0.5e-6)],
+                          bottom_layers=[('Silverink', 0.5e-6), ('Kapton', 13e-6)], Tload='Air')
+
+
+# d / dx with x the log of the piezo thickness: t_piezo ~ e^x, C0 and N ~ e^-x
+#
+def thickness_exponents(compiled):
+    exponents = {name: np.zeros((1,) + value.shape) for name, value in compiled.arrays.items()}
+    exponents['t_piezo'][:] = 1
+    exponents['C0'][:] = -1
+    exponents['N'][:] = -1
+    return exponents
+
+
+def scaled(compiled, x):
+    arrays = dict(compiled.arrays)
+    arrays.update({'t_piezo': compiled.t_piezo * np.exp(x),
+                   'C0': compiled.C0 * np.exp(-x),
+                   'N': compiled.N * np.exp(-x)})
+    return CompiledStack(**arrays)
+
+
+# Value and gradient at and around the half-wave resonances theta = k pi,
+# where the optimizer drives the design
+#
+def test_sensitivity_at_half_wave_resonance():
+    compiled = stack()
+    half_wave = float(compiled.v_piezo / (2 * compiled.t_piezo))
+    frequency = np.array([half_wave, 2 * half_wave, half_wave * (1 + 1e-9), 0.5 * half_wave, 60e6])
+
+    Z, dZ = mason_chain_sensitivity(frequency, compiled, thickness_exponents(compiled))
+    reference = compiled.electric_impedance(frequency)
+    np.testing.assert_allclose(Z, reference, rtol=1e-10)
+
+    step = 1e-6
+    difference = (scaled(compiled, step).electric_impedance(frequency)
+                  - scaled(compiled, -step).electric_impedance(frequency)) / (2 * step)
+    np.testing.assert_allclose(dZ[0], difference, rtol=1e-5)
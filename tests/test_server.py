@@ -0,0 +1,89 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import threading
+import asyncio
+import socket
+import time
+
+import numpy as np
+
+from simulation.src.data.loader import Material
+from simulation.src.features.characteristics import compile_layers
+from simulation.src.models.server import SimulationServer, SimulationClient
+
+
+MATERIALS = 'data/materials.csv'
+
+PARAMETERS = {'radius': 0.0088, 'thickness_td': 12.3e-6, 'piezo': 'P(VDF-TrFE)', 'Tload': 'Air',
+              'top_layers': [['Silverink', 0.5e-6]], 'bottom_layers': [['Silverink', 0.5e-6], ['Kapton', 13e-6]]}
+
+
+def stack(thickness_td=12.3e-6):
+    return compile_layers(library=Material(MATERIALS).library, radius=PARAMETERS['radius'], piezo=PARAMETERS['piezo'],
+                          thickness_td=thickness_td, top_layers=PARAMETERS['top_layers'],
+                          bottom_layers=PARAMETERS['bottom_layers'], Tload='Air')
+
+
+# A single stack and a (2, 3) design grid in one batch, on shared and on
+# different frequency grids
+#
+def test_batch_of_different_shapes():
+    single = stack()
+    grid = stack(thickness_td=np.linspace(10e-6, 14e-6, 6).reshape(2, 3))
+    frequency = np.linspace(20e6, 100e6, 50)
+
+    for other in [frequency, frequency * 1.1]:
+        results = SimulationServer.evaluate([(single, frequency), (grid, other), (single, frequency)])
+        assert [result.shape for result in results] == [(50,), (2, 3, 50), (50,)]
+        np.testing.assert_allclose(results[0], single.electric_impedance(frequency), rtol=1e-12)
+        np.testing.assert_allclose(results[1], grid.electric_impedance(other), rtol=1e-12)
+        np.testing.assert_allclose(results[2], results[0], rtol=1e-12)
+
+
+# Concurrent requests of a single stack and of a design sweep are batched by
+# the server and every client gets its own rows back
+#
+def test_server_batches_requests_of_different_shapes():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = SimulationServer(matpath=MATERIALS, window=0.5)
+    threading.Thread(target=lambda: asyncio.run(server.serve(port=port)), daemon=True).start()
+    time.sleep(0.5)
+
+    frequency = list(np.linspace(20e6, 100e6, 50))
+    requests = {'single': dict(PARAMETERS, frequency=frequency),
+                'sweep': dict(PARAMETERS, frequency=frequency, thickness_td=[11e-6, 12e-6, 13e-6])}
+    results = {}
+
+    def request(name):
+        client = SimulationClient(port=port)
+        results[name] = client.impedance(requests[name])[1]
+        client.close()
+
+    threads = [threading.Thread(target=request, args=(name,)) for name in requests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert server._batches == 1
+    np.testing.assert_allclose(results['single'], stack().electric_impedance(frequency), rtol=1e-12)
+    np.testing.assert_allclose(results['sweep'], stack(np.array([11e-6, 12e-6, 13e-6])).electric_impedance(frequency),
+                               rtol=1e-12)
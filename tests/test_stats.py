@@ -0,0 +1,91 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+import pytest
+
+from simulation.src.features.stats import StreamingStatistics
+
+
+# quantile level: tolerated relative error against np.quantile
+TOLERANCE = {0.05: 0.1, 0.5: 0.02, 0.95: 0.1}
+
+
+# Skewed, positive curves (n_curves, n_points) as |Z| of a Monte Carlo run
+#
+def skewed(kind, shape=(2000, 200), seed=0):
+    rng = np.random.default_rng(seed)
+    if kind == 'lognormal':
+        return np.exp(rng.normal(3, 1, shape))
+    return 1 + 5 * rng.pareto(0.7, shape)
+
+
+def streamed(data, chunk_size=256, **kwargs):
+    statistics = StreamingStatistics(**kwargs)
+    for start in range(0, len(data), chunk_size):
+        statistics.update(data[start:start + chunk_size])
+    return statistics
+
+
+# The quantiles of skewed data are within TOLERANCE of np.quantile and
+# within the stated bound of one bin
+#
+@pytest.mark.parametrize('kind', ['lognormal', 'pareto'])
+def test_quantiles_of_skewed_data(kind):
+    data = skewed(kind)
+    statistics = streamed(data, n_bins=256)
+    for q, tolerance in TOLERANCE.items():
+        exact = np.quantile(data, q, axis=0)
+        error = np.abs(statistics.quantile(q) / exact - 1)
+        assert np.all(error <= statistics.relative_error)
+        assert error.max() < tolerance
+
+
+def test_moments():
+    data = skewed('lognormal')
+    statistics = streamed(data)
+    np.testing.assert_allclose(statistics.mean, data.mean(axis=0), rtol=1e-12)
+    np.testing.assert_allclose(statistics.std, data.std(axis=0), rtol=1e-10)
+    np.testing.assert_array_equal(statistics.min, data.min(axis=0))
+    np.testing.assert_array_equal(statistics.max, data.max(axis=0))
+
+
+# Merging k partial accumulators (e.g. one per worker) gives the quantiles of
+# a single accumulator fed with all curves
+#
+@pytest.mark.parametrize('k', [2, 5])
+def test_merge_matches_single_accumulator(k):
+    data = skewed('pareto', seed=1)
+    parts = [data[i::k] * 4 ** i for i in range(k)]   # different spans, different levels
+    single = streamed(np.concatenate(parts))
+    merged = streamed(parts[0])
+    for part in parts[1:]:
+        merged.merge(streamed(part))
+
+    for q in TOLERANCE:
+        exact = np.quantile(np.concatenate(parts), q, axis=0)
+        np.testing.assert_allclose(merged.quantile(q), single.quantile(q), rtol=1e-12)
+        assert np.all(np.abs(merged.quantile(q) / exact - 1) <= merged.relative_error)
+    np.testing.assert_allclose(merged.mean, single.mean, rtol=1e-12)
+    np.testing.assert_array_equal(merged.count, single.count)
+
+
+def test_merge_rejects_other_grids():
+    data = skewed('lognormal')
+    with pytest.raises(ValueError):
+        streamed(data, n_bins=128).merge(streamed(data, n_bins=256))
@@ -0,0 +1,61 @@
+"""
+   Copyright (C) 2022 Graz University of Technology. All rights reserved.
+
+   Author: Christoph Leitner
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at:
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import numpy as np
+import pytest
+
+from simulation.src.models.simulator import simulator_xMason
+from simulation.src.models.surrogate import surrogate_xMason
+
+
+MATERIALS = 'data/materials.csv'
+PARAMETERS = dict(fband=None, frequency=np.linspace(20e6, 100e6, 2001), radius=0.0088, thickness_td=12.3e-6,
+                  thickness_el=0.5e-6, thickness_sub=13e-6, Tload='Air', Telectrode='Silverink',
+                  piezo='P(VDF-TrFE)', Belectrode='Silverink', Bsubstrate='Kapton', Bload='Air')
+
+
+@pytest.fixture(scope='module')
+def surrogate():
+    return surrogate_xMason(PARAMETERS, MATERIALS, n_poles=6, sweep=('thickness_td', np.linspace(11e-6, 13e-6, 5)),
+                            tolerance=1e-2, max_samples=33)
+
+
+# Every interval is checked inside, not only at its midpoint, and the recorded
+# worst point reproduces the recorded error
+#
+def test_intervals_are_checked_inside(surrogate):
+    errors = surrogate.errors
+    assert np.all((errors['low'] < errors['value']) & (errors['value'] < errors['high']))
+    assert not np.any(np.isclose(errors['value'], (errors['low'] + errors['high']) / 2))
+
+    simulator = simulator_xMason(parameters=PARAMETERS, matpath=MATERIALS)
+    frequency = PARAMETERS['frequency']
+    for value, error in zip(errors['value'], errors['error']):
+        exact = simulator.replace(thickness_td=value).evaluate(frequency)
+        approximation = surrogate.model(value).evaluate(frequency)
+        assert np.isclose(np.max(np.abs(approximation - exact) / np.abs(exact)), error, rtol=1e-9)
+
+
+@pytest.mark.parametrize('value', [10e-6, 14e-6])
+def test_out_of_range_is_rejected_consistently(surrogate, value):
+    with pytest.raises(ValueError, match='outside the fitted range'):
+        surrogate.within_tolerance(value)
+    with pytest.raises(ValueError, match='outside the fitted range'):
+        surrogate.model(value)
+    with pytest.raises(ValueError, match='outside the fitted range'):
+        surrogate.evaluate(PARAMETERS['frequency'], value)